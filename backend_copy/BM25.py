@@ -2,12 +2,22 @@ from nltk.util import ngrams
 import nltk
 import math
 from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+import hashlib
+import json
+import os
+import shutil
 import numpy as np
 from nltk.stem.snowball import SnowballStemmer
 
 stemmer = SnowballStemmer("russian")
 
 N_GRAM_SIZE = 3
+# Размер кэша стемминга (число различных слов)
+STEM_CACHE_SIZE = 200_000
+# Версия формата сохраненного лексического индекса; при изменении индекс пересобирается
+LEXICAL_INDEX_VERSION = 2
 
 def display_search_results(documents, idx_scores, char_limit=100):
     for idx, score in idx_scores:
@@ -71,49 +81,274 @@ def documents_to_ngrams(documents, n_gram_size=N_GRAM_SIZE, progress=False):
 
     return document_ngrams
     
-def documents_to_index(documents, n_gram_size=N_GRAM_SIZE):
-    documents_preprocessed = [
-        preprocess_document(doc) for doc in documents
-    ]
+def documents_to_index(documents, n_gram_size=N_GRAM_SIZE, documents_preprocessed=None):
+    if documents_preprocessed is None:
+        documents_preprocessed = [
+            preprocess_document(doc) for doc in documents
+        ]
 
     documents_ngrams = documents_to_ngrams(documents_preprocessed, n_gram_size)
     return documents_ngrams
 
+def collect_postings(documents_tokens, vocabulary, doc_offset=0):
+    """
+    Постинги (term_id, doc_id, count) документов в порядке документов;
+    новые термины дописываются в vocabulary, номера документов начинаются с doc_offset.
+    """
+    term_ids = []
+    doc_ids = []
+    counts = []
+    doc_lengths = np.zeros(len(documents_tokens), dtype=np.int64)
+
+    for doc_id, tokens in enumerate(documents_tokens):
+        doc_lengths[doc_id] = len(tokens)
+        for token, count in Counter(tokens).items():
+            term_id = vocabulary.setdefault(token, len(vocabulary))
+            term_ids.append(term_id)
+            doc_ids.append(doc_offset + doc_id)
+            counts.append(count)
+
+    return (
+        np.asarray(term_ids, dtype=np.int64),
+        np.asarray(doc_ids, dtype=np.int64),
+        np.asarray(counts, dtype=np.float64),
+        doc_lengths,
+    )
+
+def merge_postings(indptr, doc_ids, values, new_term_ids, new_doc_ids, new_values, n_terms):
+    """
+    Дописывает постинги новых документов в CSR-матрицу (values и new_values - списки массивов
+    значений постингов). Новые документы идут после старых, поэтому stable-сортировка
+    по термину сохраняет порядок doc_id внутри строки - результат совпадает с полной сборкой.
+    """
+    old_term_ids = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    term_ids = np.concatenate([old_term_ids, new_term_ids])
+    order = np.argsort(term_ids, kind="stable")
+    indptr = np.zeros(n_terms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=n_terms), out=indptr[1:])
+    doc_ids = np.concatenate([doc_ids, new_doc_ids])[order]
+    values = [np.concatenate([old, new])[order] for old, new in zip(values, new_values)]
+    return indptr, doc_ids, values
+
+def build_inverted_index(documents_tokens):
+    """
+    Строит инвертированный индекс в виде CSR-матрицы термин-документ.
+    Возвращает словарь термин -> строка, indptr, doc_ids, counts и длины документов.
+    """
+    vocabulary = {}
+    term_ids, doc_ids, counts, doc_lengths = collect_postings(documents_tokens, vocabulary)
+    empty = np.zeros(0, dtype=np.int64)
+    indptr, doc_ids, (counts,) = merge_postings(
+        np.zeros(1, dtype=np.int64), empty, [np.zeros(0)],
+        term_ids, doc_ids, [counts], len(vocabulary),
+    )
+    return vocabulary, indptr, doc_ids, counts, doc_lengths
+
+def gather_postings(indptr, rows):
+    """
+    Возвращает позиции всех постингов для строк rows и номер строки для каждой позиции
+    (без python-цикла по терминам).
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    positions = offsets + np.arange(lengths.sum())
+    owner = np.repeat(np.arange(len(rows)), lengths)
+    return positions, owner
+
+def top_k(doc_ids, scores, limit):
+    """
+    Top-k по убыванию score через argpartition.
+    При равных score порядок такой же, как у sorted(..., key=-score) по исходному порядку.
+    """
+    if limit <= 0 or len(scores) == 0:
+        return []
+    if limit < len(scores):
+        kth = scores[np.argpartition(-scores, limit - 1)[:limit]].min()
+        keep = np.flatnonzero(scores >= kth)
+    else:
+        keep = np.arange(len(scores))
+    order = keep[np.lexsort((keep, -scores[keep]))][:limit]
+    return list(zip(np.asarray(doc_ids)[order].tolist(), scores[order].tolist()))
+
+def query_to_rows(query_tokens, vocabulary):
+    """Строки индекса и кратности для токенов запроса, которые есть в словаре."""
+    rows = []
+    weights = []
+    for token, count in Counter(query_tokens).items():
+        row = vocabulary.get(token)
+        if row is not None:
+            rows.append(row)
+            weights.append(count)
+    return np.asarray(rows, dtype=np.int64), np.asarray(weights, dtype=np.float64)
+
+
+def queries_to_rows(queries_tokens, vocabulary):
+    """Строки индекса, кратности и номер запроса для пакета запросов."""
+    rows = []
+    weights = []
+    row_queries = []
+    for query_id, query_tokens in enumerate(queries_tokens):
+        query_rows, query_weights = query_to_rows(query_tokens, vocabulary)
+        rows.append(query_rows)
+        weights.append(query_weights)
+        row_queries.append(np.full(len(query_rows), query_id, dtype=np.int64))
+    if not rows:
+        return (
+            np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.int64)
+        )
+    return np.concatenate(rows), np.concatenate(weights), np.concatenate(row_queries)
+
+def accumulate_postings(indptr, doc_ids, values, rows, row_weights, row_queries, n_documents):
+    """
+    Пакетное разреженное произведение матрицы термин-документ на матрицу запросов.
+    Возвращает отсортированные ключи query_id * n_documents + doc_id и суммы по ним.
+    """
+    positions, owner = gather_postings(indptr, rows)
+    keys = row_queries[owner] * n_documents + doc_ids[positions]
+    keys, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse, weights=values[positions] * row_weights[owner], minlength=len(keys))
+    return keys, sums
+
+def save_index(path, prefix, vocabulary, arrays):
+    """Сохраняет словарь (json, термины в порядке строк) и массивы CSR-индекса (.npy)."""
+    terms = sorted(vocabulary, key=vocabulary.get)
+    with open(path / f"{prefix}_vocabulary.json", "w", encoding="utf-8") as f:
+        json.dump(terms, f, ensure_ascii=False)
+    for name, array in arrays.items():
+        np.save(path / f"{prefix}_{name}.npy", array)
+
+def load_index(path, prefix, names, mmap_mode="r"):
+    """Загружает словарь и массивы индекса; массивы отображаются в память (mmap)."""
+    with open(path / f"{prefix}_vocabulary.json", encoding="utf-8") as f:
+        vocabulary = {term: row for row, term in enumerate(json.load(f))}
+    arrays = {
+        name: np.load(path / f"{prefix}_{name}.npy", mmap_mode=mmap_mode)
+        for name in names
+    }
+    return vocabulary, arrays
+
+
 class SearchTFIDF:
+    INDEX_ARRAYS = ("indptr", "doc_ids", "tf", "idf")
+
     def __init__(self, n_gram_size=N_GRAM_SIZE):
         self.n_gram_size = n_gram_size
 
         self.documents = None
-        self.documents_ngrams = None
+        # Инвертированный индекс: n-грамма -> строка CSR-матрицы (doc_ids, нормированный tf)
+        self.vocabulary = None
+        self.indptr = None
+        self.doc_ids = None
+        self.tf = None
+        self.idf = None
 
     def fit(
         self,
         documents,
+        documents_preprocessed=None,
     ):
         self.documents = documents
 
-        self.documents_ngrams = documents_to_index(
+        documents_ngrams = documents_to_index(
             documents,
             n_gram_size=self.n_gram_size,
+            documents_preprocessed=documents_preprocessed,
+        )
+        self.vocabulary, self.indptr, self.doc_ids, counts, doc_lengths = build_inverted_index(
+            documents_ngrams
         )
 
+        # tf нормируется на число n-грамм документа, idf считается один раз при fit
+        self.tf = counts / doc_lengths[self.doc_ids]
+        self.compute_idf()
+
+    def compute_idf(self):
+        documents_containing = np.diff(self.indptr)
+        N = len(self.documents)
+        self.idf = np.log((1 + N) / (1 + documents_containing))
+
+    def add_documents(self, documents, documents_preprocessed):
+        """
+        Доиндексирует хвост корпуса: documents - весь новый корпус, его начало совпадает
+        с уже проиндексированным, documents_preprocessed - только новые документы.
+        """
+        doc_offset = len(self.documents)
+        documents_ngrams = documents_to_ngrams(documents_preprocessed, self.n_gram_size)
+        self.vocabulary = dict(self.vocabulary)
+        term_ids, doc_ids, counts, doc_lengths = collect_postings(documents_ngrams, self.vocabulary, doc_offset)
+        tf = counts / doc_lengths[doc_ids - doc_offset]
+        self.indptr, self.doc_ids, (self.tf,) = merge_postings(
+            self.indptr, self.doc_ids, [self.tf], term_ids, doc_ids, [tf], len(self.vocabulary)
+        )
+        self.documents = documents
+        self.compute_idf()
+
     def search(self, query, limit=5):
-        idx_scores = search_tf_idf(
-            self.documents_ngrams,
-            query,
-            limit=limit,
-            n_gram_size=self.n_gram_size,
+        """
+        Обходит только постинги n-грамм запроса.
+        Документы без общих n-грамм с запросом (score = 0) в выдачу не попадают.
+        """
+        return self.search_batch([query], limit=limit)[0]
+
+    def search_batch(self, queries, limit=5, documents_mask=None):
+        """
+        Поиск сразу по пакету запросов: одно разреженное произведение на все запросы.
+        Запросы - строки или PreprocessedQuery (предобрабатываются так же, как документы).
+        documents_mask - булев массив допустимых документов (фильтр до отбора top-k).
+        """
+        rows, weights, row_queries = queries_to_rows(
+            [query.ngrams(self.n_gram_size) for query in preprocess_queries(queries)],
+            self.vocabulary,
         )
-        return idx_scores[:limit]
+        n_documents = len(self.documents)
+        keys, scores = accumulate_postings(
+            self.indptr, self.doc_ids, self.tf,
+            rows, self.idf[rows] * weights, row_queries, n_documents,
+        )
+        if documents_mask is not None:
+            keep = np.asarray(documents_mask)[keys % n_documents]
+            keys, scores = keys[keep], scores[keep]
+        bounds = np.searchsorted(keys, np.arange(len(queries) + 1) * n_documents)
+        return [
+            top_k(keys[start:end] - query_id * n_documents, scores[start:end], limit)
+            for query_id, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+        ]
 
     def search_and_display(self, query, limit=5):
         idx_scores = self.search(query, limit=limit)
         display_search_results(self.documents, idx_scores)
 
+    def save(self, path, prefix="tfidf"):
+        save_index(
+            path, prefix, self.vocabulary,
+            {name: getattr(self, name) for name in self.INDEX_ARRAYS},
+        )
+
+    def load(self, path, documents, prefix="tfidf", mmap_mode="r"):
+        self.documents = documents
+        self.vocabulary, arrays = load_index(path, prefix, self.INDEX_ARRAYS, mmap_mode=mmap_mode)
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        return self
+
 
+@lru_cache(maxsize=STEM_CACHE_SIZE)
 def stem(word):
+    # lru_cache ограничен по размеру и потокобезопасен
     return stemmer.stem(word)
 
+def stem_cache_info():
+    """Статистика кэша стемминга: попадания, промахи, текущий и максимальный размер."""
+    info = stem.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "maxsize": info.maxsize,
+    }
+
 def preprocess_document(document):
     new_doc = ''.join(
         c for c in document if c.isalnum() or c == ' '
@@ -128,10 +363,11 @@ def documents_to_words(documents):
     documents_words = tuple(documents_words)
     return documents_words
 
-def bm25_documents_to_index(documents):
-    documents_preprocessed = [
-        preprocess_document(doc) for doc in documents
-    ]
+def bm25_documents_to_index(documents, documents_preprocessed=None):
+    if documents_preprocessed is None:
+        documents_preprocessed = [
+            preprocess_document(doc) for doc in documents
+        ]
 
     documents_words = documents_to_words(documents_preprocessed)
     return documents_words
@@ -139,6 +375,26 @@ def bm25_documents_to_index(documents):
 def bm25_query_to_wrods(query):
     return bm25_documents_to_index([query])[0]
 
+
+class PreprocessedQuery:
+    """Запрос, предобработанный один раз и общий для этапов TF-IDF и BM25."""
+    def __init__(self, query):
+        self.query = query
+        self.text = preprocess_document(query)
+        self.words = documents_to_words([self.text])[0]
+        self._ngrams = {}
+
+    def ngrams(self, n_gram_size=N_GRAM_SIZE):
+        if n_gram_size not in self._ngrams:
+            self._ngrams[n_gram_size] = documents_to_ngrams([self.text], n_gram_size)[0]
+        return self._ngrams[n_gram_size]
+
+def preprocess_queries(queries):
+    return [
+        query if isinstance(query, PreprocessedQuery) else PreprocessedQuery(query)
+        for query in queries
+    ]
+
 def idf_bm25(
     number_documents_containing_ngram,
     total_documents,
@@ -164,48 +420,90 @@ def bm25_score(
     return ngram_idf * tf_bm25(ngram_tf, document_length, average_document_length, k1=k1, b=b)
 
 
-class SearchBM25:
-    def __init__(self):
-        self.documents = None
-        self.documents_ngrams = None
-        self.tf = None
-        self.idf = None
+# Значения, которые подставляются для терминов, отсутствующих в документе / корпусе
+BM25_MISSING_TF = 1e-6
+BM25_MISSING_IDF = 1e-6
 
-    def calculate_tf(self, documents_ngrams):
-        tf = [Counter(doc_ngrams) for doc_ngrams in documents_ngrams]
 
-        return tf
-
-    def calculate_idf(self, tf, documents_ngrams):
-        idf = {}
-
-        documents_containing = {}
-
-        for doc_tf in tf:
-            for ngram in doc_tf.keys():
-                if not ngram in documents_containing:
-                    documents_containing[ngram] = 0
-                documents_containing[ngram] += 1
+class SearchBM25:
+    """
+    BM25+ на CSR-матрице термин-документ.
+    Score документа: sum(idf * (tf_bm25(tf) + delta)) по словам запроса, как в bm25_score;
+    для отсутствующих терминов tf = BM25_MISSING_TF, idf = BM25_MISSING_IDF.
+    """
+    INDEX_ARRAYS = ("indptr", "doc_ids", "counts", "doc_lengths", "idf", "weights", "base")
+
+    def __init__(self, k1=1.5, b=0.75, delta=1):
+        self.k1 = k1
+        self.b = b
+        self.delta = delta
 
-        for ngram in documents_containing.keys():
-            idf[ngram] = idf_bm25(
-                number_documents_containing_ngram=documents_containing[ngram],
-                total_documents=len(documents_ngrams),
-            )
-        return idf
+        self.documents = None
+        self.vocabulary = None
+        self.indptr = None
+        self.doc_ids = None
+        self.doc_lengths = None
+        # Кратности слов в постингах: нужны для пересчета весов при доиндексации
+        self.counts = None
+        self.idf = None
+        # Вклад постинга сверх базового score документа (уже умножен на idf)
+        self.weights = None
+        # Базовый score документа на единицу idf запроса: tf_bm25(BM25_MISSING_TF) + delta
+        self.base = None
 
     def fit(
         self,
         documents,
+        documents_preprocessed=None,
     ):
         self.documents = documents
 
-        self.documents_ngrams = bm25_documents_to_index(
+        documents_words = bm25_documents_to_index(
             documents,
+            documents_preprocessed=documents_preprocessed,
+        )
+        self.vocabulary, self.indptr, self.doc_ids, self.counts, self.doc_lengths = build_inverted_index(
+            documents_words
+        )
+        self.compute_weights()
+
+    def add_documents(self, documents, documents_preprocessed):
+        """
+        Доиндексирует хвост корпуса (см. SearchTFIDF.add_documents).
+        idf и средняя длина документа глобальные, поэтому веса постингов пересчитываются.
+        """
+        doc_offset = len(self.doc_lengths)
+        documents_words = documents_to_words(documents_preprocessed)
+        self.vocabulary = dict(self.vocabulary)
+        term_ids, doc_ids, counts, doc_lengths = collect_postings(documents_words, self.vocabulary, doc_offset)
+        self.indptr, self.doc_ids, (self.counts,) = merge_postings(
+            self.indptr, self.doc_ids, [self.counts], term_ids, doc_ids, [counts], len(self.vocabulary)
+        )
+        self.doc_lengths = np.concatenate([self.doc_lengths, doc_lengths])
+        self.documents = documents
+        self.compute_weights()
+
+    def compute_weights(self):
+        counts = self.counts
+        avg_document_length = self.doc_lengths.mean()
+        self.idf = idf_bm25(
+            number_documents_containing_ngram=np.diff(self.indptr),
+            total_documents=len(self.doc_lengths),
         )
 
-        self.tf = self.calculate_tf(self.documents_ngrams)
-        self.idf = self.calculate_idf(self.tf, self.documents_ngrams)
+        missing_tf = tf_bm25(
+            BM25_MISSING_TF, self.doc_lengths, avg_document_length,
+            k1=self.k1, b=self.b, delta=0,
+        )
+        self.base = missing_tf + self.delta
+
+        posting_lengths = self.doc_lengths[self.doc_ids]
+        posting_tf = tf_bm25(
+            counts, posting_lengths, avg_document_length,
+            k1=self.k1, b=self.b, delta=0,
+        )
+        term_ids = np.repeat(np.arange(len(self.vocabulary)), np.diff(self.indptr))
+        self.weights = self.idf[term_ids] * (posting_tf - missing_tf[self.doc_ids])
 
     def search_bm25(
         self,
@@ -213,36 +511,63 @@ class SearchBM25:
         limit,
         only_documents=None,
     ):
-        avg_document_length = sum([
-            len(doc) for doc in self.documents_ngrams
-        ])/len(self.documents_ngrams)
-        query = bm25_query_to_wrods(query)
-        indexes = []
-        match_scores = []
-
-        document_indexes = range(len(self.tf)) if only_documents is None else only_documents
-        for i in document_indexes:
-            document_tf = self.tf[i]
-
-            document_length = sum(document_tf.values())
-            if document_length == 0:
-                continue
-
-            score = 0
-            for query_ngram in query:
-                ngram_score = bm25_score(
-                    self.idf.get(query_ngram, 1e-6),
-                    document_tf.get(query_ngram, 1e-6),
-                    document_length=document_length,
-                    average_document_length=avg_document_length,
-                )
-                score += ngram_score
-            match_scores.append(score)
-            indexes.append(i)
-
-        idx_scores = zip(indexes, match_scores)
-        idx_scores = sorted(idx_scores, key=lambda pair: -pair[1])
-        return idx_scores[:limit]
+        return self.search_bm25_batch([query], limit, only_documents=[only_documents])[0]
+
+    def search_bm25_batch(
+        self,
+        queries,
+        limit,
+        only_documents=None,
+    ):
+        """
+        Пакетный BM25: queries - строки или PreprocessedQuery,
+        only_documents - None или список кандидатов (или None) для каждого запроса.
+        Без ограничения кандидатов на каждый запрос оценивается весь корпус.
+        """
+        if only_documents is None:
+            only_documents = [None] * len(queries)
+
+        queries_words = [query.words for query in preprocess_queries(queries)]
+        rows, weights, row_queries = queries_to_rows(queries_words, self.vocabulary)
+        n_documents = len(self.base)
+
+        # Каждое слово запроса дает документу минимум idf * (tf_bm25(BM25_MISSING_TF) + delta)
+        known_idf = np.bincount(row_queries, weights=self.idf[rows] * weights, minlength=len(queries))
+        known_words = np.bincount(row_queries, weights=weights, minlength=len(queries))
+        query_lengths = np.array([len(words) for words in queries_words], dtype=np.float64)
+        idf_total = known_idf + BM25_MISSING_IDF * (query_lengths - known_words)
+
+        # Разреженное произведение матрицы на матрицу запросов
+        keys, sums = accumulate_postings(
+            self.indptr, self.doc_ids, self.weights,
+            rows, weights, row_queries, n_documents,
+        )
+
+        candidates = []
+        for document_indexes in only_documents:
+            if document_indexes is None:
+                document_indexes = np.arange(n_documents)
+            else:
+                document_indexes = np.asarray(document_indexes, dtype=np.int64)
+            candidates.append(document_indexes[self.doc_lengths[document_indexes] > 0])
+
+        candidate_queries = np.repeat(np.arange(len(queries)), [len(c) for c in candidates])
+        candidate_docs = np.concatenate(candidates) if candidates else np.zeros(0, dtype=np.int64)
+        candidate_keys = candidate_queries * n_documents + candidate_docs
+
+        found = np.searchsorted(keys, candidate_keys)
+        found = np.minimum(found, max(len(keys) - 1, 0))
+        sparse = np.zeros(len(candidate_keys))
+        if len(keys):
+            matched = keys[found] == candidate_keys
+            sparse[matched] = sums[found[matched]]
+        scores = idf_total[candidate_queries] * self.base[candidate_docs] + sparse
+
+        bounds = np.cumsum([0] + [len(c) for c in candidates])
+        return [
+            top_k(candidate_docs[start:end], scores[start:end], limit)
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
 
 
     def search(self, query, limit=5):
@@ -256,6 +581,19 @@ class SearchBM25:
         idx_scores = self.search(query, limit=limit)
         display_search_results(self.documents, idx_scores, char_limit=char_limit)
 
+    def save(self, path, prefix="bm25"):
+        save_index(
+            path, prefix, self.vocabulary,
+            {name: getattr(self, name) for name in self.INDEX_ARRAYS},
+        )
+
+    def load(self, path, documents, prefix="bm25", mmap_mode="r"):
+        self.documents = documents
+        self.vocabulary, arrays = load_index(path, prefix, self.INDEX_ARRAYS, mmap_mode=mmap_mode)
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        return self
+
 
 class TwoStageSearch:
     def __init__(self, n_gram_size=3):
@@ -266,12 +604,25 @@ class TwoStageSearch:
 
     def fit(self, documents):
         self.documents = documents
+        # Предобработка корпуса общая для обоих индексов
+        documents_preprocessed = [preprocess_document(doc) for doc in documents]
 
         self.tfidf_index = SearchTFIDF(n_gram_size=self.n_gram_size)
-        self.tfidf_index.fit(self.documents)
+        self.tfidf_index.fit(self.documents, documents_preprocessed=documents_preprocessed)
 
         self.bm25_index = SearchBM25()
-        self.bm25_index.fit(self.documents)
+        self.bm25_index.fit(self.documents, documents_preprocessed=documents_preprocessed)
+
+    def add_documents(self, documents):
+        """
+        Доиндексирует документы, дописанные в конец корпуса: documents - весь новый корпус.
+        Предобрабатываются только новые документы, постинги дописываются в CSR-индексы.
+        """
+        new_documents = [documents[i] for i in range(len(self.documents), len(documents))]
+        documents_preprocessed = [preprocess_document(doc) for doc in new_documents]
+        self.tfidf_index.add_documents(documents, documents_preprocessed)
+        self.bm25_index.add_documents(documents, documents_preprocessed)
+        self.documents = documents
 
     @staticmethod
     def gmean(values):
@@ -283,16 +634,9 @@ class TwoStageSearch:
             product *= v
         return product ** (1.0 / n)
 
-    def search(self, query, limit_stage1=100, limit_stage2=5):
-        idx_scores_stage1 = self.tfidf_index.search(query, limit=limit_stage1)
-        idx_scores_stage1 = [p for p in idx_scores_stage1 if p[1] > 1e-05]
+    def aggregate_scores(self, idx_scores_stage1, idx_scores_stage2):
         idx_to_score_stage1 = {idx: score for idx, score in idx_scores_stage1}
 
-        only_document_indexes = list(idx_to_score_stage1.keys())
-        idx_scores_stage2 = self.bm25_index.search_bm25(
-            query, limit=limit_stage2, only_documents=only_document_indexes
-        )
-
         aggregated_scores = {
             idx: self.gmean([score, idx_to_score_stage1[idx]])
             for idx, score in idx_scores_stage2
@@ -309,12 +653,156 @@ class TwoStageSearch:
         )
         finally_scores = [[idx, final_sc] for idx, _, _, final_sc in idx_scores]
         return finally_scores
-    
+
+    def search(self, query, limit_stage1=100, limit_stage2=5, documents_mask=None):
+        return self.search_batch(
+            [query], limit_stage1=limit_stage1, limit_stage2=limit_stage2, documents_mask=documents_mask
+        )[0]
+
+    def search_batch(self, queries, limit_stage1=100, limit_stage2=5, documents_mask=None):
+        """
+        Поиск по пакету запросов: оба этапа считаются общими матричными операциями.
+        Результат для каждого запроса совпадает с вызовом search.
+        Каждый запрос предобрабатывается один раз и переиспользуется обоими этапами.
+        documents_mask ограничивает уже первый этап, поэтому второй видит только допустимые документы.
+        """
+        queries = preprocess_queries(queries)
+        batch_stage1 = self.tfidf_index.search_batch(queries, limit=limit_stage1, documents_mask=documents_mask)
+        batch_stage1 = [
+            [p for p in idx_scores_stage1 if p[1] > 1e-05]
+            for idx_scores_stage1 in batch_stage1
+        ]
+
+        batch_stage2 = self.bm25_index.search_bm25_batch(
+            queries,
+            limit=limit_stage2,
+            only_documents=[[idx for idx, _ in idx_scores_stage1] for idx_scores_stage1 in batch_stage1],
+        )
+
+        return [
+            self.aggregate_scores(idx_scores_stage1, idx_scores_stage2)
+            for idx_scores_stage1, idx_scores_stage2 in zip(batch_stage1, batch_stage2)
+        ]
+
+    def save(self, path, checksum=None):
+        """
+        Сохраняет оба индекса в каталог path. Запись идет во временный каталог,
+        который затем атомарно переименовывается.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        self.tfidf_index.save(tmp_path)
+        self.bm25_index.save(tmp_path)
+        meta = {
+            "version": LEXICAL_INDEX_VERSION,
+            "checksum": checksum,
+            "n_gram_size": self.n_gram_size,
+            "n_documents": len(self.documents),
+            "bm25": {"k1": self.bm25_index.k1, "b": self.bm25_index.b, "delta": self.bm25_index.delta},
+        }
+        with open(tmp_path / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Индекс уже сохранен другим процессом
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, documents, checksum=None, mmap_mode="r"):
+        """
+        Загружает сохраненный индекс (массивы через mmap).
+        Возвращает None, если индекса нет или он не подходит к documents.
+        """
+        path = Path(path)
+        try:
+            with open(path / "meta.json", encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if (
+            meta.get("version") != LEXICAL_INDEX_VERSION
+            or meta.get("checksum") != checksum
+            or meta.get("n_documents") != len(documents)
+        ):
+            return None
+
+        searcher = cls(n_gram_size=meta["n_gram_size"])
+        searcher.documents = documents
+        searcher.tfidf_index = SearchTFIDF(n_gram_size=searcher.n_gram_size).load(
+            path, documents, mmap_mode=mmap_mode
+        )
+        searcher.bm25_index = SearchBM25(**meta["bm25"]).load(
+            path, documents, mmap_mode=mmap_mode
+        )
+        return searcher
+
+
+def corpus_checksum(documents, n_gram_size=N_GRAM_SIZE):
+    """Контрольная сумма корпуса и параметров индекса."""
+    h = hashlib.sha256()
+    h.update(f"{LEXICAL_INDEX_VERSION}:{n_gram_size}:{len(documents)}".encode())
+    for doc in documents:
+        data = doc.encode("utf-8")
+        h.update(len(data).to_bytes(8, "little"))
+        h.update(data)
+    return h.hexdigest()
+
+def load_or_fit_searcher(documents, index_root, n_gram_size=N_GRAM_SIZE):
+    """
+    Загружает TwoStageSearch из index_root/<checksum корпуса>; если корпус изменился
+    (или индекса нет), заново обучает и сохраняет его, удаляя устаревшие версии.
+    """
+    index_root = Path(index_root)
+    checksum = corpus_checksum(documents, n_gram_size)
+    index_path = index_root / checksum[:16]
+
+    try:
+        searcher = TwoStageSearch.load(index_path, documents, checksum=checksum)
+    except Exception as e:
+        print(f"Не удалось загрузить лексический индекс {index_path}: {e}")
+        searcher = None
+    if searcher is not None:
+        return searcher
+
+    searcher = TwoStageSearch(n_gram_size=n_gram_size)
+    searcher.fit(documents)
+    store_searcher(searcher, index_root, checksum)
+    return searcher
+
+def store_searcher(searcher, index_root, checksum):
+    """Сохраняет индекс в index_root/<checksum> и удаляет устаревшие версии."""
+    index_root = Path(index_root)
+    index_path = index_root / checksum[:16]
+    try:
+        index_root.mkdir(parents=True, exist_ok=True)
+        searcher.save(index_path, checksum=checksum)
+        for old_path in index_root.iterdir():
+            if old_path.is_dir() and old_path.name != index_path.name and ".tmp" not in old_path.name:
+                shutil.rmtree(old_path, ignore_errors=True)
+    except OSError as e:
+        print(f"Не удалось сохранить лексический индекс {index_path}: {e}")
+
+def extend_searcher(old_documents, documents, index_root, n_gram_size=N_GRAM_SIZE):
+    """
+    Индекс корпуса documents, который продолжает old_documents: сохраненный индекс
+    old_documents доиндексируется только новыми документами и сохраняется под новой суммой.
+    """
+    searcher = load_or_fit_searcher(old_documents, index_root, n_gram_size=n_gram_size)
+    searcher.add_documents(documents)
+    store_searcher(searcher, index_root, corpus_checksum(documents, n_gram_size))
+    return searcher
+
 def bm25_to_faiss_format(bm25_results, all_payloads):
     return [{"payload": all_payloads[idx], "score": score} for idx, score in bm25_results]
 
-def search_BM25_global(searcher, question, all_payloads ,lim_stage2=5):
-    finally_scores = searcher.search(question, limit_stage2=lim_stage2)
+def search_BM25_global(searcher, question, all_payloads ,lim_stage2=5, documents_mask=None):
+    finally_scores = searcher.search(question, limit_stage2=lim_stage2, documents_mask=documents_mask)
     bm25_results = bm25_to_faiss_format(finally_scores, all_payloads)
     return bm25_results
     
@@ -0,0 +1,157 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Hashable
+
+# Допуск RAG-запросов (на процесс API).
+# Сколько RAG-запросов выполняется одновременно; остальные ждут в очереди
+RAG_MAX_CONCURRENCY = int(os.getenv("RAG_MAX_CONCURRENCY", "4"))
+# Предел очереди: сверх него - 503, сверх доли одного пользователя - 429
+RAG_MAX_QUEUE = int(os.getenv("RAG_MAX_QUEUE", "32"))
+RAG_MAX_QUEUED_PER_USER = int(os.getenv("RAG_MAX_QUEUED_PER_USER", "4"))
+# Сколько запрос может ждать в очереди, прежде чем получить 503
+RAG_QUEUE_TIMEOUT = float(os.getenv("RAG_QUEUE_TIMEOUT", "30"))
+# Окно последних ожиданий / длительностей для метрик и оценки Retry-After
+METRICS_WINDOW = 1000
+DEFAULT_SERVICE_TIME = 10.0
+
+
+class Overloaded(Exception):
+    """Запрос не принят: status_code - 429 или 503, retry_after - секунды до повтора."""
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Допуск RAG-запросов: не больше max_concurrency одновременно, ограниченная очередь.
+    Очередь справедливая: освободившийся слот получает следующий по кругу пользователь,
+    поэтому пачка запросов одного пользователя не задерживает остальных.
+    Все методы вызываются из event loop (состояние не защищено блокировками).
+    """
+    def __init__(
+        self,
+        max_concurrency: int = RAG_MAX_CONCURRENCY,
+        max_queue: int = RAG_MAX_QUEUE,
+        max_queued_per_user: int = RAG_MAX_QUEUED_PER_USER,
+        queue_timeout: float = RAG_QUEUE_TIMEOUT,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.queued = 0
+        # Пользователь -> очередь его future; порядок ключей - порядок обхода по кругу
+        self.waiting: "OrderedDict[Hashable, deque]" = OrderedDict()
+        self.counters = {"admitted": 0, "rejected_queue_full": 0, "rejected_user_limit": 0, "timed_out": 0}
+        self.queue_waits = deque(maxlen=METRICS_WINDOW)
+        self.service_times = deque(maxlen=METRICS_WINDOW)
+
+    def retry_after(self) -> int:
+        """Оценка времени до освобождения места: очередь / параллелизм * среднее время запроса."""
+        service_time = (
+            sum(self.service_times) / len(self.service_times) if self.service_times else DEFAULT_SERVICE_TIME
+        )
+        return max(1, math.ceil(service_time * (self.queued + 1) / self.max_concurrency))
+
+    async def acquire(self, user_id: Hashable) -> float:
+        """Ждет слот; возвращает время ожидания в очереди. Бросает Overloaded."""
+        started_at = time.monotonic()
+        if self.running < self.max_concurrency and not self.queued:
+            self.running += 1
+            return self.admit(started_at)
+
+        if self.queued >= self.max_queue:
+            self.counters["rejected_queue_full"] += 1
+            raise Overloaded(503, "RAG queue is full", self.retry_after())
+        user_queue = self.waiting.get(user_id)
+        if user_queue is not None and len(user_queue) >= self.max_queued_per_user:
+            self.counters["rejected_user_limit"] += 1
+            raise Overloaded(429, "Too many queued requests for this user", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(user_id, deque()).append(future)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Слот выдан одновременно с таймаутом/отменой - возвращаем его следующему
+                self.release()
+            else:
+                future.cancel()
+                self.remove_waiter(user_id, future)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.counters["timed_out"] += 1
+            raise Overloaded(503, "Timed out waiting in the RAG queue", self.retry_after())
+        return self.admit(started_at)
+
+    def admit(self, started_at: float) -> float:
+        wait = time.monotonic() - started_at
+        self.counters["admitted"] += 1
+        self.queue_waits.append(wait)
+        return wait
+
+    def remove_waiter(self, user_id: Hashable, future):
+        user_queue = self.waiting.get(user_id)
+        if user_queue is not None and future in user_queue:
+            user_queue.remove(future)
+            self.queued -= 1
+            if not user_queue:
+                del self.waiting[user_id]
+
+    def release(self, service_time: float = None):
+        """Освобождает слот и передает его следующему пользователю по кругу."""
+        if service_time is not None:
+            self.service_times.append(service_time)
+        while self.waiting:
+            user_id, user_queue = next(iter(self.waiting.items()))
+            future = user_queue.popleft()
+            self.queued -= 1
+            # Пользователь уходит в конец круга (или из очереди, если запросов больше нет)
+            del self.waiting[user_id]
+            if user_queue:
+                self.waiting[user_id] = user_queue
+            if not future.done():
+                # Слот переходит к ожидающему без уменьшения running
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    @asynccontextmanager
+    async def slot(self, user_id: Hashable):
+        await self.acquire(user_id)
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started_at)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self.queue_waits)
+
+        def percentile(p: float) -> float:
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))], 4) if waits else 0.0
+
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "queued_users": len(self.waiting),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            **self.counters,
+            "queue_wait_s": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "p99": percentile(0.99),
+                "max": round(waits[-1], 4) if waits else 0.0,
+            },
+        }
@@ -0,0 +1,115 @@
+import faiss
+import numpy as np
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+# Порог косинусной близости запросов, при котором ответ берется из кэша
+ANSWER_CACHE_THRESHOLD = 0.95
+ANSWER_CACHE_MAX_ENTRIES = 10_000
+# Сколько ближайших кэшированных запросов проверять при поиске
+ANSWER_CACHE_SEARCH_K = 8
+
+
+class SemanticAnswerCache:
+    """
+    Кэш готовых ответов RAG. Поиск по косинусной близости эмбеддинга запроса
+    (faiss.IndexFlatIP по нормированным векторам); запись подходит, только если
+    совпадают флаг use_tables и набор найденных чанков.
+    Записи привязаны к версии векторных хранилищ и сбрасываются при ее смене;
+    lookup и add с другой версией (запрос, начатый на старом снимке индексов) игнорируются.
+    """
+    def __init__(
+        self,
+        dim: int,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+        search_k: int = ANSWER_CACHE_SEARCH_K,
+        store_version: Optional[str] = None,
+    ):
+        self.dim = dim
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.search_k = search_k
+        self.store_version = store_version
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self._reset()
+
+    def _reset(self):
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+        self.entries: Dict[int, Dict[str, Any]] = {}
+        self.next_id = 0
+
+    @staticmethod
+    def _normalize(query_emb: np.ndarray) -> np.ndarray:
+        query_emb = np.asarray(query_emb, dtype=np.float32).reshape(1, -1)
+        norm = np.linalg.norm(query_emb)
+        return query_emb / norm if norm > 0 else query_emb
+
+    def lookup(
+        self, query_emb, use_tables: bool, chunk_ids: List[Any], store_version: Optional[str] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Возвращает запись {"answer", "source_documents", "similarity"} или None."""
+        with self.lock:
+            if self.index.ntotal and store_version == self.store_version:
+                k = min(self.search_k, self.index.ntotal)
+                scores, ids = self.index.search(self._normalize(query_emb), k)
+                for score, entry_id in zip(scores[0], ids[0]):
+                    if entry_id == -1 or score < self.threshold:
+                        break
+                    entry = self.entries[int(entry_id)]
+                    if entry["use_tables"] == use_tables and entry["chunk_ids"] == frozenset(chunk_ids):
+                        self.hits += 1
+                        return {
+                            "answer": entry["answer"],
+                            "source_documents": entry["source_documents"],
+                            "similarity": float(score),
+                        }
+            self.misses += 1
+            return None
+
+    def add(
+        self,
+        query_emb,
+        use_tables: bool,
+        chunk_ids: List[Any],
+        answer: str,
+        source_documents: list,
+        store_version: Optional[str] = None,
+    ):
+        with self.lock:
+            if store_version != self.store_version:
+                # Ответ собран по снимку, который уже заменен (invalidate прошел во время генерации)
+                return
+            entry_id = self.next_id
+            self.next_id += 1
+            self.index.add_with_ids(self._normalize(query_emb), np.array([entry_id], dtype=np.int64))
+            self.entries[entry_id] = {
+                "use_tables": use_tables,
+                "chunk_ids": frozenset(chunk_ids),
+                "answer": answer,
+                "source_documents": source_documents,
+            }
+            if len(self.entries) > self.max_entries:
+                # Словарь хранит порядок вставки: удаляем самую старую запись
+                oldest_id = next(iter(self.entries))
+                del self.entries[oldest_id]
+                self.index.remove_ids(np.array([oldest_id], dtype=np.int64))
+
+    def invalidate(self, store_version: Optional[str] = None):
+        """Сбрасывает кэш (например, после пересборки векторных хранилищ)."""
+        with self.lock:
+            self.store_version = store_version
+            self._reset()
+
+    def stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "store_version": self.store_version,
+            }
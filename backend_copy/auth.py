@@ -1,3 +1,4 @@
+import os
 from datetime import datetime, timedelta
 from typing import Optional
 
@@ -14,6 +15,8 @@ from schemas import TokenData
 SECRET_KEY = "SECRET_KEY_CHANGEME" 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 600
+# Пользователи с доступом к /admin/* (через запятую)
+ADMIN_USERS = {name.strip() for name in os.getenv("RAG_ADMIN_USERS", "").split(",") if name.strip()}
 
 # --- Хеширование Паролей ---
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
@@ -65,4 +68,10 @@ def get_current_user(
     if user is None:
         raise credentials_exception
         
-    return user
\ No newline at end of file
+    return user
+
+def get_current_admin(current_user: User = Depends(get_current_user)) -> User:
+    """Зависимость для административных эндпоинтов: пользователь из RAG_ADMIN_USERS."""
+    if current_user.username not in ADMIN_USERS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
@@ -0,0 +1,126 @@
+import hashlib
+import re
+from collections import namedtuple
+from typing import Any, Dict, List
+from cache import LRUCache
+from faiss_store import chunk_key
+from llm import SYSTEM_PROMPT, build_prompt
+
+# Бюджет токенов промпта (system prompt + история + контекст + вопрос)
+PROMPT_TOKEN_BUDGET = 3072
+TOKEN_COUNT_CACHE_SIZE = 50_000
+# Служебные токены шаблона чата на одно сообщение (<|im_start|>role\n ... <|im_end|>\n),
+# если их не удалось измерить по шаблону токенизатора
+MESSAGE_OVERHEAD_TOKENS = 5
+CONTEXT_SEPARATOR = "\n\n"
+
+# Границы предложений: после .!?… и пробела, либо перевод строки
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+def message_key(message: str) -> str:
+    return hashlib.sha1(message.encode("utf-8")).hexdigest()
+
+
+PackedPrompt = namedtuple("PackedPrompt", ["history", "context", "documents", "tokens"])
+
+
+class ContextPacker:
+    """
+    Укладывает историю и найденные чанки в бюджет токенов промпта.
+    Чанки важнее истории: сначала отбрасываются самые старые реплики,
+    и только потом чанки обрезаются по границам предложений.
+    Число токенов чанков кэшируется по (версия хранилищ, chunk_key).
+    """
+    def __init__(self, tokenizer, budget=PROMPT_TOKEN_BUDGET, cache_size=TOKEN_COUNT_CACHE_SIZE):
+        self.tokenizer = tokenizer
+        self.budget = budget
+        self.cache = LRUCache(maxsize=cache_size)
+        self.message_overhead = self.measure_message_overhead()
+
+    def measure_message_overhead(self) -> int:
+        try:
+            rendered = self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": "x"}], tokenize=False, add_generation_prompt=False
+            )
+            return max(self.count(rendered) - self.count("x"), 0)
+        except Exception:
+            return MESSAGE_OVERHEAD_TOKENS
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def cached_count(self, key, text: str) -> int:
+        tokens = self.cache.get(key)
+        if tokens is None:
+            tokens = self.count(text)
+            self.cache.put(key, tokens)
+        return tokens
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Начало текста не длиннее max_tokens, по целым предложениям, если это возможно."""
+        if max_tokens <= 0:
+            return ""
+        pieces, used, start = [], 0, 0
+        for match in SENTENCE_BOUNDARY.finditer(text + "\n"):
+            sentence = text[start:match.start()]
+            sentence_tokens = self.count(sentence) + (1 if pieces else 0)
+            if used + sentence_tokens > max_tokens:
+                break
+            pieces.append(text[start:match.end()])
+            used += sentence_tokens
+            start = match.end()
+        if pieces:
+            return "".join(pieces).rstrip()
+        # Первое предложение не помещается целиком - режем по токенам
+        token_ids = self.tokenizer(text, add_special_tokens=False)["input_ids"][:max_tokens]
+        return self.tokenizer.decode(token_ids).rstrip()
+
+    def pack(
+        self,
+        history: List[tuple],
+        question: str,
+        documents: List[Dict[str, Any]],
+        system_prompt: str = SYSTEM_PROMPT,
+        version=None,
+    ) -> PackedPrompt:
+        # Неизменная часть: шаблон, system prompt и вопрос
+        base_tokens = self.count(build_prompt(self.tokenizer, [], question, "", system_prompt))
+        available = self.budget - base_tokens
+        separator_tokens = self.count(CONTEXT_SEPARATOR)
+
+        # 1. Чанки в порядке ранжирования; не поместившийся обрезается, остальные отбрасываются
+        texts, packed_documents = [], []
+        for doc in documents:
+            text = doc["payload"]["text"]
+            needed = self.cached_count((version, chunk_key(doc["payload"])), text) + (separator_tokens if texts else 0)
+            if needed > available:
+                text = self.truncate(text, available - (separator_tokens if texts else 0))
+                if text:
+                    texts.append(text)
+                    packed_documents.append(doc)
+                available = min(available, 0)
+                break
+            texts.append(text)
+            packed_documents.append(doc)
+            available -= needed
+
+        # 2. История: с самых новых реплик, пока хватает бюджета (старые отбрасываются)
+        kept = 0
+        for role, message in reversed(history):
+            needed = self.cached_count(message_key(message), message) + self.message_overhead
+            if needed > available:
+                break
+            available -= needed
+            kept += 1
+        packed_history = list(history[len(history) - kept:])
+        # История начинается с вопроса пользователя, а не с обрывка ответа
+        while packed_history and packed_history[0][0] != "user":
+            _, message = packed_history.pop(0)
+            available += self.cached_count(message_key(message), message) + self.message_overhead
+
+        return PackedPrompt(
+            history=packed_history,
+            context=CONTEXT_SEPARATOR.join(texts),
+            documents=packed_documents,
+            tokens=self.budget - available,
+        )
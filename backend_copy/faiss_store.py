@@ -1,30 +1,274 @@
+import argparse
 import faiss
+import hashlib
+import json
+import math
+import re
+import time
 import numpy as np
-import pickle
+from collections import namedtuple
 from sentence_transformers import SentenceTransformer,CrossEncoder
 from pathlib import Path
+from threading import Lock
+from cache import LRUCache
+from payload_store import PayloadStore
 
 VECTOR_STORE_PATH = Path("vector_store_multilingual_800chunksize_150overlap")
+# Кэш эмбеддингов запросов и оценок cross-encoder (размер, TTL в секундах)
+EMBEDDING_CACHE_SIZE = 4096
+EMBEDDING_CACHE_TTL = 24 * 3600
+RERANK_CACHE_SIZE = 100_000
+RERANK_CACHE_TTL = 24 * 3600
+# Адаптивный rerank: размер микро-батча, порог уверенности cross-encoder,
+# отрыв лидера FAISS (по косинусной близости, не по RRF score), после которого хвост
+# не оценивается, и порог почти-дубликатов
+RERANK_MICRO_BATCH = 5
+RERANK_CONFIDENCE = 0.9
+RERANK_FAISS_MARGIN = 0.05
+DEDUP_JACCARD = 0.9
+# Константа сглаживания reciprocal-rank fusion
+RRF_K = 60
+# Типы индексов: flat - точный поиск (исходный faiss.index), остальные - приближенные
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+# Типы, которые строятся из embeddings.npy; flat не перестраивается, чтобы не затереть исходный faiss.index
+APPROXIMATE_INDEX_TYPES = ("ivf_flat", "hnsw", "ivf_pq")
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+HNSW_M = 32
+PQ_SUBQUANTIZERS = 64
+# Номера удаленных строк индекса (пишет ingest.py); фильтруются при поиске
+TOMBSTONES_FILE = "tombstones.npy"
+
+
+def normalize_query(query):
+    # Только пробелы: e5 и cross-encoder различают регистр, разный регистр - разные ключи кэша
+    return " ".join(query.split())
+
+def chunk_key(payload):
+    """Стабильный идентификатор чанка: id из payload или хэш текста."""
+    chunk_id = payload.get("id")
+    if chunk_id is not None:
+        return chunk_id
+    return hashlib.sha1(payload["text"].encode("utf-8")).hexdigest()
+
+def text_shingles(text, size=3):
+    """Множество словесных n-грамм нормализованного текста (для поиска почти-дубликатов)."""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {tuple(words)}
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def deduplicate_candidates(candidates, threshold=DEDUP_JACCARD):
+    """
+    Убирает одинаковые и почти одинаковые чанки (Jaccard по n-граммам >= threshold).
+    Из группы дубликатов остается первый, т.е. лучший по FAISS.
+    """
+    kept, kept_keys, kept_shingles = [], set(), []
+    for candidate in candidates:
+        key = chunk_key(candidate['payload'])
+        if key in kept_keys:
+            continue
+        shingles = text_shingles(candidate['payload']['text'])
+        if any(
+            len(shingles & other) >= threshold * len(shingles | other)
+            for other in kept_shingles
+        ):
+            continue
+        kept.append(candidate)
+        kept_keys.add(key)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def default_nlist(n_vectors):
+    # ~4*sqrt(N) кластеров, но не меньше 39 точек обучения на кластер
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+def build_index(embeddings, index_type="flat", nlist=None, hnsw_m=HNSW_M, pq_m=PQ_SUBQUANTIZERS):
+    """
+    Строит индекс по эмбеддингам (метрика - скалярное произведение, как у faiss.index).
+    ivf_flat / ivf_pq обучаются на самих эмбеддингах.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Неизвестный тип индекса: {index_type}. Доступны: {INDEX_TYPES}")
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    n_vectors, dim = embeddings.shape
+    metric = faiss.METRIC_INNER_PRODUCT
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, metric)
+    else:
+        nlist = nlist or default_nlist(n_vectors)
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, metric)
+        else:
+            # Число подквантизаторов должно делить размерность
+            while dim % pq_m:
+                pq_m -= 1
+            # Для 8 бит на код нужно >= 256 * 39 точек обучения
+            nbits = max(1, min(8, int(math.log2(max(n_vectors // 39, 2)))))
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, nbits, metric)
+        index.train(embeddings)
+
+    index.add(embeddings)
+    return index
+
+def set_search_params(index, nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH):
+    """nprobe для IVF-индексов и efSearch для HNSW (для flat ничего не меняет)."""
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    except RuntimeError:
+        pass
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+    return index
+
+def search_parameters(index, selector, nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH):
+    """
+    SearchParameters с фильтром selector; параметры поиска переданных
+    SearchParameters заменяют настройки индекса, поэтому nprobe / efSearch дублируются.
+    """
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        return faiss.SearchParametersIVF(sel=selector, nprobe=min(nprobe, ivf.nlist))
+    except RuntimeError:
+        pass
+    if hasattr(index, "hnsw"):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+    return faiss.SearchParameters(sel=selector)
+
+def index_filename(index_type):
+    return "faiss.index" if index_type == "flat" else f"faiss_{index_type}.index"
+
+def index_meta_filename(index_type):
+    # Рядом с построенным индексом - отпечаток embeddings.npy, из которого он построен
+    return f"faiss_{index_type}.meta.json"
+
 
 class FAISSStore:
-    def __init__(self, vector_store_path=VECTOR_STORE_PATH, payloads=None):
+    def __init__(
+        self,
+        vector_store_path=VECTOR_STORE_PATH,
+        payloads=None,
+        index_type="flat",
+        nprobe=DEFAULT_NPROBE,
+        ef_search=DEFAULT_EF_SEARCH,
+    ):
         self.vector_store_path = vector_store_path
         self.index = None
-        self.embeddings = None
-        self.payloads = None
+        self._embeddings = None
+        self.payloads = payloads
         self.ids = None
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.tombstones = np.zeros(0, dtype=np.int64)
+        self.selector = None
+        self.params = None
+
+    @property
+    def embeddings(self):
+        # embeddings.npy нужен только для построения индексов: открываем через mmap по требованию
+        if self._embeddings is None:
+            self._embeddings = np.load(self.vector_store_path / "embeddings.npy", mmap_mode="r")
+        return self._embeddings
+
+    def source_stamp(self):
+        """Размер и mtime embeddings.npy; None, если файла нет."""
+        path = self.vector_store_path / "embeddings.npy"
+        if not path.exists():
+            return None
+        stat = path.stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def build_index(self, **kwargs):
+        """Строит приближенный индекс из embeddings.npy и сохраняет его рядом с отпечатком источника."""
+        if self.index_type not in APPROXIMATE_INDEX_TYPES:
+            raise ValueError(
+                f"Индекс {self.index_type} не строится из embeddings.npy: "
+                f"{index_filename(self.index_type)} - исходный индекс хранилища"
+            )
+        source_stamp = self.source_stamp()
+        index = build_index(self.embeddings, self.index_type, **kwargs)
+        faiss.write_index(index, str(self.vector_store_path / index_filename(self.index_type)))
+        with open(self.vector_store_path / index_meta_filename(self.index_type), "w", encoding="utf-8") as f:
+            json.dump({"source": source_stamp, "ntotal": index.ntotal}, f)
+        return index
+
+    def is_stale(self, index):
+        """Приближенный индекс построен не из текущего embeddings.npy или не совпадает с payloads."""
+        source_stamp = self.source_stamp()
+        if self.index_type == "flat" or source_stamp is None:
+            # faiss.index - исходный индекс хранилища; без embeddings.npy перестроить не из чего
+            return False
+        if index.ntotal != len(self.payloads):
+            return True
+        try:
+            with open(self.vector_store_path / index_meta_filename(self.index_type), encoding="utf-8") as f:
+                return json.load(f).get("source") != source_stamp
+        except (FileNotFoundError, ValueError):
+            return True
 
     def load_embds(self):
         if self.payloads is None:  # fallback для обратной совместимости
-            with open(self.vector_store_path / "payloads.pkl", "rb") as f:
-                self.payloads = pickle.load(f)
-        self.embeddings = np.load(self.vector_store_path / "embeddings.npy")
-        self.index = faiss.read_index(str(self.vector_store_path / "faiss.index"))
+            self.payloads = PayloadStore.load_or_build(self.vector_store_path)
+        index_path = self.vector_store_path / index_filename(self.index_type)
+        if self.index_type not in APPROXIMATE_INDEX_TYPES and not index_path.exists():
+            raise FileNotFoundError(f"Нет исходного индекса хранилища: {index_path}")
+        self.index = faiss.read_index(str(index_path)) if index_path.exists() else None
+        if self.index is not None and self.is_stale(self.index):
+            print(f"Индекс {index_path} устарел относительно embeddings.npy - перестраиваем")
+            self.index = None
+        if self.index is None:
+            # Приближенный индекс еще не построен (или устарел) - строим из embeddings.npy
+            self._embeddings = None
+            self.index = self.build_index()
+        if self.index.ntotal != len(self.payloads):
+            raise RuntimeError(
+                f"Индекс {index_path}: {self.index.ntotal} векторов, а payloads - {len(self.payloads)}"
+            )
+        set_search_params(self.index, nprobe=self.nprobe, ef_search=self.ef_search)
         self.ids = list(range(len(self.payloads)))
+        tombstones_path = self.vector_store_path / TOMBSTONES_FILE
+        if tombstones_path.exists():
+            self.set_tombstones(np.load(tombstones_path))
         return self
 
+    def set_search_params(self, nprobe=None, ef_search=None):
+        self.nprobe = nprobe or self.nprobe
+        self.ef_search = ef_search or self.ef_search
+        set_search_params(self.index, nprobe=self.nprobe, ef_search=self.ef_search)
+        self.set_tombstones(self.tombstones)
+
+    def set_tombstones(self, tombstones):
+        """Удаленные строки исключаются из поиска через IDSelector, индекс не перестраивается."""
+        self.tombstones = np.unique(np.asarray(tombstones, dtype=np.int64))
+        if not len(self.tombstones):
+            self.selector = self.params = None
+            return
+        # SearchParameters не владеет selector - держим ссылку, пока живут params
+        self.selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(self.tombstones))
+        self.params = search_parameters(self.index, self.selector, nprobe=self.nprobe, ef_search=self.ef_search)
+
+    def alive_mask(self):
+        """Булев массив по строкам payloads: строка не удалена."""
+        mask = np.ones(len(self.payloads), dtype=bool)
+        mask[self.tombstones[self.tombstones < len(mask)]] = False
+        return mask
+
+    def search_index(self, query_embs, top_k=3):
+        """index.search без удаленных строк: (scores, rows) формы (Q, top_k)."""
+        if self.params is None:
+            return self.index.search(query_embs, top_k)
+        return self.index.search(query_embs, top_k, params=self.params)
+
     def search(self, query_emb, top_k=3):
-        scores, indices = self.index.search(query_emb[np.newaxis, :], top_k)
+        scores, indices = self.search_index(query_emb[np.newaxis, :], top_k)
         results = []
         score_list = scores[0]
         for rank, idx in enumerate(indices[0]):
@@ -36,20 +280,122 @@ class FAISSStore:
             })
         return scores[0], results
 
+
+def evaluate_index(exact_index, index, queries, top_k=25):
+    """Recall@k относительно точного поиска и средняя задержка на запрос (мс)."""
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    _, exact_ids = exact_index.search(queries, top_k)
+
+    started = time.perf_counter()
+    for query in queries:
+        index.search(query[np.newaxis, :], top_k)
+    latency_ms = (time.perf_counter() - started) * 1000 / len(queries)
+
+    _, ids = index.search(queries, top_k)
+    hits = sum(
+        len(set(found[found != -1]) & set(expected[expected != -1]))
+        for found, expected in zip(ids, exact_ids)
+    )
+    total = sum(len(expected[expected != -1]) for expected in exact_ids)
+    return {"recall": hits / total if total else 1.0, "latency_ms": latency_ms}
+
+def recall_latency_report(
+    vector_store_path,
+    index_types=INDEX_TYPES,
+    nprobes=(1, 4, 16, 64),
+    ef_searches=(16, 64, 256),
+    n_queries=200,
+    top_k=25,
+    seed=0,
+):
+    """
+    Отчет recall vs latency для всех типов индексов на выборке эмбеддингов корпуса
+    (в роли запросов используются зашумленные эмбеддинги чанков).
+    """
+    vector_store_path = Path(vector_store_path)
+    embeddings = np.load(vector_store_path / "embeddings.npy").astype(np.float32)
+    rng = np.random.default_rng(seed)
+    sample = embeddings[rng.choice(len(embeddings), size=min(n_queries, len(embeddings)), replace=False)]
+    queries = sample + rng.normal(scale=0.02, size=sample.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    exact_index = build_index(embeddings, "flat")
+    rows = []
+    for index_type in index_types:
+        index_path = vector_store_path / index_filename(index_type)
+        index = faiss.read_index(str(index_path)) if index_path.exists() else build_index(embeddings, index_type)
+        if index_type in ("ivf_flat", "ivf_pq"):
+            params = [{"nprobe": nprobe} for nprobe in nprobes]
+        elif index_type == "hnsw":
+            params = [{"ef_search": ef} for ef in ef_searches]
+        else:
+            params = [{}]
+        for param in params:
+            set_search_params(index, **param)
+            rows.append({"index_type": index_type, **param, **evaluate_index(exact_index, index, queries, top_k)})
+    return rows
+
+
+class CachedEncoder:
+    """
+    Обертка над SentenceTransformer с LRU/TTL-кэшем эмбеддингов по тексту со схлопнутыми пробелами.
+    Промахи кодируются одним батчем.
+    """
+    def __init__(self, model, cache_size=EMBEDDING_CACHE_SIZE, cache_ttl=EMBEDDING_CACHE_TTL):
+        self.model = model
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+
+    def encode(self, sentences, **kwargs):
+        if kwargs:
+            return self.model.encode(sentences, **kwargs)
+
+        keys = [normalize_query(s) for s in sentences]
+        embeddings = [self.cache.get(key) for key in keys]
+        missing = [i for i, emb in enumerate(embeddings) if emb is None]
+        if missing:
+            new_embeddings = self.model.encode([sentences[i] for i in missing])
+            for i, emb in zip(missing, new_embeddings):
+                self.cache.put(keys[i], emb)
+                embeddings[i] = emb
+        return np.stack(embeddings)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
 class Reranker:
-    def __init__(self, model_path):
-        self.model = CrossEncoder(model_path, local_files_only=True)
+    def __init__(self, model_path, cache_size=RERANK_CACHE_SIZE, cache_ttl=RERANK_CACHE_TTL, model=None):
+        # model - готовая модель с методом predict (например, OnnxCrossEncoder)
+        self.model = model if model is not None else CrossEncoder(model_path, local_files_only=True)
+        # Кэш оценок по (версия хранилищ, нормализованный запрос, id чанка)
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        # Счетчики адаптивного режима: сколько пар cross-encoder удалось не оценивать
+        self.lock = Lock()
+        self.counters = {"calls": 0, "candidates": 0, "duplicates": 0, "scored": 0, "early_exits": 0}
+
+    def score(self, query, candidates, version=None):
+        """
+        Оценки cross-encoder для кандидатов; уже посчитанные пары берутся из кэша.
+        version - версия хранилищ: после переиндексации тот же id может указывать на другой текст.
+        """
+        query_key = normalize_query(query)
+        keys = [(version, query_key, chunk_key(c['payload'])) for c in candidates]
+        scores = [self.cache.get(key) for key in keys]
+        missing = [i for i, s in enumerate(scores) if s is None]
+        if missing:
+            pairs = [(query, candidates[i]['payload']['text']) for i in missing]
+            for i, s in zip(missing, self.model.predict(pairs)):
+                s = float(s)
+                self.cache.put(keys[i], s)
+                scores[i] = s
+        return scores
 
-    def rerank(self, query, candidates, top_n=3):
+    def rerank(self, query, candidates, top_n=3, version=None):
         if not candidates:
-            return [], [], []
-        pairs = []
-        original_indices = []
-        for i, c in enumerate(candidates):
-            pairs.append((query, c['payload']['text']))
-            original_indices.append(i)
-
-        scores = self.model.predict(pairs)
+            return [], []
+        original_indices = list(range(len(candidates)))
+
+        scores = self.score(query, candidates, version)
         scored = sorted(
             zip(scores, candidates, original_indices),
             key=lambda x: x[0],
@@ -60,11 +406,219 @@ class Reranker:
 
         return top_candidates, top_scores
 
+    def rerank_adaptive(
+        self,
+        query,
+        candidates,
+        top_n=3,
+        micro_batch=RERANK_MICRO_BATCH,
+        confidence=RERANK_CONFIDENCE,
+        faiss_margin=RERANK_FAISS_MARGIN,
+        dedup_threshold=DEDUP_JACCARD,
+        version=None,
+    ):
+        """
+        Rerank кандидатов в порядке поиска микро-батчами с ранним выходом.
+        Почти-дубликаты убираются до оценки. Оценка прекращается, когда top_n лучших
+        оценок не ниже confidence или когда оставшиеся кандидаты отстают от лидера
+        FAISS больше чем на faiss_margin. Отрыв считается по косинусной близости FAISS:
+        faiss_score кандидата, а без него - score (у кандидатов поиска это и есть FAISS).
+        Кандидаты слияния с faiss_score=None (оценка неизвестна) ранний выход по отрыву отключают.
+        """
+        unique = deduplicate_candidates(candidates, dedup_threshold)
+        faiss_scores = [c.get("faiss_score", c['score']) for c in unique]
+        scored, early_exit = [], False
+        # Первый батч не меньше top_n, чтобы было из чего выбирать
+        end = min(max(micro_batch, top_n), len(unique))
+        start = 0
+        while start < len(unique):
+            batch = unique[start:end]
+            scored.extend(zip(self.score(query, batch, version), batch))
+            start, end = end, end + micro_batch
+            if start >= len(unique) or len(scored) < top_n:
+                continue
+            top_scores = sorted((s for s, _ in scored), reverse=True)
+            if top_scores[top_n - 1] >= confidence or self.faiss_gap(faiss_scores, start) > faiss_margin:
+                early_exit = True
+                break
+
+        with self.lock:
+            self.counters["calls"] += 1
+            self.counters["candidates"] += len(candidates)
+            self.counters["duplicates"] += len(candidates) - len(unique)
+            self.counters["scored"] += len(scored)
+            self.counters["early_exits"] += early_exit
+
+        # Стабильная сортировка: при равных оценках сохраняется порядок FAISS
+        scored.sort(key=lambda x: x[0], reverse=True)
+        return [c for _, c in scored[:top_n]], [s for s, _ in scored[:top_n]]
+
+    @staticmethod
+    def faiss_gap(faiss_scores, start):
+        """Отставание лучшего из оставшихся кандидатов (с позиции start) от лидера FAISS."""
+        if any(score is None for score in faiss_scores):
+            return float("-inf")
+        return max(faiss_scores) - max(faiss_scores[start:])
+
+    def pruning_stats(self):
+        """Отчет адаптивного режима: сколько пар (запрос, чанк) не ушло в cross-encoder."""
+        with self.lock:
+            counters = dict(self.counters)
+        saved = counters["candidates"] - counters["scored"]
+        counters["pairs_saved"] = saved
+        counters["saved_rate"] = saved / counters["candidates"] if counters["candidates"] else 0.0
+        return counters
+
 
 # faiss_store.py
 
 # ... (импорты и классы FAISSStore, Reranker остаются без изменений) ...
 
+# Результат поиска до материализации payload: номер хранилища, строка в нем, score
+SearchHit = namedtuple("SearchHit", ["store_id", "row_id", "score"])
+
+
+def top_k_columns(scores, limit):
+    """
+    Номера столбцов top-k по убыванию score в каждой строке через argpartition.
+    При равных score порядок такой же, как у стабильного argsort по -score.
+    """
+    if limit >= scores.shape[1]:
+        return np.argsort(-scores, axis=1, kind="stable")
+    kth = -np.partition(-scores, limit - 1, axis=1)[:, limit - 1:limit]
+    above = scores > kth
+    # Из равных k-му значению берутся самые левые, сколько осталось мест
+    tied = scores == kth
+    keep = above | (tied & (np.cumsum(tied, axis=1) <= limit - above.sum(axis=1, keepdims=True)))
+    columns = np.nonzero(keep)[1].reshape(len(scores), limit)
+    order = np.argsort(-np.take_along_axis(scores, columns, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(columns, order, axis=1)
+
+
+class MultiStore:
+    """
+    Несколько FAISSStore как одна коллекция. Пакет запросов ищется одним вызовом
+    на каждый индекс, результаты сливаются в общий top-k на numpy-массивах,
+    а payload достается только для итоговых SearchHit.
+    """
+    def __init__(self):
+        self.names = []
+        self.stores = []
+        # Тип документа, проставляемый payload при материализации (например, "table")
+        self.payload_types = []
+
+    def add_store(self, name, store, payload_type=None):
+        if store is not None:
+            self.names.append(name)
+            self.stores.append(store)
+            self.payload_types.append(payload_type)
+        return self
+
+    def search_batch(self, query_embs, top_k=3, store_names=None):
+        """
+        query_embs: (Q, d). Возвращает по списку SearchHit на запрос,
+        отсортированному по убыванию score (при равенстве - порядок хранилищ).
+        """
+        query_embs = np.ascontiguousarray(np.atleast_2d(query_embs), dtype=np.float32)
+        selected = [
+            store_id for store_id, name in enumerate(self.names)
+            if store_names is None or name in store_names
+        ]
+        if not selected:
+            return [[] for _ in range(len(query_embs))]
+
+        all_scores, all_rows, all_stores = [], [], []
+        for store_id in selected:
+            scores, rows = self.stores[store_id].search_index(query_embs, top_k)
+            all_scores.append(scores)
+            all_rows.append(rows)
+            all_stores.append(np.full(rows.shape, store_id, dtype=np.int64))
+
+        scores = np.concatenate(all_scores, axis=1)
+        rows = np.concatenate(all_rows, axis=1)
+        store_ids = np.concatenate(all_stores, axis=1)
+        scores = np.where(rows == -1, -np.inf, scores)
+
+        order = top_k_columns(scores, top_k)
+        top_scores = np.take_along_axis(scores, order, axis=1)
+        top_rows = np.take_along_axis(rows, order, axis=1)
+        top_stores = np.take_along_axis(store_ids, order, axis=1)
+
+        return [
+            [
+                SearchHit(int(store_id), int(row_id), float(score))
+                for store_id, row_id, score in zip(query_stores, query_rows, query_scores)
+                if row_id != -1
+            ]
+            for query_stores, query_rows, query_scores in zip(top_stores, top_rows, top_scores)
+        ]
+
+    def search(self, query_emb, top_k=3, store_names=None):
+        return self.search_batch(query_emb[np.newaxis, :], top_k=top_k, store_names=store_names)[0]
+
+    def materialize(self, hits):
+        """SearchHit -> {"payload", "score"} в формате FAISSStore.search."""
+        results = []
+        for hit in hits:
+            payload = self.stores[hit.store_id].payloads[hit.row_id]
+            payload_type = self.payload_types[hit.store_id]
+            if payload_type is not None:
+                payload = {**payload, "type": payload_type}
+            results.append({"payload": payload, "score": hit.score})
+        return results
+
+
+def search_candidates(query, multi_store, emb_model, top_faiss=25, store_names=None):
+    """Кандидаты FAISS по всем выбранным хранилищам (без rerank), в порядке score."""
+    query_emb = emb_model.encode([query])[0]
+    hits = multi_store.search(query_emb, top_k=top_faiss, store_names=store_names)
+    return multi_store.materialize(hits)
+
+
+def reciprocal_rank_fusion(ranked_lists, k=RRF_K, limit=None):
+    """
+    Слияние нескольких ранжированных списков кандидатов: score = sum(1 / (k + rank)).
+    Дубликаты сводятся по chunk_key; payload берется из первого списка, где встретился чанк.
+    faiss_score кандидатов (если задан) переносится в результат - максимум по спискам.
+    """
+    fused = {}
+    for candidates in ranked_lists:
+        for rank, candidate in enumerate(candidates, start=1):
+            key = chunk_key(candidate['payload'])
+            faiss_score = candidate.get("faiss_score")
+            entry = fused.get(key)
+            if entry is None:
+                fused[key] = {"payload": candidate['payload'], "score": 1.0 / (k + rank), "faiss_score": faiss_score}
+            else:
+                entry["score"] += 1.0 / (k + rank)
+                if faiss_score is not None and (entry["faiss_score"] is None or faiss_score > entry["faiss_score"]):
+                    entry["faiss_score"] = faiss_score
+    # Стабильная сортировка: при равных score - порядок первого появления
+    return sorted(fused.values(), key=lambda c: c["score"], reverse=True)[:limit]
+
+
+def get_context_multi(
+    query,
+    multi_store,
+    emb_model,
+    reranker,
+    top_faiss=25,
+    top_final=3,
+    store_names=None,
+    adaptive=False,
+):
+    """Поиск по нескольким хранилищам MultiStore + Rerank (adaptive - с ранним выходом)."""
+    # 1. Поиск по всем выбранным индексам и слияние в общий top_faiss
+    candidates = search_candidates(query, multi_store, emb_model, top_faiss=top_faiss, store_names=store_names)
+
+    # 2. Rerank (payload достаются только для слитого top_faiss)
+    rerank = reranker.rerank_adaptive if adaptive else reranker.rerank
+    final_results, _ = rerank(query, candidates, top_n=top_final)
+
+    context = "\n\n".join(doc['payload']['text'] for doc in final_results)
+
+    return context, final_results
+
 def get_context_hybrid(
     query, 
     store_text, 
@@ -76,34 +630,37 @@ def get_context_hybrid(
     use_tables=False # <--- Флаг для включения таблиц
 ):
     """Гибридный поиск, объединяющий результаты из текстового и табличного индексов."""
-    
-    query_emb = emb_model.encode([query])[0]
-    all_faiss_results = []
-    
-    # 1. Поиск в текстовом хранилище (всегда включено)
-    # Поиск в текстовом хранилище (text_store)
-    # Мы ищем с запасом (top_faiss * 2), так как у нас два источника
-    _,text_results = store_text.search(query_emb, top_k=top_faiss) 
-    all_faiss_results.extend(text_results)
-    
-    # 2. Поиск в табличном хранилище (только если флаг включен)
-    if use_tables and store_tables is not None:
-        _,table_results = store_tables.search(query_emb, top_k=top_faiss)
-        
-        # Добавляем тип документа, чтобы reranker видел откуда пришел документ
-        for doc in table_results:
-             doc['payload']['type'] = 'table'
-        
-        all_faiss_results.extend(table_results)
-    all_faiss_results = sorted(all_faiss_results, key=lambda x: x['score'], reverse=True)
-    
-    # 3. Rerank
-    final_results, _ = reranker.rerank(
-        query, all_faiss_results[:top_faiss], top_n=top_final
+    multi_store = MultiStore().add_store("text", store_text)
+    if use_tables:
+        # Тип документа нужен, чтобы reranker и фронтенд видели, откуда пришел документ
+        multi_store.add_store("table", store_tables, payload_type="table")
+
+    return get_context_multi(
+        query, multi_store, emb_model, reranker, top_faiss=top_faiss, top_final=top_final
     )
-    
-    context = "\n\n".join(doc['payload']['text'] for doc in final_results)
-    
-    return context, final_results
 
-# Переименуй старую функцию get_context, если она еще где-то используется, или удали ее.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Построение FAISS-индексов и отчет recall/latency")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="построить индекс из embeddings.npy")
+    build_parser.add_argument("store", type=Path, help="каталог хранилища (data/vector_store_text)")
+    build_parser.add_argument("--type", choices=APPROXIMATE_INDEX_TYPES, required=True)
+    build_parser.add_argument("--nlist", type=int, default=None)
+
+    report_parser = subparsers.add_parser("report", help="recall vs latency относительно точного поиска")
+    report_parser.add_argument("store", type=Path)
+    report_parser.add_argument("--top-k", type=int, default=25)
+    report_parser.add_argument("--queries", type=int, default=200)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        kwargs = {"nlist": args.nlist} if args.type in ("ivf_flat", "ivf_pq") else {}
+        index = FAISSStore(args.store, index_type=args.type).build_index(**kwargs)
+        print(f"{args.type}: {index.ntotal} векторов -> {args.store / index_filename(args.type)}")
+    else:
+        print(f"{'index':<10} {'param':<16} {'recall@' + str(args.top_k):>10} {'ms/query':>10}")
+        for row in recall_latency_report(args.store, n_queries=args.queries, top_k=args.top_k):
+            param = ", ".join(f"{k}={row[k]}" for k in ("nprobe", "ef_search") if k in row) or "-"
+            print(f"{row['index_type']:<10} {param:<16} {row['recall']:>10.3f} {row['latency_ms']:>10.3f}")
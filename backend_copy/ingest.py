@@ -0,0 +1,307 @@
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import faiss
+import numpy as np
+
+from BM25 import extend_searcher
+from faiss_store import TOMBSTONES_FILE, index_filename
+from payload_store import PayloadStore, ConcatPayloads
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+RAW_DIR = Path("data/raw")
+INGEST_STORE_PATH = Path("data/vector_store_ingest")
+# Хранилища, собранные офлайн: их строки удаленных файлов помечаются tombstones
+BASE_STORE_PATHS = {
+    "text": Path("data/vector_store_text"),
+    "table": Path("data/vector_store_table"),
+}
+LEXICAL_INDEX_PATH = Path("data/lexical_index")
+EMB_MODEL = "models/multilingual-e5-large"
+
+CHUNK_SIZE = 800
+CHUNK_OVERLAP = 150
+EMBED_BATCH_SIZE = 32
+LEXICAL_N_GRAM_SIZE = 3
+MANIFEST_FILE = "manifest.json"
+SEGMENTS_DIR = "segments"
+RAW_SUFFIXES = (".txt", ".md", ".pdf")
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def ingest_chunk_id(row: int) -> str:
+    # Отдельное пространство id: числовые id офлайн-хранилищ не совпадут с id новых чанков
+    # (по id сводятся дубликаты в RRF и кэшируются оценки reranker и длины чанков)
+    return f"ingest:{row}"
+
+
+def read_document(path: Path) -> str:
+    if path.suffix.lower() == ".pdf":
+        if PdfReader is None:
+            raise RuntimeError(f"Для {path.name} нужен пакет pypdf")
+        return "\n".join(page.extract_text() or "" for page in PdfReader(str(path)).pages)
+    return path.read_text(encoding="utf-8", errors="replace")
+
+
+def chunk_text(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """Чанки по size символов с перекрытием overlap; граница сдвигается на ближайший пробел."""
+    text = text.strip()
+    chunks, start = [], 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            space = text.rfind(" ", start + overlap + 1, end)
+            if space != -1:
+                end = space
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return chunks
+
+
+def write_atomic(path: Path, write):
+    """write(tmp_path), затем rename: читатели видят либо старый, либо новый файл."""
+    tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(store_path: Path) -> Dict[str, Any]:
+    try:
+        with open(store_path / MANIFEST_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"files": None, "chunk_rows": {}, "rows": 0, "segments": 0}
+
+
+def save_manifest(store_path: Path, manifest: Dict[str, Any]):
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+    write_atomic(store_path / MANIFEST_FILE, write)
+
+
+def segment_paths(store_path: Path) -> List[Path]:
+    segments_path = Path(store_path) / SEGMENTS_DIR
+    if not segments_path.exists():
+        return []
+    return sorted(p for p in segments_path.iterdir() if p.is_dir() and ".tmp" not in p.name)
+
+
+def load_ingest_payloads(store_path: Path = INGEST_STORE_PATH) -> Optional[ConcatPayloads]:
+    """Payloads хранилища инкрементной индексации (сегменты подряд, строка = id в FAISS)."""
+    paths = segment_paths(store_path)
+    return ConcatPayloads([PayloadStore(path) for path in paths]) if paths else None
+
+
+def load_base_payloads(base_store_paths: Dict[str, Path]) -> Dict[str, PayloadStore]:
+    stores = {}
+    for name, path in base_store_paths.items():
+        try:
+            stores[name] = PayloadStore.load_or_build(path, default_type="table" if name == "table" else None)
+        except FileNotFoundError:
+            pass
+    return stores
+
+
+def source_rows(store: PayloadStore, filename: str) -> np.ndarray:
+    """Строки хранилища, чей source указывает на файл filename."""
+    sources = store.columns["source"]
+    return np.asarray(
+        [i for i in range(len(store)) if Path(sources[i].replace("\\", "/")).name == filename],
+        dtype=np.int64,
+    )
+
+
+def append_tombstones(store_path: Path, rows) -> int:
+    path = Path(store_path) / TOMBSTONES_FILE
+    old = np.load(path) if path.exists() else np.zeros(0, dtype=np.int64)
+    tombstones = np.union1d(old, np.asarray(rows, dtype=np.int64))
+    if len(tombstones) != len(old):
+        def write(tmp_path):
+            # np.save с путем дописал бы к tmp-имени суффикс .npy
+            with open(tmp_path, "wb") as f:
+                np.save(f, tombstones)
+        write_atomic(path, write)
+    return len(tombstones) - len(old)
+
+
+def load_encoder(model_path: str = EMB_MODEL):
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_path, local_files_only=True)
+
+
+def ingest(
+    raw_dir: Path = RAW_DIR,
+    store_path: Path = INGEST_STORE_PATH,
+    encoder=None,
+    model_path: str = EMB_MODEL,
+    base_store_paths: Dict[str, Path] = BASE_STORE_PATHS,
+    lexical_index_path: Optional[Path] = LEXICAL_INDEX_PATH,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+) -> Dict[str, Any]:
+    """
+    Индексирует новые и измененные файлы raw_dir в отдельное хранилище store_path:
+    FAISS IndexIDMap2 (add_with_ids) + сегмент payloads + доиндексация лексического индекса.
+    Строки удаленных и измененных файлов (в том числе в офлайн-хранилищах) помечаются tombstones.
+    Эмбеддинги считаются только для чанков, которых еще нет в индексе (по хэшу текста).
+    encoder - модель с encode(); если не передана, загружается из model_path, только когда есть что кодировать.
+    """
+    raw_dir, store_path = Path(raw_dir), Path(store_path)
+    store_path.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(store_path)
+    base_stores = load_base_payloads(base_store_paths)
+    report = {"added_files": [], "changed_files": [], "deleted_files": [], "new_chunks": 0,
+              "reused_chunks": 0, "encoded_chunks": 0, "tombstoned_rows": 0}
+
+    current = {
+        path.name: file_sha256(path)
+        for path in sorted(raw_dir.iterdir())
+        if path.is_file() and path.suffix.lower() in RAW_SUFFIXES
+    } if raw_dir.exists() else {}
+
+    # Первый запуск: файлы, уже попавшие в офлайн-хранилища, не индексируются заново
+    if manifest["files"] is None:
+        base_sources = {
+            Path(source.replace("\\", "/")).name
+            for store in base_stores.values()
+            for source in set(store.columns["source"][i] for i in range(len(store)))
+        }
+        manifest["files"] = {
+            name: {"sha256": sha, "rows": [], "baseline": True}
+            for name, sha in current.items() if name in base_sources
+        }
+
+    files = manifest["files"]
+    stale = [name for name, entry in files.items() if current.get(name) != entry["sha256"]]
+    to_index = [name for name, sha in current.items() if name not in files or name in stale]
+    for name in stale:
+        report["changed_files" if name in current else "deleted_files"].append(name)
+    report["added_files"] = [name for name in to_index if name not in files]
+
+    # 1. Tombstones для строк устаревших версий файлов
+    index_path = store_path / index_filename("flat")
+    ingest_tombstones = []
+    for name in stale:
+        entry = files.pop(name)
+        if entry.get("baseline"):
+            for store_name, store in base_stores.items():
+                report["tombstoned_rows"] += append_tombstones(base_store_paths[store_name], source_rows(store, name))
+        else:
+            ingest_tombstones.extend(entry["rows"])
+    if ingest_tombstones:
+        report["tombstoned_rows"] += append_tombstones(store_path, ingest_tombstones)
+
+    # 2. Чанки новых версий файлов
+    payloads, hashes = [], []
+    for name in to_index:
+        try:
+            chunks = chunk_text(read_document(raw_dir / name), chunk_size, chunk_overlap)
+        except Exception as e:
+            print(f"Не удалось прочитать {name}: {e}")
+            continue
+        first_row = manifest["rows"] + len(payloads)
+        for text in chunks:
+            row = manifest["rows"] + len(payloads)
+            payloads.append({"text": text, "source": name, "type": "text", "id": ingest_chunk_id(row)})
+            hashes.append(chunk_hash(text))
+        files[name] = {
+            "sha256": current[name],
+            "rows": list(range(first_row, manifest["rows"] + len(payloads))),
+            "baseline": False,
+        }
+    report["new_chunks"] = len(payloads)
+
+    if payloads:
+        index = faiss.read_index(str(index_path)) if index_path.exists() else None
+        chunk_rows = manifest["chunk_rows"]
+        vectors: Dict[str, np.ndarray] = {}
+        # Векторы уже проиндексированных чанков (в том числе удаленных) берутся из индекса
+        for h in set(hashes):
+            if h in chunk_rows and index is not None:
+                vectors[h] = index.reconstruct(int(chunk_rows[h]))
+        report["reused_chunks"] = sum(h in vectors for h in hashes)
+
+        missing = {}
+        for payload, h in zip(payloads, hashes):
+            if h not in vectors:
+                missing.setdefault(h, payload["text"])
+        if missing:
+            encoder = encoder or load_encoder(model_path)
+            embeddings = np.asarray(
+                encoder.encode(list(missing.values()), batch_size=EMBED_BATCH_SIZE), dtype=np.float32
+            )
+            vectors.update(zip(missing.keys(), embeddings))
+        report["encoded_chunks"] = len(missing)
+
+        embeddings = np.ascontiguousarray(np.stack([vectors[h] for h in hashes]), dtype=np.float32)
+        ids = np.arange(manifest["rows"], manifest["rows"] + len(payloads), dtype=np.int64)
+        if index is None:
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(embeddings.shape[1]))
+        index.add_with_ids(embeddings, ids)
+        for h, row in zip(hashes, ids):
+            chunk_rows.setdefault(h, int(row))
+
+        # 3. Сегмент payloads, затем индекс: строки сегментов идут подряд и совпадают с id
+        old_documents = lexical_corpus(base_stores, store_path)
+        manifest["segments"] += 1
+        PayloadStore.build(payloads, store_path / SEGMENTS_DIR / f"{manifest['segments']:06d}")
+        write_atomic(index_path, lambda tmp_path: faiss.write_index(index, str(tmp_path)))
+        manifest["rows"] += len(payloads)
+
+        # 4. Лексический индекс: старый корпус - префикс нового, постинги дописываются
+        if lexical_index_path is not None:
+            extend_searcher(
+                old_documents, lexical_corpus(base_stores, store_path),
+                lexical_index_path, n_gram_size=LEXICAL_N_GRAM_SIZE,
+            )
+
+    save_manifest(store_path, manifest)
+    return report
+
+
+def lexical_corpus(base_stores: Dict[str, PayloadStore], store_path: Path):
+    """Тексты в порядке all_payloads сервера: текст, таблицы, сегменты инкрементной индексации."""
+    return ConcatPayloads(
+        [base_stores.get("text"), base_stores.get("table"), load_ingest_payloads(store_path)]
+    ).texts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Инкрементная индексация файлов data/raw")
+    parser.add_argument("--raw-dir", type=Path, default=RAW_DIR)
+    parser.add_argument("--store", type=Path, default=INGEST_STORE_PATH)
+    parser.add_argument("--model", default=EMB_MODEL)
+    parser.add_argument("--no-lexical", action="store_true", help="не обновлять лексический индекс")
+    args = parser.parse_args()
+
+    report = ingest(
+        args.raw_dir,
+        args.store,
+        model_path=args.model,
+        lexical_index_path=None if args.no_lexical else LEXICAL_INDEX_PATH,
+    )
+    print(json.dumps(report, ensure_ascii=False, indent=2))
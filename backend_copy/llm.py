@@ -1,7 +1,37 @@
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
+import argparse
+import copy
+import hashlib
+import queue
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from concurrent.futures import Future
+from multiprocessing import get_context
+from threading import Event, Lock, Thread
+from typing import Any, Iterator, List, Optional, Tuple
+from transformers import (
+    AutoTokenizer, AutoModelForCausalLM, GenerationConfig, TextIteratorStreamer,
+    StoppingCriteria, StoppingCriteriaList, LogitsProcessor, LogitsProcessorList,
+)
 
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+# Вариант загрузки модели: fp32 (как есть), bf16 (если поддерживается) или int8 (динамическое
+# квантование Linear, только CPU); число токенов прогрева после torch.compile
+LLM_BACKENDS = ("fp32", "bf16", "int8")
+WARMUP_NEW_TOKENS = 8
+MAX_NEW_TOKENS = 1000
+# Параметры динамического батчинга: размер батча и время ожидания попутных запросов
+GENERATION_MAX_BATCH_SIZE = 8
+GENERATION_MAX_WAIT_SECONDS = 0.02
+# Бюджет памяти под KV-кэш префиксов (system prompt + история) по чатам
+PREFIX_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# Минимальная длина общего префикса (в токенах), при которой кэш имеет смысл переиспользовать
+PREFIX_CACHE_MIN_TOKENS = 16
+# Ускоренное (спекулятивное) декодирование: по n-граммам промпта или с черновой моделью
+ASSISTED_MODES = ("prompt_lookup", "draft")
+PROMPT_LOOKUP_TOKENS = 10
 SYSTEM_PROMPT = (
     "<system\n"
     "Ты технолог-консультант на производстве АО СПЛАВ, ты консультируешь работников на производстве.\n"
@@ -11,21 +41,185 @@ SYSTEM_PROMPT = (
     ">\nuser\n"
 )
 
-def load_llm(model_path: str):
+def bf16_supported() -> bool:
+    if DEVICE == "cuda":
+        return torch.cuda.is_bf16_supported()
+    # На CPU bf16 быстрее fp32 только при аппаратной поддержке (AVX512-BF16 / AMX)
+    return torch.cpu._is_avx512_bf16_supported() or torch.cpu._is_amx_tile_supported()
+
+def set_num_threads(num_threads: Optional[int]):
+    """Число потоков intra-op для torch (None - значение по умолчанию)."""
+    if not num_threads:
+        return
+    torch.set_num_threads(num_threads)
+    try:
+        # Межоператорный параллелизм при генерации не нужен; задается до первой операции
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+def load_llm(model_path: str, backend: str = "fp32", compile: bool = False, num_threads: Optional[int] = None):
+    if backend not in LLM_BACKENDS:
+        raise ValueError(f"Неизвестный backend LLM: {backend}")
+    if backend == "bf16" and not bf16_supported():
+        print("bf16 не поддерживается на этом устройстве, используется fp32")
+        backend = "fp32"
+    if backend == "int8" and DEVICE != "cpu":
+        print("int8 динамическое квантование доступно только на CPU, используется fp32")
+        backend = "fp32"
+
+    set_num_threads(num_threads)
     tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True, local_files_only=True)
-    model = AutoModelForCausalLM.from_pretrained(model_path, trust_remote_code=True, local_files_only=True)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_path,
+        trust_remote_code=True,
+        local_files_only=True,
+        dtype=torch.bfloat16 if backend == "bf16" else torch.float32,
+    )
     model.to(DEVICE)
     model.eval()
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if compile:
+        compile_llm(tokenizer, model)
     return tokenizer, model
-def generate_answer(
-        tokenizer,
-        model,
-        history: list,
-        question: str,
-        context: str,
-        system_prompt: str = SYSTEM_PROMPT
-    ) -> str:
 
+def warmup_llm(tokenizer, model, max_new_tokens: int = WARMUP_NEW_TOKENS):
+    inputs = tokenizer("Прогрев модели", return_tensors="pt").to(DEVICE)
+    with torch.no_grad():
+        model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+        )
+
+def compile_llm(tokenizer, model):
+    """
+    torch.compile для forward модели с прогревом при запуске, чтобы компиляция
+    не приходилась на первый запрос. При ошибке компиляции остается eager-режим.
+    """
+    eager_forward = model.forward
+    model.forward = torch.compile(eager_forward, dynamic=True)
+    started = time.perf_counter()
+    try:
+        warmup_llm(tokenizer, model)
+    except Exception as e:
+        print(f"torch.compile не удался ({e}), используется eager-режим")
+        model.forward = eager_forward
+        return model
+    print(f"torch.compile: прогрев за {time.perf_counter() - started:.1f} с")
+    return model
+
+def strip_think(decoded: str) -> str:
+    return decoded.split("</think>", 1)[-1].strip()
+
+def cut_at_stop(text: str, stop_sequences: List[str]) -> str:
+    """Текст до первой из стоп-последовательностей."""
+    for stop in stop_sequences:
+        text = text.split(stop, 1)[0]
+    return text
+
+
+class GenerationOptions:
+    """
+    Параметры генерации одного запроса: лимит токенов, режим размышлений
+    (enable_thinking - через шаблон чата, max_thinking_tokens - ограничение блока <think>,
+    0 или None - без лимита),
+    стоп-последовательности и ускоренное декодирование (assisted: prompt_lookup или draft).
+    """
+    def __init__(
+        self,
+        max_new_tokens: int = MAX_NEW_TOKENS,
+        enable_thinking: bool = True,
+        max_thinking_tokens: Optional[int] = None,
+        stop_sequences: Optional[List[str]] = None,
+        assisted: Optional[str] = None,
+    ):
+        if assisted is not None and assisted not in ASSISTED_MODES:
+            raise ValueError(f"Неизвестный режим ускоренного декодирования: {assisted}")
+        self.max_new_tokens = max_new_tokens
+        self.enable_thinking = enable_thinking
+        # 0 - без лимита, как и RAG_MAX_THINKING_TOKENS
+        self.max_thinking_tokens = max_thinking_tokens or None
+        self.stop_sequences = [stop for stop in stop_sequences or [] if stop]
+        self.assisted = assisted
+
+class StopSequenceFilter:
+    """
+    Потоково обрезает ответ на первой стоп-последовательности.
+    Хвост, который может оказаться началом стоп-последовательности, придерживается.
+    """
+    def __init__(self, stop_sequences: List[str]):
+        self.stop_sequences = [stop for stop in stop_sequences if stop]
+        self.buffer = ""
+        self.stopped = False
+
+    def feed(self, text: str) -> str:
+        if self.stopped:
+            return ""
+        self.buffer += text
+        cut = cut_at_stop(self.buffer, self.stop_sequences)
+        if len(cut) < len(self.buffer):
+            self.stopped = True
+            self.buffer = ""
+            return cut
+        keep = max(
+            (k for stop in self.stop_sequences for k in range(1, len(stop)) if self.buffer.endswith(stop[:k])),
+            default=0,
+        )
+        text, self.buffer = self.buffer[:len(self.buffer) - keep], self.buffer[len(self.buffer) - keep:]
+        return text
+
+    def flush(self) -> str:
+        text, self.buffer = self.buffer, ""
+        return "" if self.stopped else text
+
+class ThinkFilter:
+    """
+    Потоково вырезает блок <think>...</think> из начала ответа модели.
+    Пока блок не закрыт, текст буферизуется; после </think> текст отдается как есть.
+    """
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self.buffer = ""
+        self.passthrough = False
+        self.started = False
+
+    def feed(self, text: str) -> str:
+        if self.passthrough:
+            return self._emit(text)
+
+        self.buffer += text
+        head = self.buffer.lstrip()
+        if head and not head.startswith(self.OPEN_TAG) and not self.OPEN_TAG.startswith(head):
+            # Модель ответила без блока размышлений
+            self.passthrough = True
+            text, self.buffer = self.buffer, ""
+            return self._emit(text)
+
+        if self.CLOSE_TAG in self.buffer:
+            self.passthrough = True
+            text = self.buffer.split(self.CLOSE_TAG, 1)[-1]
+            self.buffer = ""
+            return self._emit(text)
+        return ""
+
+    def flush(self) -> str:
+        # Блок </think> так и не встретился - отдаем все, что накопили
+        text, self.buffer = self.buffer, ""
+        return self._emit(text)
+
+    def _emit(self, text: str) -> str:
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return text
+
+
+def build_history_messages(history: list, system_prompt: str = SYSTEM_PROMPT) -> list:
     chat_messages = []
 
     # SYSTEM
@@ -37,6 +231,26 @@ def generate_answer(
             chat_messages.append({"role": "user", "content": msg})
         else:
             chat_messages.append({"role": "assistant", "content": msg})
+    return chat_messages
+
+def build_prompt_prefix(tokenizer, history: list, system_prompt: str = SYSTEM_PROMPT) -> str:
+    """Общая для последующих ходов часть промпта: system prompt + история."""
+    return tokenizer.apply_chat_template(
+        build_history_messages(history, system_prompt),
+        tokenize=False,
+        add_generation_prompt=False
+    )
+
+def build_prompt(
+        tokenizer,
+        history: list,
+        question: str,
+        context: str,
+        system_prompt: str = SYSTEM_PROMPT,
+        enable_thinking: bool = True,
+    ) -> str:
+
+    chat_messages = build_history_messages(history, system_prompt)
 
     # CONTEXT + QUESTION
     chat_messages.append({
@@ -48,25 +262,639 @@ def generate_answer(
     })
 
     # APPLY TEMPLATE
-    prompt = tokenizer.apply_chat_template(
+    # enable_thinking=False - шаблон Qwen3 подставляет пустой блок <think></think>
+    return tokenizer.apply_chat_template(
         chat_messages,
         tokenize=False,
-        add_generation_prompt=True
+        add_generation_prompt=True,
+        enable_thinking=enable_thinking,
     )
 
-    inputs = tokenizer(prompt, return_tensors="pt").to(DEVICE)
-
-    gen_config = GenerationConfig(
-        max_new_tokens=1000,
+def get_generation_config(tokenizer) -> GenerationConfig:
+    return GenerationConfig(
+        max_new_tokens=MAX_NEW_TOKENS,
         temperature=0.2,
         top_p=0.9,
         do_sample=False,
         eos_token_id=tokenizer.eos_token_id
     )
 
+def common_prefix_length(a: torch.Tensor, b: torch.Tensor) -> int:
+    n = min(len(a), len(b))
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+def crop_cache(cache, length: int):
+    # Отрицательный аргумент crop - число удаляемых с конца токенов
+    excess = cache.get_seq_length() - length
+    if excess > 0:
+        cache.crop(-excess)
+    return cache
+
+def cache_nbytes(cache) -> int:
+    if hasattr(cache, "layers"):
+        tensors = [t for layer in cache.layers for t in (layer.keys, layer.values)]
+    else:
+        tensors = list(cache.key_cache) + list(cache.value_cache)
+    return sum(t.numel() * t.element_size() for t in tensors if isinstance(t, torch.Tensor))
+
+
+class PrefixCache:
+    """
+    KV-кэш префиксов промпта (system prompt + история чата).
+    Ключ - (chat_id, хэш токенов префикса); вытеснение LRU в пределах бюджета памяти.
+    При поиске берется запись с самым длинным общим префиксом: сначала среди записей
+    этого чата, иначе среди всех (общий system prompt).
+    """
+    def __init__(self, max_bytes: int = PREFIX_CACHE_MAX_BYTES, min_tokens: int = PREFIX_CACHE_MIN_TOKENS):
+        self.max_bytes = max_bytes
+        self.min_tokens = min_tokens
+        self.entries: "OrderedDict[Tuple[Any, str], Tuple[torch.Tensor, Any, int]]" = OrderedDict()
+        self.total_bytes = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+
+    @staticmethod
+    def make_key(chat_id, token_ids: torch.Tensor) -> Tuple[Any, str]:
+        return chat_id, hashlib.sha1(token_ids.cpu().numpy().tobytes()).hexdigest()
+
+    def lookup(self, chat_id, input_ids: torch.Tensor):
+        """Возвращает (копия KV-кэша, обрезанная до общего префикса, длина префикса) или (None, 0)."""
+        with self.lock:
+            best_key, best_length = None, 0
+            for own_chat in (True, False):
+                for key, (token_ids, _, _) in self.entries.items():
+                    if (key[0] == chat_id) != own_chat:
+                        continue
+                    length = common_prefix_length(token_ids, input_ids)
+                    if length > best_length:
+                        best_key, best_length = key, length
+                if best_key is not None:
+                    break
+
+            # Хотя бы один токен промпта должен пройти через модель
+            best_length = min(best_length, len(input_ids) - 1)
+            if best_key is None or best_length < self.min_tokens:
+                self.misses += 1
+                return None, 0
+
+            self.entries.move_to_end(best_key)
+            cache = copy.deepcopy(self.entries[best_key][1])
+            self.hits += 1
+            self.reused_tokens += best_length
+
+        return crop_cache(cache, best_length), best_length
+
+    def store(self, chat_id, token_ids: torch.Tensor, cache):
+        """
+        Сохраняет KV-кэш, уже обрезанный до длины token_ids.
+        Более короткие префиксы того же чата заменяются новым.
+        """
+        nbytes = cache_nbytes(cache)
+        if nbytes > self.max_bytes:
+            return
+        key = self.make_key(chat_id, token_ids)
+        with self.lock:
+            for old_key in [old_key for old_key in self.entries if old_key[0] == chat_id]:
+                self.total_bytes -= self.entries.pop(old_key)[2]
+            self.entries[key] = (token_ids.cpu(), cache, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _, (_, _, evicted_bytes) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def drop_chat(self, chat_id):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == chat_id]:
+                self.total_bytes -= self.entries.pop(key)[2]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "reused_tokens": self.reused_tokens,
+            }
+
+
+class GenerationRequest:
+    """Запрос к GenerationWorker: промпт, параметры генерации, условия остановки и future с ответом."""
+    def __init__(
+        self,
+        prompt: str,
+        max_new_tokens: int = MAX_NEW_TOKENS,
+        stop_token_ids: Optional[List[int]] = None,
+        streamer=None,
+        chat_id=None,
+        prefix_prompt: Optional[str] = None,
+        options: Optional[GenerationOptions] = None,
+    ):
+        self.prompt = prompt
+        # Для переиспользования KV-кэша: чат и его префикс (system prompt + история)
+        self.chat_id = chat_id
+        self.prefix_prompt = prefix_prompt
+        self.options = options if options is not None else GenerationOptions(max_new_tokens=max_new_tokens)
+        self.max_new_tokens = self.options.max_new_tokens
+        self.stop_token_ids = set(stop_token_ids or [])
+        # Необязательный streamer (интерфейс transformers: put/end) для потоковой выдачи
+        self.streamer = streamer
+        self.future: Future = Future()
+        self.created_at = time.monotonic()
+        self.token_ids: List[int] = []
+        # Состояние блока <think>: открыт ли он сейчас и с какого токена начинается ответ
+        self.thinking = False
+        self.answer_start = 0
+        self.finished = False
+        # Ответ больше не нужен (клиент отключился): генерация строки прекращается на ближайшем шаге
+        self.cancelled = Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def accept(self, token_id: int, open_ids: List[int], close_ids: List[int], tokenizer) -> bool:
+        """Добавляет сгенерированный токен; True - запрос пора завершать."""
+        if token_id in self.stop_token_ids:
+            return True
+        self.token_ids.append(token_id)
+        if self.streamer is not None:
+            self.streamer.put(torch.tensor([token_id]))
+
+        if self.token_ids == open_ids:
+            self.thinking = True
+        elif self.thinking and self.token_ids[-len(close_ids):] == close_ids:
+            self.thinking = False
+            self.answer_start = len(self.token_ids)
+
+        stop_sequences = self.options.stop_sequences
+        if stop_sequences and not self.thinking:
+            # Каждый токен - хотя бы один символ, поэтому хвоста такой длины достаточно
+            window = max(len(stop) for stop in stop_sequences) + 1
+            tail = tokenizer.decode(
+                self.token_ids[max(self.answer_start, len(self.token_ids) - window):],
+                skip_special_tokens=True,
+            )
+            if any(stop in tail for stop in stop_sequences):
+                return True
+
+        return len(self.token_ids) >= self.max_new_tokens
+
+
+def think_tag_ids(tokenizer) -> Tuple[List[int], List[int]]:
+    return (
+        tokenizer.encode(ThinkFilter.OPEN_TAG, add_special_tokens=False),
+        tokenizer.encode(ThinkFilter.CLOSE_TAG, add_special_tokens=False),
+    )
+
+
+def contains_sequence(tokens: List[int], sequence: List[int]) -> bool:
+    n = len(sequence)
+    return any(tokens[i:i + n] == sequence for i in range(len(tokens) - n + 1))
+
+
+class BatchStoppingCriteria(StoppingCriteria):
+    """
+    Построчные условия остановки для батча: у каждого запроса свой лимит токенов,
+    свои стоп-токены и стоп-последовательности; отмененный запрос останавливается сразу.
+    Завершенный запрос сразу получает ответ, не дожидаясь всего батча.
+    За шаг может добавиться несколько токенов (assisted decoding).
+    """
+    def __init__(self, requests: List[GenerationRequest], tokenizer, prompt_length: int):
+        self.requests = requests
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.open_ids, self.close_ids = think_tag_ids(tokenizer)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros(len(self.requests), dtype=torch.bool, device=input_ids.device)
+        for row, request in enumerate(self.requests):
+            if request.cancelled.is_set():
+                finish_request(request, self.tokenizer)
+            elif not request.finished:
+                new_tokens = input_ids[row, self.prompt_length + len(request.token_ids):].tolist()
+                for token_id in new_tokens:
+                    if request.accept(token_id, self.open_ids, self.close_ids, self.tokenizer):
+                        finish_request(request, self.tokenizer)
+                        break
+            done[row] = request.finished
+        return done
+
+
+class ThinkingBudgetProcessor(LogitsProcessor):
+    """
+    Ограничивает блок <think> числом max_thinking_tokens: после лимита
+    принудительно генерируются токены </think>, и модель переходит к ответу.
+    """
+    def __init__(self, requests: List[GenerationRequest], tokenizer, prompt_length: int):
+        self.requests = requests
+        self.prompt_length = prompt_length
+        self.open_ids, self.close_ids = think_tag_ids(tokenizer)
+
+    def __call__(self, input_ids, scores):
+        for row, request in enumerate(self.requests):
+            budget = request.options.max_thinking_tokens
+            if budget is None or request.finished or request.answer_start:
+                continue
+            generated = input_ids[row, self.prompt_length:].tolist()
+            body = generated[len(self.open_ids):]
+            if generated[:len(self.open_ids)] != self.open_ids or len(body) < budget:
+                continue
+            if contains_sequence(body, self.close_ids):
+                continue
+            # Сколько токенов </think> уже сгенерировано подряд в конце
+            done = max(
+                (k for k in range(1, len(self.close_ids)) if body[-k:] == self.close_ids[:k]),
+                default=0,
+            )
+            forced = self.close_ids[done]
+            scores[row, :] = -float("inf")
+            scores[row, forced] = 0.0
+        return scores
+
+
+def finish_request(request: GenerationRequest, tokenizer, error: Optional[BaseException] = None):
+    if request.finished:
+        return
+    request.finished = True
+    if request.streamer is not None:
+        request.streamer.end()
+    if error is not None:
+        request.future.set_exception(error)
+    else:
+        decoded = tokenizer.decode(request.token_ids, skip_special_tokens=True)
+        answer = cut_at_stop(strip_think(decoded), request.options.stop_sequences)
+        request.future.set_result(answer.strip())
+
+
+def generate_single(tokenizer, model, request: GenerationRequest, past_key_values=None, draft_model=None):
+    """
+    Генерация одного запроса (с готовым KV-кэшем префикса и/или ускоренным декодированием).
+    Возвращает (input_ids промпта, результат model.generate).
+    """
+    inputs = tokenizer(request.prompt, return_tensors="pt").to(DEVICE)
+    prompt_length = inputs["input_ids"].shape[1]
+
+    gen_config = get_generation_config(tokenizer)
+    gen_config.max_new_tokens = request.max_new_tokens
+    gen_config.pad_token_id = tokenizer.pad_token_id
+    gen_config.return_dict_in_generate = True
+
+    # Спекулятивное декодирование в transformers поддерживает только batch size 1
+    assistant = {}
+    if request.options.assisted == "prompt_lookup":
+        gen_config.prompt_lookup_num_tokens = PROMPT_LOOKUP_TOKENS
+    elif request.options.assisted == "draft" and draft_model is not None:
+        assistant["assistant_model"] = draft_model
+
     with torch.no_grad():
-        output = model.generate(**inputs, generation_config=gen_config)
+        output = model.generate(
+            **inputs,
+            generation_config=gen_config,
+            past_key_values=past_key_values,
+            logits_processor=LogitsProcessorList([ThinkingBudgetProcessor([request], tokenizer, prompt_length)]),
+            stopping_criteria=StoppingCriteriaList([BatchStoppingCriteria([request], tokenizer, prompt_length)]),
+            **assistant,
+        )
+    finish_request(request, tokenizer)
+    return inputs["input_ids"][0], output
+
+
+class GenerationWorker:
+    """
+    Единственный поток, владеющий моделью. Динамический (не continuous) батчинг:
+    запросы из очереди собираются в батч (до max_batch_size, с ожиданием попутных
+    запросов max_wait секунд), промпты выравниваются левым паддингом и генерируются
+    одним model.generate. Состав батча фиксирован до конца генерации: запрос, пришедший
+    во время нее, ждет следующего батча; досрочно завершенные запросы отдаются сразу.
+    Одиночный запрос с chat_id генерируется с переиспользованием KV-кэша префикса,
+    запросы с ускоренным декодированием - по одному (с черновой моделью draft_model).
+    """
+    def __init__(
+        self,
+        tokenizer,
+        model,
+        max_batch_size: int = GENERATION_MAX_BATCH_SIZE,
+        max_wait: float = GENERATION_MAX_WAIT_SECONDS,
+        prefix_cache: Optional[PrefixCache] = None,
+        draft_model=None,
+    ):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.draft_model = draft_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: "queue.Queue[Optional[GenerationRequest]]" = queue.Queue()
+        self.thread: Optional[Thread] = None
+        self.stats = {"batches": 0, "requests": 0, "max_batch_size": 0}
+
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def start(self) -> "GenerationWorker":
+        if self.thread is None:
+            self.thread = Thread(target=self._run, name="generation-worker", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(
+        self,
+        prompt: str,
+        max_new_tokens: int = MAX_NEW_TOKENS,
+        stop_token_ids: Optional[List[int]] = None,
+        streamer=None,
+        chat_id=None,
+        prefix_prompt: Optional[str] = None,
+        options: Optional[GenerationOptions] = None,
+    ) -> Future:
+        if stop_token_ids is None:
+            stop_token_ids = [self.tokenizer.eos_token_id]
+        request = GenerationRequest(
+            prompt, max_new_tokens, stop_token_ids, streamer,
+            chat_id=chat_id, prefix_prompt=prefix_prompt, options=options,
+        )
+        return self.submit_request(request)
+
+    def submit_request(self, request: GenerationRequest) -> Future:
+        """Ставит готовый запрос в очередь; сам запрос остается у вызывающего (например, для cancel)."""
+        self.queue.put(request)
+        return request.future
+
+    def _collect_batch(self, first: GenerationRequest) -> List[GenerationRequest]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                request = self.queue.get(timeout=max(timeout, 0)) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Сигнал остановки обработаем после текущего батча
+                self.queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            request = self.queue.get()
+            if request is None:
+                return
+            batch = self._collect_batch(request)
+            try:
+                self._generate_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    finish_request(request, self.tokenizer, error=e)
+
+    def _uses_prefix_cache(self, request: GenerationRequest) -> bool:
+        return self.prefix_cache is not None and request.chat_id is not None and request.prefix_prompt is not None
+
+    def _generate_single(self, request: GenerationRequest):
+        # Ускоренное декодирование в transformers расходится с жадным при готовом past_key_values,
+        # поэтому такие запросы считают промпт целиком
+        if request.options.assisted or not self._uses_prefix_cache(request):
+            generate_single(self.tokenizer, self.model, request, draft_model=self.draft_model)
+            return
+
+        input_ids = self.tokenizer(request.prompt, return_tensors="pt")["input_ids"][0]
+        past_key_values, _ = self.prefix_cache.lookup(request.chat_id, input_ids)
+        input_ids, output = generate_single(
+            self.tokenizer, self.model, request,
+            past_key_values=past_key_values, draft_model=self.draft_model,
+        )
+
+        # Сохраняем KV только для префикса, который повторится в следующем ходе чата
+        prefix_ids = self.tokenizer(request.prefix_prompt, return_tensors="pt")["input_ids"][0]
+        prefix_length = common_prefix_length(prefix_ids, input_ids.cpu())
+        if prefix_length >= self.prefix_cache.min_tokens and output.past_key_values is not None:
+            cache = crop_cache(output.past_key_values, prefix_length)
+            self.prefix_cache.store(request.chat_id, input_ids[:prefix_length], cache)
+
+    def _generate_batch(self, batch: List[GenerationRequest]):
+        # Отмененные, пока ждали в очереди, не генерируются вовсе
+        for request in batch:
+            if request.cancelled.is_set():
+                finish_request(request, self.tokenizer)
+        batch = [request for request in batch if not request.finished]
+        if not batch:
+            return
+        # Запросы с ускоренным декодированием и одиночный запрос чата идут по одному
+        single = [request for request in batch if request.options.assisted]
+        regular = [request for request in batch if not request.options.assisted]
+        if len(regular) == 1 and self._uses_prefix_cache(regular[0]):
+            single.insert(0, regular.pop())
+
+        if regular:
+            self._generate_regular(regular)
+        for request in single:
+            if request.cancelled.is_set():
+                finish_request(request, self.tokenizer)
+                continue
+            self._generate_single(request)
+        self._update_stats(batch)
+
+    def _generate_regular(self, batch: List[GenerationRequest]):
+        inputs = self.tokenizer(
+            # Для батчевой генерации decoder-only модели нужен левый паддинг; задаем его
+            # в вызове, а не в общем токенизаторе, которым пользуются и другие потоки
+            [request.prompt for request in batch], return_tensors="pt", padding=True, padding_side="left",
+        ).to(DEVICE)
+        prompt_length = inputs["input_ids"].shape[1]
+
+        gen_config = get_generation_config(self.tokenizer)
+        gen_config.max_new_tokens = max(request.max_new_tokens for request in batch)
+        gen_config.pad_token_id = self.tokenizer.pad_token_id
+
+        with torch.no_grad():
+            self.model.generate(
+                **inputs,
+                generation_config=gen_config,
+                logits_processor=LogitsProcessorList([ThinkingBudgetProcessor(batch, self.tokenizer, prompt_length)]),
+                stopping_criteria=StoppingCriteriaList([BatchStoppingCriteria(batch, self.tokenizer, prompt_length)]),
+            )
 
-    decoded = tokenizer.decode(output[0], skip_special_tokens=True)
-    answer = decoded.split("</think>", 1)[-1].strip()
-    return answer
+        # Запросы, остановленные самой генерацией (например, по общему лимиту)
+        for request in batch:
+            finish_request(request, self.tokenizer)
+
+    def _update_stats(self, batch: List[GenerationRequest]):
+        self.stats["batches"] += 1
+        self.stats["requests"] += len(batch)
+        self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+
+
+def generate_answer(
+        tokenizer,
+        model,
+        history: list,
+        question: str,
+        context: str,
+        system_prompt: str = SYSTEM_PROMPT,
+        worker: Optional[GenerationWorker] = None,
+        chat_id=None,
+        options: Optional[GenerationOptions] = None,
+    ) -> str:
+
+    options = options if options is not None else GenerationOptions()
+    prompt = build_prompt(tokenizer, history, question, context, system_prompt, options.enable_thinking)
+    if worker is not None:
+        return worker.submit(
+            prompt,
+            chat_id=chat_id,
+            prefix_prompt=build_prompt_prefix(tokenizer, history, system_prompt),
+            options=options,
+        ).result()
+
+    request = GenerationRequest(prompt, stop_token_ids=[tokenizer.eos_token_id], options=options)
+    generate_single(tokenizer, model, request)
+    return request.future.result()
+
+def generate_answer_stream(
+        tokenizer,
+        model,
+        history: list,
+        question: str,
+        context: str,
+        system_prompt: str = SYSTEM_PROMPT,
+        worker: Optional[GenerationWorker] = None,
+        chat_id=None,
+        options: Optional[GenerationOptions] = None,
+    ) -> Iterator[str]:
+    """
+    Потоковая версия generate_answer: отдает фрагменты ответа по мере генерации
+    токенов, блок <think> вырезается на лету, ответ обрывается на стоп-последовательности.
+    """
+    options = options if options is not None else GenerationOptions()
+    prompt = build_prompt(tokenizer, history, question, context, system_prompt, options.enable_thinking)
+    streamer = TextIteratorStreamer(tokenizer, skip_special_tokens=True)
+    request = GenerationRequest(
+        prompt,
+        stop_token_ids=[tokenizer.eos_token_id],
+        streamer=streamer,
+        chat_id=chat_id,
+        prefix_prompt=build_prompt_prefix(tokenizer, history, system_prompt),
+        options=options,
+    )
+    thread = None
+
+    if worker is not None:
+        worker.submit_request(request)
+    else:
+        def run_generate():
+            try:
+                generate_single(tokenizer, model, request)
+            except Exception as e:
+                finish_request(request, tokenizer, error=e)
+
+        thread = Thread(target=run_generate, daemon=True)
+        thread.start()
+
+    think_filter = ThinkFilter()
+    stop_filter = StopSequenceFilter(options.stop_sequences)
+    try:
+        for text in streamer:
+            piece = stop_filter.feed(think_filter.feed(text))
+            if piece:
+                yield piece
+    finally:
+        # Генератор закрыт посреди ответа (клиент отключился): строка генерации
+        # прекращается на ближайшем шаге, и закрытие ждет, пока она действительно освободится
+        if not request.finished:
+            request.cancel()
+        if thread is not None:
+            thread.join()
+        error = request.future.exception()
+    if error is not None:
+        raise error
+
+    piece = stop_filter.feed(think_filter.flush()) + stop_filter.flush()
+    if piece:
+        yield piece
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux - в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def benchmark_backend(
+    model_path: str,
+    backend: str,
+    compile: bool = False,
+    num_threads: Optional[int] = None,
+    max_new_tokens: int = 128,
+    runs: int = 3,
+) -> dict:
+    """Скорость генерации (токенов/с) и пиковый RSS для одного варианта модели."""
+    started = time.perf_counter()
+    tokenizer, model = load_llm(model_path, backend=backend, compile=compile, num_threads=num_threads)
+    load_seconds = time.perf_counter() - started
+    warmup_llm(tokenizer, model)
+
+    prompt = build_prompt(tokenizer, [], "Опиши порядок приемки продукции.", "Контекст: " + "текст " * 200)
+    inputs = tokenizer(prompt, return_tensors="pt").to(DEVICE)
+    generated, seconds = 0, 0.0
+    for _ in range(runs):
+        started = time.perf_counter()
+        with torch.no_grad():
+            output = model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+            )
+        seconds += time.perf_counter() - started
+        generated += output.shape[1] - inputs["input_ids"].shape[1]
+
+    return {
+        "backend": backend,
+        "compile": compile,
+        "threads": torch.get_num_threads(),
+        "prompt_tokens": inputs["input_ids"].shape[1],
+        "load_s": load_seconds,
+        "tokens_per_s": generated / seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def benchmark_backends(model_path: str, backends=LLM_BACKENDS, **kwargs) -> List[dict]:
+    """Каждый вариант меряется в отдельном процессе, чтобы пиковый RSS не смешивался."""
+    rows = []
+    for backend in backends:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            rows.append(executor.submit(benchmark_backend, model_path, backend, **kwargs).result())
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Микро-бенчмарк вариантов LLM: токены/с и пиковый RSS")
+    parser.add_argument("model", help="каталог модели (models/qwen3_06b)")
+    parser.add_argument("--backends", nargs="+", choices=LLM_BACKENDS, default=list(LLM_BACKENDS))
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'backend':<8} {'compile':<8} {'threads':>7} {'load, s':>8} {'tok/s':>8} {'peak RSS, MB':>13}")
+    for row in benchmark_backends(
+        args.model, args.backends, compile=args.compile, num_threads=args.threads,
+        max_new_tokens=args.max_new_tokens, runs=args.runs,
+    ):
+        print(
+            f"{row['backend']:<8} {str(row['compile']):<8} {row['threads']:>7} {row['load_s']:>8.1f} "
+            f"{row['tokens_per_s']:>8.1f} {row['peak_rss_mb']:>13.0f}"
+        )
@@ -1,34 +1,87 @@
 import asyncio
-from fastapi import FastAPI, Depends, HTTPException, status
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from fastapi import FastAPI, Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from fastapi.responses import FileResponse
-from database import get_db, User, create_db_tables 
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
+from database import get_db, User, create_db_tables, SessionLocal
 from schemas import UserCreate, Token, UserLogin, Chat as ChatSchema, Message as MessageSchema, ChatCreate 
-from auth import get_password_hash, verify_password, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, get_current_user
+from auth import get_password_hash, verify_password, create_access_token, ACCESS_TOKEN_EXPIRE_MINUTES, get_current_user, get_current_admin
 from datetime import timedelta
 import crud
-from pydantic import BaseModel
-from typing import List
+from admission import RAG_MAX_CONCURRENCY, AdmissionController, Overloaded
+from pydantic import BaseModel, Field
+from typing import Any, Dict, List, Literal, Optional
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
-from main_rag import initialize_rag_resources, get_rag_answer 
+# RAG_MODEL_SOCKET: модели держит отдельный процесс model_server.py, а воркеры API
+# обращаются к нему по Unix-сокету (без собственной копии моделей и индексов)
+MODEL_SOCKET = os.getenv("RAG_MODEL_SOCKET")
+if MODEL_SOCKET:
+    from model_server import ModelServerClient
+    rag_client = ModelServerClient(MODEL_SOCKET)
+    start_rag_initialization, get_rag_answer, get_rag_answer_stream = (
+        rag_client.start_rag_initialization, rag_client.get_rag_answer, rag_client.get_rag_answer_stream
+    )
+    forget_chat, get_cache_stats, reload_index, index_status = (
+        rag_client.forget_chat, rag_client.get_cache_stats, rag_client.reload_index, rag_client.index_status
+    )
+    rag_readiness, rag_resources_ready = rag_client.rag_readiness, rag_client.rag_resources_ready
+else:
+    from main_rag import (
+        start_rag_initialization, get_rag_answer, get_rag_answer_stream, forget_chat, get_cache_stats,
+        reload_index, index_status, rag_readiness, rag_resources_ready,
+    )
 RAW_DIR = Path("data/raw")
+# Через сколько секунд клиенту стоит повторить запрос, пока RAG-ресурсы загружаются
+RAG_RETRY_AFTER_SECONDS = 10
+
+# Допуск RAG-запросов: параметры (RAG_MAX_CONCURRENCY и др.) читаются из окружения в admission.py
+admission = AdmissionController()
+# Свой пул вместо asyncio.to_thread: потоков ровно столько, сколько допущено запросов
+RAG_EXECUTOR = ThreadPoolExecutor(max_workers=RAG_MAX_CONCURRENCY, thread_name_prefix="rag")
 
 # Создаем таблицы при запуске (если еще не созданы)
 create_db_tables() 
 
 app = FastAPI()
 
+@app.exception_handler(Overloaded)
+def overloaded_handler(request: Request, exc: Overloaded):
+    """Перегрузка: 429 (лимит пользователя) или 503 (очередь полна / таймаут) с Retry-After."""
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 # --- ИНИЦИАЛИЗАЦИЯ RAG-РЕСУРСОВ ПРИ ЗАПУСКЕ СЕРВЕРА ---
 @app.on_event("startup")
 def startup_event():
-    # Загружаем LLM, эмбеддинги и FAISS-индекс один раз
-    if not initialize_rag_resources():
-        # Если инициализация не удалась, можно остановить приложение или выдать предупреждение
-        print("ВНИМАНИЕ: RAG-ресурсы не были загружены. Чат будет недоступен или будет выдавать ошибки.")
+    # LLM, эмбеддинги и индексы грузятся параллельно в фоне; эндпоинты без RAG работают сразу,
+    # а /chat отвечает 503, пока /health/ready не станет готов
+    start_rag_initialization()
 # -------------------------------------------------------
 
+@app.get("/health/live")
+def health_live():
+    """Процесс жив и принимает запросы (RAG-ресурсы могут еще загружаться)."""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+def health_ready():
+    """Готовность к RAG-запросам: 200 или 503, с состоянием и временем загрузки каждого ресурса."""
+    readiness = rag_readiness()
+    return JSONResponse(
+        status_code=status.HTTP_200_OK if readiness["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE,
+        content=readiness,
+    )
+
 @app.get("/files/{filename}")
 async def get_file(filename: str):
     file_path = RAW_DIR / filename
@@ -82,6 +135,32 @@ def login_for_access_token(user_data: UserLogin, db: Session = Depends(get_db)):
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
+@app.get("/stats/cache")
+def read_cache_stats(current_user: User = Depends(get_current_user)):
+    """Метрики кэшей RAG (эмбеддинги запросов, оценки reranker, стемминг, KV-префиксы)."""
+    return get_cache_stats()
+
+@app.get("/stats/admission")
+def read_admission_stats(current_user: User = Depends(get_current_user)):
+    """Очередь RAG-запросов: выполняются / ждут, отказы и время ожидания в очереди."""
+    return admission.stats()
+
+@app.get("/admin/index")
+def read_index_status(current_user: User = Depends(get_current_admin)):
+    """Версия поисковых индексов и состояние фоновой перезагрузки."""
+    return index_status()
+
+@app.post("/admin/index/reload", status_code=status.HTTP_202_ACCEPTED)
+def reload_rag_index(ingest: bool = False, current_user: User = Depends(get_current_admin)):
+    """
+    Загружает новую версию FAISS / BM25 / payloads в фоне и подменяет ее без перезапуска
+    (ingest=true - сначала проиндексировать изменения data/raw). Модели не перезагружаются.
+    """
+    try:
+        return reload_index(run_ingest=ingest)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
 @app.get("/users/me")
 def read_users_me(current_user: User = Depends(get_current_user)):
     return {"username": current_user.username, "id": current_user.id}
@@ -118,6 +197,7 @@ def delete_user_chat(
     if owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized to delete this chat")
     crud.delete_chat(db, chat_id)
+    forget_chat(chat_id)
     return 
 
 @app.get("/chats/{chat_id}/messages", response_model=List[MessageSchema])
@@ -141,19 +221,36 @@ class ChatRequest(BaseModel):
     query: str
     chat_id: int 
     use_tables: bool = False # <-- НОВОЕ ПОЛЕ: Флаг для поиска в табличном индексе
-    
-@app.post("/chat", response_model=MessageSchema)
-async def process_chat_request(
-    request: ChatRequest, 
-    db: Session = Depends(get_db), 
-    current_user: User = Depends(get_current_user)
-):
+    # Параметры генерации; не заданные берутся из настроек сервера
+    enable_thinking: Optional[bool] = None
+    # 0 не принимается: у RAG_MAX_THINKING_TOKENS он означает "без лимита", для отключения размышлений - enable_thinking=false
+    max_thinking_tokens: Optional[int] = Field(None, ge=1)
+    max_new_tokens: Optional[int] = Field(None, ge=1)
+    stop_sequences: Optional[List[str]] = None
+    assisted: Optional[Literal["prompt_lookup", "draft"]] = None
+
+    def generation_overrides(self) -> Dict[str, Any]:
+        return self.model_dump(
+            include={"enable_thinking", "max_thinking_tokens", "max_new_tokens", "stop_sequences", "assisted"},
+            exclude_none=True,
+        )
+
+
+def prepare_chat_turn(request: ChatRequest, db: Session, current_user: User) -> List[tuple]:
+    """Проверяет владение чатом, сохраняет сообщение пользователя и возвращает историю для RAG."""
     # 1. Проверка владения чатом
     owner_id = crud.get_chat_owner_id(db, request.chat_id)
     if owner_id is None:
         raise HTTPException(status_code=404, detail="Chat not found")
     if owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not authorized to use this chat")
+    # До сохранения сообщения: иначе в истории останется вопрос без ответа
+    if not rag_resources_ready():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="RAG resources are loading",
+            headers={"Retry-After": str(RAG_RETRY_AFTER_SECONDS)},
+        )
 
     # 2. Логика именования чата при первом сообщении
     message_count = crud.get_message_count_by_chat_id(db, request.chat_id)
@@ -176,30 +273,130 @@ async def process_chat_request(
         for msg in previous_messages_db 
         if msg.id != db_user_message.id 
     ]
-    history_for_rag = history_for_rag[-20:]
-    
-    # 4. ВЫЗОВ РЕАЛЬНОГО RAG-ДВИЖКА
-    try:
-        # get_rag_answer синхронная, поэтому используем asyncio.to_thread, чтобы не блокировать сервер
-        rag_result = await asyncio.to_thread(
-            get_rag_answer, 
-            history_for_rag, 
-            request.query, 
-            use_tables=request.use_tables # <-- Передаем новый флаг!
-        )
-        answer_text = rag_result.get("answer", "Ошибка при получении ответа от RAG-движка.")
-        source_documents = rag_result.get("source_documents", [])
-        
-    except Exception as e:
-        # В случае ошибки RAG, возвращаем сообщение об ошибке
-        print(f"Критическая ошибка RAG: {e}")
-        answer_text = "Извините, произошла внутренняя ошибка сервера при обработке запроса AI."
-        source_documents = []
-        
+    return history_for_rag[-20:]
+
+@app.post("/chat", response_model=MessageSchema)
+async def process_chat_request(
+    request: ChatRequest, 
+    db: Session = Depends(get_db), 
+    current_user: User = Depends(get_current_user)
+):
+    # Слот выдается до сохранения вопроса: отклоненный запрос не оставляет следа в истории
+    async with admission.slot(current_user.id):
+        # Запросы к БД синхронные - выполняем их вне event loop
+        history_for_rag = await run_in_threadpool(prepare_chat_turn, request, db, current_user)
+
+        # 4. ВЫЗОВ РЕАЛЬНОГО RAG-ДВИЖКА
+        try:
+            # get_rag_answer синхронная, поэтому выполняем ее в RAG_EXECUTOR, чтобы не блокировать сервер
+            rag_result = await asyncio.get_running_loop().run_in_executor(RAG_EXECUTOR, partial(
+                get_rag_answer,
+                history_for_rag,
+                request.query,
+                use_tables=request.use_tables, # <-- Передаем новый флаг!
+                chat_id=request.chat_id,
+                generation=request.generation_overrides(),
+            ))
+            answer_text = rag_result.get("answer", "Ошибка при получении ответа от RAG-движка.")
+            source_documents = rag_result.get("source_documents", [])
+
+        except Exception as e:
+            # В случае ошибки RAG, возвращаем сообщение об ошибке
+            print(f"Критическая ошибка RAG: {e}")
+            answer_text = "Извините, произошла внутренняя ошибка сервера при обработке запроса AI."
+            source_documents = []
+
+
     # 5. Сохраняем ответ AI (только текст в БД)
-    db_ai_message = crud.create_message(db, request.chat_id, answer_text, sender="ai")
+    db_ai_message = await run_in_threadpool(crud.create_message, db, request.chat_id, answer_text, sender="ai")
 
     # 6. Возвращаем сообщение AI + источники
     response = MessageSchema.model_validate(db_ai_message)
     response.source_documents = source_documents
-    return response
\ No newline at end of file
+    return response
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    Держит слот admission, пока ответ передается: слот освобождается, когда ответ
+    отправлен или клиент отключился (даже если генератор так и не был запущен).
+    При отключении синхронный генератор ответа закрывается явно, и слот освобождается
+    только после того, как генерация действительно остановилась.
+    """
+    def __init__(self, content, started_at: float, **kwargs):
+        super().__init__(content, **kwargs)
+        self.content = content
+        self.started_at = started_at
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            try:
+                # close() ждет отмены генерации, поэтому выполняется вне event loop
+                await run_in_threadpool(self.content.close)
+            finally:
+                admission.release(time.monotonic() - self.started_at)
+
+@app.post("/chat/stream")
+async def process_chat_stream_request(
+    request: ChatRequest, 
+    db: Session = Depends(get_db), 
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Потоковый вариант /chat (server-sent events): события sources, token (фрагменты ответа)
+    и message (сохраненное сообщение AI) в конце.
+    """
+    await admission.acquire(current_user.id)
+    started_at = time.monotonic()
+    try:
+        # Запросы к БД синхронные - выполняем их вне event loop
+        history_for_rag = await run_in_threadpool(prepare_chat_turn, request, db, current_user)
+    except BaseException:
+        admission.release()
+        raise
+    chat_id = request.chat_id
+
+    def event_stream():
+        answer_text = "Извините, произошла внутренняя ошибка сервера при обработке запроса AI."
+        source_documents = []
+        events = get_rag_answer_stream(
+            history_for_rag, request.query, use_tables=request.use_tables, chat_id=chat_id,
+            generation=request.generation_overrides(),
+        )
+        try:
+            for event in events:
+                if event["type"] == "sources":
+                    source_documents = event["source_documents"]
+                    yield sse_event("sources", {"source_documents": source_documents})
+                elif event["type"] == "token":
+                    yield sse_event("token", {"text": event["text"]})
+                elif event["type"] == "done":
+                    answer_text = event["answer"]
+        except Exception as e:
+            print(f"Критическая ошибка RAG: {e}")
+        finally:
+            # Клиент отключился (GeneratorExit) - закрываем RAG-генератор, это отменяет генерацию
+            events.close()
+
+        # Сессия запроса к этому моменту может быть уже закрыта, поэтому открываем свою
+        stream_db = SessionLocal()
+        try:
+            db_ai_message = crud.create_message(stream_db, chat_id, answer_text, sender="ai")
+            response = MessageSchema.model_validate(db_ai_message)
+            response.source_documents = source_documents
+            yield sse_event("message", response.model_dump(mode="json", by_alias=True))
+        finally:
+            stream_db.close()
+
+    return AdmittedStreamingResponse(
+        event_stream(),
+        started_at,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,212 +1,614 @@
 import torch
 import pandas as pd
+import numpy as np
 import os
 import traceback
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict, Any 
+from typing import List, Tuple, Optional, Dict, Any, Iterator
 from sentence_transformers import SentenceTransformer
 # Предполагается, что BM25 импортирует нужные классы/функции
-from BM25 import TwoStageSearch, search_BM25_global
-import pickle
+from BM25 import load_or_fit_searcher, search_BM25_global, stem_cache_info
+from payload_store import PayloadStore, ConcatPayloads
+from ingest import INGEST_STORE_PATH, load_ingest_payloads, ingest
+import hashlib
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 # ВАЖНО: Убедитесь, что FAISSStore, Reranker, load_llm и generate_answer 
 # доступны через импорты, которые вы используете.
 try:
-    from faiss_store import FAISSStore, Reranker, get_context_hybrid
-    from llm import load_llm, generate_answer 
+    from faiss_store import (
+        FAISSStore, MultiStore, Reranker, CachedEncoder, search_candidates, reciprocal_rank_fusion, chunk_key
+    )
+    from answer_cache import SemanticAnswerCache
+    from llm import (
+        load_llm, generate_answer, generate_answer_stream, GenerationWorker, PrefixCache,
+        GenerationOptions, MAX_NEW_TOKENS, ASSISTED_MODES,
+    )
+    from context_packer import ContextPacker
 except ImportError as e:
     print(f"RAG Import Error: {e}. Убедитесь, что 'faiss_store.py' и 'llm.py' доступны.")
-    FAISSStore, Reranker, get_context_hybrid, load_llm, generate_answer = None, None, None, None, None
+    FAISSStore, Reranker, load_llm, generate_answer = None, None, None, None
+    MultiStore, search_candidates, reciprocal_rank_fusion = None, None, None
+    CachedEncoder, chunk_key, SemanticAnswerCache = None, None, None
+    generate_answer_stream, GenerationWorker, PrefixCache = None, None, None
+    ContextPacker, GenerationOptions, MAX_NEW_TOKENS = None, None, 1000
+    ASSISTED_MODES = ("prompt_lookup", "draft")
+
+# ONNX Runtime - необязательный бэкенд для энкодера и reranker
+try:
+    from onnx_backend import OnnxEncoder, OnnxCrossEncoder
+except ImportError:
+    OnnxEncoder, OnnxCrossEncoder = None, None
 
 # --- КОНФИГУРАЦИЯ ---
 LLM_MODEL = "models/qwen3_06b"
+EMB_MODEL = "models/multilingual-e5-large"
+RERANKER_MODEL = "models/cross-encoder/ms-marco-MiniLM-L-6-v2"
+# Бэкенд энкодера запросов и reranker: torch или onnx (int8, экспортируется при первом запуске)
+ENCODER_BACKEND = os.getenv("RAG_ENCODER_BACKEND", "torch")
+ONNX_MODELS_PATH = Path("models/onnx")
+ONNX_THREADS = int(os.getenv("RAG_ONNX_THREADS", str(os.cpu_count() or 1)))
+# Адаптивный rerank: дедупликация кандидатов и ранний выход вместо оценки всех top_faiss
+RERANK_ADAPTIVE = os.getenv("RAG_RERANK_ADAPTIVE", "0") == "1"
+# Слияние FAISS и BM25 (reciprocal-rank fusion): кандидаты каждого этапа,
+# сколько лучших после слияния идут в reranker и сколько документов попадает в контекст
+DENSE_CANDIDATES = 25
+LEXICAL_CANDIDATES = 10
+RERANK_CANDIDATES = 20
+CONTEXT_DOCUMENTS = 3
+# Бюджет токенов промпта: история и контекст укладываются в него перед генерацией
+PROMPT_TOKEN_BUDGET = int(os.getenv("RAG_PROMPT_TOKEN_BUDGET", "3072"))
+# Параметры генерации по умолчанию (каждый можно переопределить в запросе):
+# размышления Qwen3 и их лимит (0 - без лимита), ускоренное декодирование
+# (prompt_lookup или draft) и черновая модель с тем же токенизатором
+ENABLE_THINKING = os.getenv("RAG_ENABLE_THINKING", "1") == "1"
+MAX_THINKING_TOKENS = int(os.getenv("RAG_MAX_THINKING_TOKENS", "0")) or None
+ASSISTED_DECODING = os.getenv("RAG_ASSISTED_DECODING") or None
+# Ошибка в настройках видна сразу при запуске, а не первым запросом
+if MAX_THINKING_TOKENS is not None and MAX_THINKING_TOKENS < 0:
+    raise ValueError(f"RAG_MAX_THINKING_TOKENS должен быть >= 0, получено {MAX_THINKING_TOKENS}")
+if ASSISTED_DECODING is not None and ASSISTED_DECODING not in ASSISTED_MODES:
+    raise ValueError(f"RAG_ASSISTED_DECODING: неизвестный режим {ASSISTED_DECODING!r}, доступны {ASSISTED_MODES}")
+DRAFT_MODEL = os.getenv("RAG_DRAFT_MODEL") or None
+# Вариант LLM: fp32 / bf16 / int8, torch.compile с прогревом при запуске, потоки intra-op (0 - по умолчанию)
+LLM_BACKEND = os.getenv("RAG_LLM_BACKEND", "fp32")
+LLM_COMPILE = os.getenv("RAG_LLM_COMPILE", "0") == "1"
+LLM_THREADS = int(os.getenv("RAG_LLM_THREADS", "0")) or None
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 VECTOR_STORE_TEXT_PATH = Path("data/vector_store_text")
 VECTOR_STORE_TABLE_PATH = Path("data/vector_store_table")
+# Сохраненный лексический индекс (TF-IDF + BM25), ключ - контрольная сумма корпуса
+LEXICAL_INDEX_PATH = Path("data/lexical_index")
+# Тип FAISS-индекса (flat - точный; ivf_flat / hnsw / ivf_pq - приближенные) и параметры поиска
+FAISS_INDEX_TYPE = os.getenv("RAG_FAISS_INDEX", "flat")
+FAISS_NPROBE = int(os.getenv("RAG_FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH = int(os.getenv("RAG_FAISS_EF_SEARCH", "64"))
+# Семантический кэш ответов (включается явно); используется только для вопросов без истории
+ANSWER_CACHE_ENABLED = os.getenv("RAG_ANSWER_CACHE", "0") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.95"))
+# Параллельный поиск: число потоков и таймауты этапов (секунды)
+RETRIEVAL_WORKERS = int(os.getenv("RAG_RETRIEVAL_WORKERS", "8"))
+DENSE_RETRIEVAL_TIMEOUT = float(os.getenv("RAG_DENSE_TIMEOUT", "30"))
+LEXICAL_RETRIEVAL_TIMEOUT = float(os.getenv("RAG_LEXICAL_TIMEOUT", "10"))
 
 # Глобальные переменные для хранения инициализированных ресурсов (загружаются один раз)
 LLM_RESOURCES: Dict[str, Any] = {
     "tokenizer": None,
     "model": None,
-    "store_text": None,   # TEXT FAISS Store
-    "store_tables": None, # TABLES FAISS Store (Optional)
+    "draft_model": None,  # Черновая модель для спекулятивного декодирования (необязательная)
+    "generator": None,    # GenerationWorker: единственный владелец модели, батчит запросы
+    "prefix_cache": None, # KV-кэш префиксов промпта по чатам
+    "context_packer": None, # Укладка истории и чанков в бюджет токенов
+    "index": None,        # IndexSnapshot: хранилища, BM25 и payloads текущей версии
     "emb_model": None,
     "reranker": None,
-    "searcher": None,
-    "all_payloads": None  # Payloads для BM25
+    "answer_cache": None,  # SemanticAnswerCache (если включен)
 }
 # --------------------
 
+# Версия поисковых индексов. Заменяется целиком одним присваиванием LLM_RESOURCES["index"]:
+# запрос берет ссылку на снимок один раз и дорабатывает на нем, даже если снимок уже заменен
+IndexSnapshot = namedtuple("IndexSnapshot", [
+    "version",
+    "store_version",   # Отпечаток файлов векторных хранилищ
+    "store_text",      # TEXT FAISS Store
+    "store_tables",    # TABLES FAISS Store (Optional)
+    "store_ingest",    # FAISS Store инкрементной индексации data/raw (Optional)
+    "multi_store",     # MultiStore над всеми FAISS-хранилищами
+    "searcher",
+    "all_payloads",    # Payloads для BM25
+    "text_documents",  # Маска текстовых (не табличных) документов BM25
+    "alive_documents", # Маска документов BM25 без tombstones
+    "loaded_at",
+])
+
+# Фоновая перезагрузка индексов: не больше одной одновременно
+INDEX_RELOAD_LOCK = threading.Lock()
+INDEX_RELOAD_STATUS: Dict[str, Any] = {
+    "state": "idle", "error": None, "started_at": None, "duration_s": None, "ingest": None,
+}
+
+# Пул для этапов поиска: FAISS и torch отпускают GIL, BM25 идет параллельно с ними
+RETRIEVAL_EXECUTOR = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+
+
+def stores_fingerprint(paths: List[Path]) -> str:
+    """Отпечаток файлов хранилищ (имя, размер, mtime): меняется при их пересборке."""
+    h = hashlib.sha256()
+    for path in paths:
+        for file in sorted(path.glob("*")) if path.exists() else []:
+            stat = file.stat()
+            h.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return h.hexdigest()[:16]
+
+
+def load_index_snapshot(version: int) -> IndexSnapshot:
+    """Загружает payloads, FAISS-хранилища и лексический индекс с диска (без моделей)."""
+    # Отпечаток до загрузки: если файлы поменяются во время нее, следующая перезагрузка это увидит
+    store_version = stores_fingerprint([VECTOR_STORE_TEXT_PATH, VECTOR_STORE_TABLE_PATH, INGEST_STORE_PATH])
+
+    # 1. Загружаем payloads для TEXT и TABLES
+    # Колоночное хранилище через mmap (собирается из payloads.pkl при первом запуске)
+    text_payloads = PayloadStore.load_or_build(VECTOR_STORE_TEXT_PATH)
+    
+    # Загружаем TABLES (С обработкой отсутствия)
+    table_payloads = None
+    try:
+        # Поле 'type' для BM25 проставляется при сборке, если его не было при индексировании
+        table_payloads = PayloadStore.load_or_build(VECTOR_STORE_TABLE_PATH, default_type="table")
+    except FileNotFoundError:
+        print("Табличный индекс не найден. Инициализация только текстового поиска.")
+
+    # Документы, добавленные инкрементно (ingest.py), идут после офлайн-хранилищ
+    ingest_payloads = load_ingest_payloads(INGEST_STORE_PATH)
+
+    # all_payloads для BM25 (текст + таблицы + инкрементные), без копирования данных
+    all_payloads = ConcatPayloads([text_payloads, table_payloads, ingest_payloads])
+
+    all_text_chunks = all_payloads.texts
+
+    # 2. Загружаем FAISS stores
+    faiss_params = dict(index_type=FAISS_INDEX_TYPE, nprobe=FAISS_NPROBE, ef_search=FAISS_EF_SEARCH)
+    store_text = FAISSStore(VECTOR_STORE_TEXT_PATH, payloads=text_payloads, **faiss_params).load_embds()
+    
+    store_tables = None
+    if table_payloads:
+        # Передаем table_payloads в FAISSStore для инициализации
+        store_tables = FAISSStore(VECTOR_STORE_TABLE_PATH, payloads=table_payloads, **faiss_params).load_embds()
+
+    store_ingest = None
+    if ingest_payloads:
+        # Инкрементный индекс всегда точный IndexIDMap2 (в него дописывают через add_with_ids)
+        store_ingest = FAISSStore(INGEST_STORE_PATH, payloads=ingest_payloads, index_type="flat").load_embds()
+
+    # Фильтры BM25 применяются до подсчета score: use_tables=False и удаленные документы
+    alive_documents = np.concatenate([
+        store.alive_mask() for store in (store_text, store_tables, store_ingest) if store is not None
+    ])
+    text_documents = all_payloads.type_mask({None, "text"}) & alive_documents
+
+    # Все коллекции ищутся пакетно через один MultiStore
+    multi_store = (
+        MultiStore()
+        .add_store("text", store_text)
+        .add_store("table", store_tables, payload_type="table")
+        .add_store("ingest", store_ingest)
+    )
+
+    # 3. Инициализация BM25 (на всех документах)
+    # Индекс загружается с диска и пересобирается, только если изменились payloads
+    searcher = load_or_fit_searcher(all_text_chunks, LEXICAL_INDEX_PATH, n_gram_size=3)
+
+    return IndexSnapshot(
+        version=version,
+        store_version=store_version,
+        store_text=store_text,
+        store_tables=store_tables,
+        store_ingest=store_ingest,
+        multi_store=multi_store,
+        searcher=searcher,
+        all_payloads=all_payloads,
+        text_documents=text_documents,
+        alive_documents=alive_documents,
+        loaded_at=time.time(),
+    )
+
+
+def load_encoder_resource() -> Dict[str, Any]:
+    """Модель эмбеддингов (с кэшем эмбеддингов запросов)."""
+    if ENCODER_BACKEND == "onnx":
+        if OnnxEncoder is None:
+            raise RuntimeError("RAG_ENCODER_BACKEND=onnx, но onnxruntime не установлен")
+        return {"emb_model": CachedEncoder(OnnxEncoder.load_or_export(
+            EMB_MODEL, ONNX_MODELS_PATH / Path(EMB_MODEL).name, ONNX_THREADS
+        ))}
+    return {"emb_model": CachedEncoder(SentenceTransformer(
+        EMB_MODEL,
+        local_files_only=True,
+        device=DEVICE
+    ))}
+
+
+def load_reranker_resource() -> Dict[str, Any]:
+    if ENCODER_BACKEND == "onnx":
+        if OnnxCrossEncoder is None:
+            raise RuntimeError("RAG_ENCODER_BACKEND=onnx, но onnxruntime не установлен")
+        return {"reranker": Reranker(RERANKER_MODEL, model=OnnxCrossEncoder.load_or_export(
+            RERANKER_MODEL, ONNX_MODELS_PATH / Path(RERANKER_MODEL).name, ONNX_THREADS
+        ))}
+    return {"reranker": Reranker(RERANKER_MODEL)}
+
+
+def load_llm_resource() -> Dict[str, Any]:
+    """LLM, черновая модель и все, что от них зависит (воркер генерации, кэши промпта)."""
+    tokenizer, model = load_llm(LLM_MODEL, backend=LLM_BACKEND, compile=LLM_COMPILE, num_threads=LLM_THREADS)
+    draft_model = load_llm(DRAFT_MODEL, backend=LLM_BACKEND)[1] if DRAFT_MODEL else None
+    prefix_cache = PrefixCache()
+    generator = GenerationWorker(
+        tokenizer, model, prefix_cache=prefix_cache, draft_model=draft_model
+    ).start()
+    return {
+        "tokenizer": tokenizer,
+        "model": model,
+        "draft_model": draft_model,
+        "generator": generator,
+        "prefix_cache": prefix_cache,
+        "context_packer": ContextPacker(tokenizer, budget=PROMPT_TOKEN_BUDGET),
+    }
+
+
+def load_index_resource() -> Dict[str, Any]:
+    """Payloads, FAISS stores и BM25 + семантический кэш ответов, привязанный к их версии."""
+    index = load_index_snapshot(version=1)
+    answer_cache = None
+    if ANSWER_CACHE_ENABLED:
+        answer_cache = SemanticAnswerCache(
+            index.store_text.index.d,
+            threshold=ANSWER_CACHE_THRESHOLD,
+            store_version=index.store_version,
+        )
+    return {"index": index, "answer_cache": answer_cache}
+
+
+# Независимые ресурсы грузятся параллельно: torch, FAISS и чтение файлов отпускают GIL
+RESOURCE_LOADERS = {
+    "index": load_index_resource,
+    "encoder": load_encoder_resource,
+    "reranker": load_reranker_resource,
+    "llm": load_llm_resource,
+}
+RESOURCE_STATUS: Dict[str, Dict[str, Any]] = {
+    name: {"state": "pending", "duration_s": None, "error": None} for name in RESOURCE_LOADERS
+}
+
+
+def load_resource(name: str) -> bool:
+    """Загружает один ресурс в LLM_RESOURCES, записывая состояние и время загрузки."""
+    RESOURCE_STATUS[name].update({"state": "loading", "error": None})
+    started_at = time.monotonic()
+    try:
+        LLM_RESOURCES.update(RESOURCE_LOADERS[name]())
+        RESOURCE_STATUS[name]["state"] = "ready"
+        return True
+    except Exception as e:
+        print(f"КРИТИЧЕСКАЯ ОШИБКА: не удалось загрузить RAG-ресурс '{name}': {e}")
+        traceback.print_exc()
+        RESOURCE_STATUS[name].update({"state": "failed", "error": str(e)})
+        return False
+    finally:
+        RESOURCE_STATUS[name]["duration_s"] = round(time.monotonic() - started_at, 3)
+        print(f"RAG-ресурс '{name}': {RESOURCE_STATUS[name]['state']} за {RESOURCE_STATUS[name]['duration_s']} с")
+
 
 def initialize_rag_resources() -> bool:
-    """Инициализирует все тяжелые RAG-ресурсы при запуске сервера."""
+    """Инициализирует все тяжелые RAG-ресурсы (параллельно) и ждет их загрузки."""
     print("--- Инициализация Qwen RAG ресурсов ---")
 
     if load_llm is None:
         print("Не удалось импортировать RAG-модули. Проверьте faiss_store.py и llm.py.")
+        for status in RESOURCE_STATUS.values():
+            status.update({"state": "failed", "error": "RAG-модули не импортированы"})
         return False
 
+    with ThreadPoolExecutor(max_workers=len(RESOURCE_LOADERS), thread_name_prefix="rag-init") as executor:
+        loaded = list(executor.map(load_resource, RESOURCE_LOADERS))
+
+    if all(loaded):
+        print("--- Qwen RAG ресурсы успешно инициализированы ---")
+    return all(loaded)
+
+
+def start_rag_initialization() -> threading.Thread:
+    """Запускает initialize_rag_resources в фоне: сервер принимает запросы сразу."""
+    def run():
+        if not initialize_rag_resources():
+            print("ВНИМАНИЕ: RAG-ресурсы не были загружены. Чат будет недоступен.")
+
+    thread = threading.Thread(target=run, name="rag-init", daemon=True)
+    thread.start()
+    return thread
+
+
+def rag_readiness() -> Dict[str, Any]:
+    """Готовность RAG-пайплайна и состояние загрузки каждого ресурса."""
+    return {
+        "ready": rag_resources_ready(),
+        "resources": {name: dict(status) for name, status in RESOURCE_STATUS.items()},
+    }
+
+
+def reload_index(run_ingest: bool = False) -> Dict[str, Any]:
+    """
+    Запускает в фоне загрузку новой версии индексов (перед ней - ingest.py, если run_ingest)
+    и атомарно подменяет LLM_RESOURCES["index"]. Модели не перезагружаются.
+    Возвращает состояние перезагрузки; если она уже идет, новая не запускается.
+    """
+    if LLM_RESOURCES["index"] is None:
+        raise RuntimeError("RAG-ресурсы не инициализированы")
+    if not INDEX_RELOAD_LOCK.acquire(blocking=False):
+        return index_status()
+    INDEX_RELOAD_STATUS.update({
+        "state": "loading", "error": None, "started_at": time.time(), "duration_s": None, "ingest": None,
+    })
+    threading.Thread(target=swap_index, args=(run_ingest,), name="index-reload", daemon=True).start()
+    return index_status()
+
+
+def swap_index(run_ingest: bool):
+    started_at = time.monotonic()
     try:
-        # 1. Загружаем payloads для TEXT и TABLES
-        with open(VECTOR_STORE_TEXT_PATH / "payloads.pkl", "rb") as f:
-            text_payloads = pickle.load(f)
-        
-        # Загружаем TABLES (С обработкой отсутствия)
-        table_payloads: List[Dict[str, Any]] = []
-        try:
-            with open(VECTOR_STORE_TABLE_PATH / "payloads.pkl", "rb") as f:
-                table_payloads = pickle.load(f)
-                # Добавляем поле 'type' для BM25, если оно не было добавлено при индексировании
-                for payload in table_payloads:
-                    if 'type' not in payload:
-                        payload['type'] = 'table'
-        except FileNotFoundError:
-            print("Табличный индекс не найден. Инициализация только текстового поиска.")
-
-        # all_payloads для BM25 (текст + таблицы)
-        all_payloads = text_payloads + table_payloads 
-
-        all_text_chunks = [p["text"] for p in all_payloads]
-
-        # 2. Загружаем FAISS stores
-        store_text = FAISSStore(VECTOR_STORE_TEXT_PATH, payloads=text_payloads).load_embds()
-        
-        store_tables = None
-        if table_payloads:
-            # Передаем table_payloads в FAISSStore для инициализации
-            store_tables = FAISSStore(VECTOR_STORE_TABLE_PATH, payloads=table_payloads).load_embds()
-
-        # 3. Инициализация BM25 (на всех документах)
-        searcher = TwoStageSearch(n_gram_size=3)
-        searcher.fit(all_text_chunks)
-
-        # 4. Модель эмбеддингов
-        emb_model = SentenceTransformer(
-            "models/multilingual-e5-large",
-            local_files_only=True,
-            device=DEVICE
-        )
+        if run_ingest:
+            # Кодируем чанки моделью сервера, минуя кэш эмбеддингов запросов
+            INDEX_RELOAD_STATUS["ingest"] = ingest(encoder=LLM_RESOURCES["emb_model"].model)
+        index = load_index_snapshot(version=LLM_RESOURCES["index"].version + 1)
+        LLM_RESOURCES["index"] = index
+        # Ответы, собранные по старым документам, больше не валидны
+        if LLM_RESOURCES["answer_cache"] is not None:
+            LLM_RESOURCES["answer_cache"].invalidate(index.store_version)
+        INDEX_RELOAD_STATUS["state"] = "idle"
+        print(f"--- Индексы обновлены до версии {index.version} ---")
+    except Exception as e:
+        # Старый снимок продолжает обслуживать запросы
+        print(f"Ошибка перезагрузки индексов: {e}")
+        traceback.print_exc()
+        INDEX_RELOAD_STATUS.update({"state": "failed", "error": str(e)})
+    finally:
+        INDEX_RELOAD_STATUS["duration_s"] = round(time.monotonic() - started_at, 3)
+        INDEX_RELOAD_LOCK.release()
+
 
-        # 5. Reranker
-        reranker = Reranker("models/cross-encoder/ms-marco-MiniLM-L-6-v2")
-
-        # 6. LLM
-        tokenizer, model = load_llm(LLM_MODEL)
-
-        # 7. Сохраняем все глобально
-        LLM_RESOURCES.update({
-            "tokenizer": tokenizer,
-            "model": model,
-            "store_text": store_text,
-            "store_tables": store_tables, 
-            "emb_model": emb_model,
-            "reranker": reranker,
-            "searcher": searcher,
-            "all_payloads": all_payloads
+def index_status() -> Dict[str, Any]:
+    """Текущая версия индексов и состояние фоновой перезагрузки."""
+    index = LLM_RESOURCES["index"]
+    status = {"reload": dict(INDEX_RELOAD_STATUS)}
+    if index is not None:
+        status.update({
+            "version": index.version,
+            "store_version": index.store_version,
+            "loaded_at": index.loaded_at,
+            "documents": len(index.all_payloads),
+            "stores": {name: store.index.ntotal for name, store in zip(index.multi_store.names, index.multi_store.stores)},
         })
+    return status
+
+
+def dense_retrieval(user_query: str, use_tables: bool, index: IndexSnapshot) -> List[Dict[str, Any]]:
+    """Эмбеддинг запроса + FAISS (текст и, если разрешено, таблицы), без rerank."""
+    return search_candidates(
+        user_query,
+        index.multi_store,
+        LLM_RESOURCES["emb_model"],
+        top_faiss=DENSE_CANDIDATES,
+        store_names=None if use_tables else {"text", "ingest"},
+    )
 
-        print("--- Qwen RAG ресурсы успешно инициализированы ---")
-        return True
 
+def lexical_retrieval(user_query: str, use_tables: bool, index: IndexSnapshot) -> List[Dict[str, Any]]:
+    """TwoStageSearch по всем документам; без таблиц - только по текстовым."""
+    return search_BM25_global(
+        index.searcher,
+        user_query,
+        index.all_payloads,
+        lim_stage2=LEXICAL_CANDIDATES,
+        documents_mask=index.alive_documents if use_tables else index.text_documents,
+    )
+
+
+def stage_result(future, started_at: float, timeout: float, stage: str) -> List[Dict[str, Any]]:
+    """Результат этапа поиска; при таймауте (от started_at) или ошибке этап пропускается."""
+    try:
+        return future.result(timeout=max(started_at + timeout - time.monotonic(), 0))
+    except FutureTimeoutError:
+        print(f"RAG: этап '{stage}' не уложился в {timeout} с, продолжаем без него")
     except Exception as e:
-        print(f"КРИТИЧЕСКАЯ ОШИБКА: Ошибка инициализации RAG: {e}")
+        print(f"RAG: ошибка на этапе '{stage}': {e}")
         traceback.print_exc()
-        return False
+    return []
+
+
+def fuse_and_rerank(
+    user_query: str,
+    dense_candidates: List[Dict[str, Any]],
+    lexical_candidates: List[Dict[str, Any]],
+    store_version: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    RRF-слияние кандидатов FAISS и BM25 и один общий rerank.
+    Оценки reranker кэшируются в пределах store_version снимка, из которого взяты кандидаты.
+    """
+    # Для раннего выхода rerank по отрыву FAISS нужна близость FAISS, а не RRF score.
+    # Кандидат только из BM25 не попал в top FAISS, поэтому его близость не выше последнего из них
+    dense_candidates = [{**c, "faiss_score": c['score']} for c in dense_candidates]
+    dense_floor = min((c['score'] for c in dense_candidates), default=None)
+    lexical_candidates = [{**c, "faiss_score": dense_floor} for c in lexical_candidates]
+    candidates = reciprocal_rank_fusion(
+        [dense_candidates, lexical_candidates], limit=RERANK_CANDIDATES
+    )
+    reranker = LLM_RESOURCES["reranker"]
+    rerank = reranker.rerank_adaptive if RERANK_ADAPTIVE else reranker.rerank
+    final_docs, _ = rerank(user_query, candidates, top_n=CONTEXT_DOCUMENTS, version=store_version)
+    return final_docs
+
+
+def retrieve_documents(
+    user_query: str, use_tables: bool = False, index: Optional[IndexSnapshot] = None
+) -> List[Dict[str, Any]]:
+    """
+    Гибридный поиск: FAISS + BM25 -> RRF -> Reranker. Возвращает финальные документы для контекста.
+    Векторный и лексический этапы независимы и выполняются параллельно.
+    index - снимок индексов (по умолчанию текущий).
+    """
+    # 1. ВЕКТОРНЫЙ ПОИСК и 2. BM25 ПОИСК - одновременно
+    # Оба этапа работают с одним снимком индексов, даже если его подменят посреди запроса
+    index = index or LLM_RESOURCES["index"]
+    started_at = time.monotonic()
+    dense_future = RETRIEVAL_EXECUTOR.submit(dense_retrieval, user_query, use_tables, index)
+    lexical_future = RETRIEVAL_EXECUTOR.submit(lexical_retrieval, user_query, use_tables, index)
+
+    dense_candidates = stage_result(dense_future, started_at, DENSE_RETRIEVAL_TIMEOUT, "vector")
+    lexical_candidates = stage_result(lexical_future, started_at, LEXICAL_RETRIEVAL_TIMEOUT, "bm25")
+
+    # 3. Слияние и единый rerank
+    return fuse_and_rerank(user_query, dense_candidates, lexical_candidates, index.store_version)
+
+
+def format_source_documents(final_docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Подготовка данных о источниках для фронтенда."""
+    return [
+        {
+            "filepath": d["payload"]["source"],
+            "content": d["payload"]["text"],
+            # Добавляем тип, чтобы фронтенд мог стилизовать его
+            "type": d["payload"].get("type", "text") 
+        }
+        for d in final_docs
+    ]
+
+
+def rag_resources_ready() -> bool:
+    return all([
+        LLM_RESOURCES[name]
+        for name in ("tokenizer", "model", "generator", "index", "emb_model", "reranker")
+    ])
 
 
-def get_rag_answer(history: List[tuple], user_query: str, use_tables: bool = False):
+def get_cache_stats() -> Dict[str, Any]:
+    """Метрики кэшей RAG-пайплайна (размер, попадания, промахи, hit rate)."""
+    stats: Dict[str, Any] = {"stem": stem_cache_info()}
+    if LLM_RESOURCES["emb_model"] is not None:
+        stats["query_embeddings"] = LLM_RESOURCES["emb_model"].cache.stats()
+    if LLM_RESOURCES["reranker"] is not None:
+        stats["rerank_scores"] = LLM_RESOURCES["reranker"].cache.stats()
+        stats["rerank_pruning"] = LLM_RESOURCES["reranker"].pruning_stats()
+    if LLM_RESOURCES["context_packer"] is not None:
+        stats["chunk_token_counts"] = LLM_RESOURCES["context_packer"].cache.stats()
+    if LLM_RESOURCES["prefix_cache"] is not None:
+        stats["prefix_kv"] = LLM_RESOURCES["prefix_cache"].stats()
+    if LLM_RESOURCES["answer_cache"] is not None:
+        stats["answers"] = LLM_RESOURCES["answer_cache"].stats()
+    return stats
+
+
+def answer_cache_key(
+    history: List[tuple],
+    user_query: str,
+    final_docs: List[Dict[str, Any]],
+    generation: Optional[Dict[str, Any]] = None,
+    index: Optional[IndexSnapshot] = None,
+):
+    """
+    Эмбеддинг запроса, id чанков и версия хранилищ снимка index для семантического кэша ответов.
+    None, если кэш выключен, у вопроса есть история или в запросе переопределены
+    параметры генерации (ответ зависит от них).
+    """
+    if LLM_RESOURCES["answer_cache"] is None or history or generation:
+        return None
+    # Эмбеддинг запроса уже посчитан при поиске и берется из кэша CachedEncoder
+    query_emb = LLM_RESOURCES["emb_model"].encode([user_query])[0]
+    store_version = (index or LLM_RESOURCES["index"]).store_version
+    return query_emb, [chunk_key(d["payload"]) for d in final_docs], store_version
+
+
+def generation_options(overrides: Optional[Dict[str, Any]] = None) -> GenerationOptions:
+    """Параметры генерации запроса: настройки сервера, переопределенные полями запроса."""
+    overrides = overrides or {}
+    assisted = overrides.get("assisted", ASSISTED_DECODING)
+    if assisted == "draft" and LLM_RESOURCES["draft_model"] is None:
+        assisted = None
+    return GenerationOptions(
+        max_new_tokens=min(overrides.get("max_new_tokens") or MAX_NEW_TOKENS, MAX_NEW_TOKENS),
+        enable_thinking=overrides.get("enable_thinking", ENABLE_THINKING),
+        max_thinking_tokens=overrides.get("max_thinking_tokens", MAX_THINKING_TOKENS),
+        stop_sequences=overrides.get("stop_sequences"),
+        assisted=assisted,
+    )
+
+
+def forget_chat(chat_id: int):
+    """Освобождает KV-кэш удаленного чата."""
+    if LLM_RESOURCES["prefix_cache"] is not None:
+        LLM_RESOURCES["prefix_cache"].drop_chat(chat_id)
+
+
+def get_rag_answer(
+    history: List[tuple],
+    user_query: str,
+    use_tables: bool = False,
+    chat_id: Optional[int] = None,
+    generation: Optional[Dict[str, Any]] = None,
+):
     """
     Основная функция RAG, использующая гибридный поиск по тексту и таблицам.
+    generation - переопределения параметров генерации (см. generation_options).
     """
     tokenizer = LLM_RESOURCES["tokenizer"]
     model = LLM_RESOURCES["model"]
-    store_text = LLM_RESOURCES["store_text"]
-    store_tables = LLM_RESOURCES["store_tables"]
-    emb_model = LLM_RESOURCES["emb_model"]
-    reranker = LLM_RESOURCES["reranker"]
-    searcher = LLM_RESOURCES["searcher"]
-    all_payloads = LLM_RESOURCES["all_payloads"]
+    generator = LLM_RESOURCES["generator"]
     
     try:
         # Проверка, что LLM-ресурсы инициализированы
-        if not all([tokenizer, model, store_text, emb_model, reranker, searcher]):
+        if not rag_resources_ready():
              return {"answer": "RAG ресурсы не инициализированы.", "source_documents": []}
 
-        # 1. ГИБРИДНЫЙ ПОИСК (Vector + Rerank)
-        # Получаем топ-2 документа, прошедших Reranker
-        context_str, payload_docs = get_context_hybrid(
-            user_query,
-            store_text,
-            store_tables,
-            emb_model,
-            reranker,
-            top_faiss=25, 
-            top_final=2,
-            use_tables=use_tables 
-        )
-
-        # 2. BM25 ПОИСК
-        # BM25 ищет по всем документам (text + tables), но в этом контексте 
-        # нам нужно только текстовое дополнение
-        bm25_candidates_raw = search_BM25_global(searcher, user_query, all_payloads)
-        
-        final_docs = []
-        if payload_docs:
-            final_docs.extend(payload_docs)
-            reranker_doc_id = payload_docs[0]['payload'].get('id')
-        else:
-            reranker_doc_id = None
-
-
-        # Находим лучший документ из BM25, который отличается от топ-1 Reranker
-        bm25_doc = None
-        for doc in bm25_candidates_raw:
-            # ID может отсутствовать, если вы его не добавляете при индексировании
-            doc_id = doc["payload"].get("id")
-            
-            # Проверяем, что документ: 
-            # 1) не является тем же, что и топ-1 Reranker ИЛИ топ-1 Reranker отсутствует
-            # 2) если таблицы отключены, то тип должен быть "text"
-            is_distinct = (doc_id is None) or (doc_id != reranker_doc_id)
-            is_allowed = use_tables or (doc["payload"].get("type", "text") == "text")
-
-            if is_distinct and is_allowed:
-                bm25_doc = doc
-                # Добавляем его в финальный список, если он еще не там
-                is_already_in_final = any(
-                    d['payload'].get('id') == bm25_doc['payload'].get('id') 
-                    for d in final_docs
-                )
-                if not is_already_in_final:
-                    final_docs.append(bm25_doc)
-                break
+        # Поиск, кэш ответов и упаковка работают с одним снимком индексов
+        index = LLM_RESOURCES["index"]
+        final_docs = retrieve_documents(user_query, use_tables=use_tables, index=index)
         
         # Если ничего не нашли
         if not final_docs:
              return {"answer": "Я не нашел информацию по вашему запросу.", "source_documents": []}
              
-        # Склеиваем контекст из финальных документов
-        context = "\n\n".join([d["payload"]["text"] for d in final_docs])
+        # Склеиваем контекст из финальных документов в пределах бюджета токенов;
+        # источниками считаются только документы, попавшие в контекст
+        packed = LLM_RESOURCES["context_packer"].pack(
+            history, user_query, final_docs, version=index.store_version
+        )
+        source_documents = format_source_documents(packed.documents)
+        cache_key = answer_cache_key(history, user_query, final_docs, generation, index)
+        if cache_key is not None:
+            cached = LLM_RESOURCES["answer_cache"].lookup(cache_key[0], use_tables, cache_key[1], cache_key[2])
+            if cached is not None:
+                return {"answer": cached["answer"], "source_documents": cached["source_documents"]}
 
         # ГЕНЕРАЦИЯ ОТВЕТА
         answer = generate_answer(
             tokenizer,
             model,
-            history,
+            packed.history,
             user_query,
-            context
+            packed.context,
+            worker=generator,
+            chat_id=chat_id,
+            options=generation_options(generation),
         )
 
-        # Подготовка данных о источниках для фронтенда
-        source_documents = [
-            {
-                "filepath": d["payload"]["source"],
-                "content": d["payload"]["text"],
-                # Добавляем тип, чтобы фронтенд мог стилизовать его
-                "type": d["payload"].get("type", "text") 
-            }
-            for d in final_docs
-        ]
+        if cache_key is not None:
+            LLM_RESOURCES["answer_cache"].add(
+                cache_key[0], use_tables, cache_key[1], answer, source_documents, cache_key[2]
+            )
 
         return {
             "answer": answer,
@@ -219,4 +621,77 @@ def get_rag_answer(history: List[tuple], user_query: str, use_tables: bool = Fal
         return {
             "answer": "Произошла критическая ошибка при обработке запроса RAG.",
             "source_documents": []
-        }
\ No newline at end of file
+        }
+
+
+def get_rag_answer_stream(
+    history: List[tuple],
+    user_query: str,
+    use_tables: bool = False,
+    chat_id: Optional[int] = None,
+    generation: Optional[Dict[str, Any]] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Потоковая версия get_rag_answer. Отдает события:
+    {"type": "sources", ...}, затем {"type": "token", "text": ...} по мере генерации
+    и в конце {"type": "done", "answer": ...} с полным ответом.
+    """
+    tokenizer = LLM_RESOURCES["tokenizer"]
+    model = LLM_RESOURCES["model"]
+    generator = LLM_RESOURCES["generator"]
+
+    def final_event(answer: str) -> Dict[str, Any]:
+        return {"type": "done", "answer": answer}
+
+    try:
+        if not rag_resources_ready():
+            yield final_event("RAG ресурсы не инициализированы.")
+            return
+
+        # Поиск, кэш ответов и упаковка работают с одним снимком индексов
+        index = LLM_RESOURCES["index"]
+        final_docs = retrieve_documents(user_query, use_tables=use_tables, index=index)
+        if not final_docs:
+            yield final_event("Я не нашел информацию по вашему запросу.")
+            return
+
+        # Упаковка до события "sources": источники - только документы, попавшие в контекст
+        packed = LLM_RESOURCES["context_packer"].pack(
+            history, user_query, final_docs, version=index.store_version
+        )
+        source_documents = format_source_documents(packed.documents)
+        cache_key = answer_cache_key(history, user_query, final_docs, generation, index)
+        if cache_key is not None:
+            cached = LLM_RESOURCES["answer_cache"].lookup(cache_key[0], use_tables, cache_key[1], cache_key[2])
+            if cached is not None:
+                yield {"type": "sources", "source_documents": cached["source_documents"]}
+                yield {"type": "token", "text": cached["answer"]}
+                yield final_event(cached["answer"])
+                return
+
+        yield {"type": "sources", "source_documents": source_documents}
+
+        pieces = []
+        answer_stream = generate_answer_stream(
+            tokenizer, model, packed.history, user_query, packed.context,
+            worker=generator, chat_id=chat_id, options=generation_options(generation),
+        )
+        try:
+            for piece in answer_stream:
+                pieces.append(piece)
+                yield {"type": "token", "text": piece}
+        finally:
+            # При закрытии этого генератора (обрыв клиента) генерация отменяется и дожидается остановки
+            answer_stream.close()
+
+        answer = "".join(pieces).strip()
+        if cache_key is not None:
+            LLM_RESOURCES["answer_cache"].add(
+                cache_key[0], use_tables, cache_key[1], answer, source_documents, cache_key[2]
+            )
+        yield final_event(answer)
+
+    except Exception as e:
+        print("RAG ERROR:", e)
+        traceback.print_exc()
+        yield final_event("Произошла критическая ошибка при обработке запроса RAG.")
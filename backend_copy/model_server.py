@@ -0,0 +1,321 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import time
+from queue import Empty, LifoQueue
+from threading import Lock
+from typing import Any, Dict, Iterator, List, Optional
+
+# Один процесс-владелец моделей и индексов (LLM_RESOURCES) на машину; API-воркеры uvicorn
+# ходят к нему по Unix-сокету и не держат собственных копий моделей:
+#   python model_server.py --socket /tmp/rag_model_server.sock
+#   RAG_MODEL_SOCKET=/tmp/rag_model_server.sock uvicorn main:app --workers 4
+MODEL_SOCKET_PATH = "/tmp/rag_model_server.sock"
+CLIENT_POOL_SIZE = 16
+CONNECT_TIMEOUT = 5.0
+# Ответ LLM может идти минуты (очередь генерации), поэтому чтение без жесткого лимита
+READ_TIMEOUT = None
+# Служебные операции отвечают из памяти сервера: зависший сервер не должен держать их бесконечно,
+# таймаут готовности означает "не готов"
+CONTROL_TIMEOUT = 2.0
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Сколько секунд клиент доверяет последнему ответу о готовности (проверяется на каждый запрос чата);
+# недоступность сервера кэшируется дольше, чтобы не ждать CONNECT_TIMEOUT на каждом запросе
+READINESS_TTL = 1.0
+READINESS_FAILURE_TTL = 5.0
+
+# Кадр: заголовок (тип uint8, длина тела uint32, big-endian) + тело JSON в UTF-8
+FRAME_HEADER = struct.Struct(">BI")
+
+# Запросы
+OP_ANSWER = 0x01
+OP_ANSWER_STREAM = 0x02
+OP_FORGET_CHAT = 0x03
+OP_CACHE_STATS = 0x04
+OP_READINESS = 0x05
+OP_INDEX_STATUS = 0x06
+OP_RELOAD_INDEX = 0x07
+# Операции, ждущие генерации ответа (и перезагрузки индексов), читаются без таймаута
+SLOW_OPS = {OP_ANSWER, OP_ANSWER_STREAM, OP_RELOAD_INDEX}
+# Ответы
+MSG_RESULT = 0x81
+MSG_EVENT = 0x82
+MSG_END = 0x83
+MSG_ERROR = 0x84
+
+
+class ModelServerError(RuntimeError):
+    """Ошибка на стороне model-сервера или обрыв соединения с ним."""
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionError("соединение закрыто")
+        received += n
+    return bytes(data)
+
+
+def send_frame(sock: socket.socket, kind: int, body: Any = None):
+    data = b"" if body is None else json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+    sock.sendall(FRAME_HEADER.pack(kind, len(data)) + data)
+
+
+def recv_frame(sock: socket.socket):
+    kind, size = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+    if size > MAX_FRAME_SIZE:
+        raise ConnectionError(f"слишком большой кадр: {size} байт")
+    return kind, json.loads(recv_exact(sock, size)) if size else None
+
+
+# --- Сервер ---
+
+class ModelRequestHandler(socketserver.BaseRequestHandler):
+    """Обрабатывает запросы одного соединения по очереди, пока клиент его не закроет."""
+    def handle(self):
+        import main_rag
+
+        sock = self.request
+        while True:
+            try:
+                op, body = recv_frame(sock)
+            except (ConnectionError, OSError):
+                return
+            try:
+                if op == OP_ANSWER_STREAM:
+                    self.stream_answer(main_rag, body)
+                else:
+                    send_frame(sock, MSG_RESULT, self.call(main_rag, op, body or {}))
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            except Exception as e:
+                print(f"Model server: ошибка запроса {op:#x}: {e}")
+                send_frame(sock, MSG_ERROR, {"error": str(e)})
+
+    @staticmethod
+    def rag_args(body: Dict[str, Any]) -> Dict[str, Any]:
+        return dict(
+            history=[tuple(turn) for turn in body["history"]],
+            user_query=body["query"],
+            use_tables=body.get("use_tables", False),
+            chat_id=body.get("chat_id"),
+            generation=body.get("generation"),
+        )
+
+    def call(self, main_rag, op: int, body: Dict[str, Any]):
+        if op == OP_ANSWER:
+            return main_rag.get_rag_answer(**self.rag_args(body))
+        if op == OP_FORGET_CHAT:
+            return main_rag.forget_chat(body["chat_id"])
+        if op == OP_CACHE_STATS:
+            return main_rag.get_cache_stats()
+        if op == OP_READINESS:
+            return main_rag.rag_readiness()
+        if op == OP_INDEX_STATUS:
+            return main_rag.index_status()
+        if op == OP_RELOAD_INDEX:
+            return main_rag.reload_index(run_ingest=body.get("ingest", False))
+        raise ValueError(f"неизвестная операция {op:#x}")
+
+    def stream_answer(self, main_rag, body: Dict[str, Any]):
+        events = main_rag.get_rag_answer_stream(**self.rag_args(body))
+        try:
+            for event in events:
+                send_frame(self.request, MSG_EVENT, event)
+        finally:
+            # Клиент отключился посреди ответа (send_frame упал): закрытие генератора отменяет
+            # запрос генерации, и close() возвращается, когда строка батча уже освобождена
+            events.close()
+        send_frame(self.request, MSG_END)
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # Поток на соединение: одновременные запросы попадают в общий батч GenerationWorker
+    daemon_threads = True
+
+
+def serve(socket_path: str = MODEL_SOCKET_PATH):
+    import main_rag
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # Сокет доступен только пользователю сервера и его группе
+    old_umask = os.umask(0o117)
+    try:
+        server = ModelServer(socket_path, ModelRequestHandler)
+    finally:
+        os.umask(old_umask)
+    # Запросы принимаются сразу, готовность - через OP_READINESS
+    main_rag.start_rag_initialization()
+    print(f"--- Model server слушает {socket_path} ---")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+# --- Клиент ---
+
+class ModelServerClient:
+    """
+    Клиент model-сервера с тем же API, что и main_rag. Соединения переиспользуются
+    через пул; соединение, оборванное посреди ответа, закрывается, а не возвращается в пул.
+    """
+    def __init__(self, socket_path: str = MODEL_SOCKET_PATH, pool_size: int = CLIENT_POOL_SIZE):
+        self.socket_path = socket_path
+        self.pool = LifoQueue(maxsize=pool_size)
+        self.readiness_lock = Lock()
+        self.readiness: Optional[Dict[str, Any]] = None
+        self.readiness_expires_at = 0.0
+
+    def connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as e:
+            sock.close()
+            raise ModelServerError(f"model-сервер недоступен ({self.socket_path}): {e}") from e
+        return sock
+
+    def acquire(self, op: int):
+        """(соединение, взято ли оно из пула) с таймаутом чтения для операции op."""
+        try:
+            sock, pooled = self.pool.get_nowait(), True
+        except Empty:
+            sock, pooled = self.connect(), False
+        sock.settimeout(READ_TIMEOUT if op in SLOW_OPS else CONTROL_TIMEOUT)
+        return sock, pooled
+
+    def release(self, sock: socket.socket):
+        try:
+            self.pool.put_nowait(sock)
+        except Exception:
+            sock.close()
+
+    def request(self, op: int, body: Optional[Dict[str, Any]] = None):
+        while True:
+            sock, pooled = self.acquire(op)
+            try:
+                send_frame(sock, op, body)
+                kind, result = recv_frame(sock)
+            except (ConnectionError, OSError) as e:
+                # После таймаута ответ еще может прийти - такое соединение не переиспользуется
+                sock.close()
+                # Соединение из пула могло устареть (перезапуск сервера) - повторяем на новом;
+                # обрыв нового соединения и таймаут не повторяем, чтобы не сгенерировать ответ дважды
+                if pooled and not isinstance(e, socket.timeout):
+                    continue
+                raise ModelServerError(f"обрыв соединения с model-сервером: {e}") from e
+            self.release(sock)
+            if kind == MSG_ERROR:
+                raise ModelServerError(result["error"])
+            return result
+
+    def stream(self, op: int, body: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        sock, _ = self.acquire(op)
+        finished = False
+        try:
+            send_frame(sock, op, body)
+            while True:
+                kind, event = recv_frame(sock)
+                if kind == MSG_END:
+                    finished = True
+                    return
+                if kind == MSG_ERROR:
+                    finished = True
+                    raise ModelServerError(event["error"])
+                yield event
+        except (ConnectionError, OSError) as e:
+            raise ModelServerError(f"обрыв соединения с model-сервером: {e}") from e
+        finally:
+            if finished:
+                self.release(sock)
+            else:
+                sock.close()
+
+    @staticmethod
+    def rag_body(history, user_query, use_tables, chat_id, generation) -> Dict[str, Any]:
+        return {
+            "history": [list(turn) for turn in history],
+            "query": user_query,
+            "use_tables": use_tables,
+            "chat_id": chat_id,
+            "generation": generation,
+        }
+
+    # --- API main_rag ---
+
+    def start_rag_initialization(self):
+        """Ресурсы загружает model-сервер; здесь только проверяем, что он доступен."""
+        try:
+            self.request(OP_READINESS)
+        except ModelServerError as e:
+            print(f"ВНИМАНИЕ: {e}. Чат будет недоступен, пока model-сервер не запустится.")
+
+    def get_rag_answer(
+        self,
+        history: List[tuple],
+        user_query: str,
+        use_tables: bool = False,
+        chat_id: Optional[int] = None,
+        generation: Optional[Dict[str, Any]] = None,
+    ):
+        return self.request(OP_ANSWER, self.rag_body(history, user_query, use_tables, chat_id, generation))
+
+    def get_rag_answer_stream(
+        self,
+        history: List[tuple],
+        user_query: str,
+        use_tables: bool = False,
+        chat_id: Optional[int] = None,
+        generation: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        return self.stream(OP_ANSWER_STREAM, self.rag_body(history, user_query, use_tables, chat_id, generation))
+
+    def forget_chat(self, chat_id: int):
+        # Освобождение KV-кэша - оптимизация: удаление чата не должно падать из-за сервера
+        try:
+            self.request(OP_FORGET_CHAT, {"chat_id": chat_id})
+        except ModelServerError as e:
+            print(f"Model server: не удалось освободить KV-кэш чата {chat_id}: {e}")
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        return self.request(OP_CACHE_STATS)
+
+    def rag_readiness(self) -> Dict[str, Any]:
+        try:
+            readiness, ttl = self.request(OP_READINESS), READINESS_TTL
+        except ModelServerError as e:
+            readiness, ttl = {"ready": False, "error": str(e)}, READINESS_FAILURE_TTL
+        with self.readiness_lock:
+            self.readiness, self.readiness_expires_at = readiness, time.monotonic() + ttl
+        return readiness
+
+    def rag_resources_ready(self) -> bool:
+        """Готовность из кэша (READINESS_TTL): без обращения к серверу на каждый запрос."""
+        with self.readiness_lock:
+            if self.readiness is not None and time.monotonic() < self.readiness_expires_at:
+                return self.readiness["ready"]
+        return self.rag_readiness()["ready"]
+
+    def index_status(self) -> Dict[str, Any]:
+        return self.request(OP_INDEX_STATUS)
+
+    def reload_index(self, run_ingest: bool = False) -> Dict[str, Any]:
+        return self.request(OP_RELOAD_INDEX, {"ingest": run_ingest})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Процесс-владелец RAG-моделей для нескольких API-воркеров")
+    parser.add_argument("--socket", default=os.getenv("RAG_MODEL_SOCKET", MODEL_SOCKET_PATH))
+    args = parser.parse_args()
+    serve(args.socket)
@@ -0,0 +1,285 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import torch
+from pathlib import Path
+from sentence_transformers import SentenceTransformer, CrossEncoder
+from transformers import AutoTokenizer
+
+# ONNX Runtime - необязательная зависимость: без нее доступен только torch-бэкенд
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+except ImportError:
+    ort = None
+
+ONNX_MODELS_PATH = Path("models/onnx")
+ONNX_THREADS = os.cpu_count() or 1
+ONNX_OPSET = 17
+ONNX_BATCH_SIZE = 32
+META_FILENAME = "onnx_meta.json"
+
+
+class _EncoderGraph(torch.nn.Module):
+    """SentenceTransformer целиком (трансформер + pooling + normalize) как один граф."""
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(dict(zip(self.input_names, inputs)))["sentence_embedding"]
+
+
+class _CrossEncoderGraph(torch.nn.Module):
+    """Классификатор cross-encoder вместе с его функцией активации."""
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        scores = self.model.activation_fn(self.model.model(**dict(zip(self.input_names, inputs))).logits)
+        return scores[:, 0] if scores.shape[1] == 1 else scores
+
+
+def _model_input_names(tokenizer):
+    return [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in tokenizer.model_input_names]
+
+
+def _export(graph, tokenizer, output_dir, max_length, quantize):
+    """torch -> ONNX (fp32) и, по желанию, динамическое int8-квантование весов MatMul."""
+    if ort is None:
+        raise RuntimeError("onnxruntime не установлен: pip install onnxruntime onnx")
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    input_names = graph.input_names
+    dummy = tokenizer(["пример запроса"], ["пример документа"], return_tensors="pt")
+    fp32_path = output_dir / "model.onnx"
+
+    graph.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            graph,
+            tuple(dummy[name] for name in input_names),
+            str(fp32_path),
+            input_names=input_names,
+            output_names=["output"],
+            dynamic_axes={
+                **{name: {0: "batch", 1: "sequence"} for name in input_names},
+                "output": {0: "batch"},
+            },
+            opset_version=ONNX_OPSET,
+            dynamo=False,
+        )
+
+    model_file = fp32_path.name
+    if quantize:
+        model_file = "model_int8.onnx"
+        quantize_dynamic(
+            str(fp32_path),
+            str(output_dir / model_file),
+            op_types_to_quantize=["MatMul"],
+            per_channel=True,
+            weight_type=QuantType.QInt8,
+        )
+
+    tokenizer.save_pretrained(output_dir)
+    meta = {"model_file": model_file, "input_names": input_names, "max_length": max_length}
+    (output_dir / META_FILENAME).write_text(json.dumps(meta, indent=2))
+    return output_dir
+
+
+def export_encoder(model_path, output_dir, quantize=True):
+    """Экспорт SentenceTransformer в ONNX (с int8-квантованием по умолчанию)."""
+    model = SentenceTransformer(str(model_path), local_files_only=True, device="cpu")
+    graph = _EncoderGraph(model, _model_input_names(model.tokenizer))
+    return _export(graph, model.tokenizer, output_dir, model.max_seq_length, quantize)
+
+
+def export_cross_encoder(model_path, output_dir, quantize=True):
+    """Экспорт CrossEncoder в ONNX; активация (sigmoid и т.п.) входит в граф."""
+    model = CrossEncoder(str(model_path), local_files_only=True, device="cpu")
+    graph = _CrossEncoderGraph(model, _model_input_names(model.tokenizer))
+    return _export(graph, model.tokenizer, output_dir, model.max_length, quantize)
+
+
+def create_session(model_path, num_threads=ONNX_THREADS):
+    """Сессия ONNX Runtime на CPU с фиксированным числом потоков."""
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+
+
+class OnnxModel:
+    """Общая часть: токенизатор, сессия и прогон батчей (отсортированных по длине)."""
+    export = None
+
+    def __init__(self, model_dir, num_threads=ONNX_THREADS):
+        if ort is None:
+            raise RuntimeError("onnxruntime не установлен: pip install onnxruntime onnx")
+        self.model_dir = Path(model_dir)
+        self.meta = json.loads((self.model_dir / META_FILENAME).read_text())
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
+        self.session = create_session(self.model_dir / self.meta["model_file"], num_threads)
+
+    @classmethod
+    def load_or_export(cls, model_path, model_dir, num_threads=ONNX_THREADS):
+        """Загружает экспортированную модель; при первом запуске экспортирует ее."""
+        if not (Path(model_dir) / META_FILENAME).exists():
+            print(f"Экспорт {model_path} в ONNX (int8) -> {model_dir}")
+            cls.export(model_path, model_dir)
+        return cls(model_dir, num_threads)
+
+    def _run(self, texts, text_pairs=None, batch_size=ONNX_BATCH_SIZE):
+        # Сортировка по длине уменьшает паддинг внутри батча
+        order = np.argsort([-len(t) for t in texts], kind="stable")
+        outputs = [None] * len(texts)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            features = self.tokenizer(
+                [texts[i] for i in batch],
+                [text_pairs[i] for i in batch] if text_pairs is not None else None,
+                padding=True,
+                truncation=True,
+                max_length=self.meta["max_length"],
+                return_tensors="np",
+            )
+            inputs = {name: features[name].astype(np.int64) for name in self.meta["input_names"]}
+            for i, out in zip(batch, self.session.run(None, inputs)[0]):
+                outputs[i] = out
+        return outputs
+
+
+class OnnxEncoder(OnnxModel):
+    """Замена SentenceTransformer.encode для запросов на ONNX Runtime."""
+    export = staticmethod(export_encoder)
+
+    def encode(self, sentences, batch_size=ONNX_BATCH_SIZE, **kwargs):
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size=batch_size)[0]
+        if not sentences:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.stack(self._run(list(sentences), batch_size=batch_size)).astype(np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return self.session.get_outputs()[0].shape[-1]
+
+
+class OnnxCrossEncoder(OnnxModel):
+    """Замена CrossEncoder.predict на ONNX Runtime."""
+    export = staticmethod(export_cross_encoder)
+
+    def predict(self, pairs, batch_size=ONNX_BATCH_SIZE, **kwargs):
+        if not pairs:
+            return np.zeros(0, dtype=np.float32)
+        queries, documents = zip(*pairs)
+        return np.asarray(self._run(list(queries), list(documents), batch_size=batch_size), dtype=np.float32)
+
+
+def _latency_ms(fn, items):
+    started = time.perf_counter()
+    for item in items:
+        fn(item)
+    return (time.perf_counter() - started) * 1000 / max(len(items), 1)
+
+
+def encoder_parity(reference, candidate, queries, index=None, top_k=25):
+    """
+    Сравнение двух энкодеров на отложенных запросах: косинус между эмбеддингами,
+    recall@k выдачи FAISS относительно эталона и задержка кодирования одного запроса (мс).
+    """
+    ref_embs = np.asarray(reference.encode(queries), dtype=np.float32)
+    cand_embs = np.asarray(candidate.encode(queries), dtype=np.float32)
+    cosine = np.sum(ref_embs * cand_embs, axis=1) / (
+        np.linalg.norm(ref_embs, axis=1) * np.linalg.norm(cand_embs, axis=1)
+    )
+    report = {
+        "cosine_mean": float(cosine.mean()),
+        "cosine_min": float(cosine.min()),
+        "reference_ms": _latency_ms(lambda q: reference.encode([q]), queries),
+        "candidate_ms": _latency_ms(lambda q: candidate.encode([q]), queries),
+    }
+    if index is not None:
+        _, ref_ids = index.search(ref_embs, top_k)
+        _, cand_ids = index.search(cand_embs, top_k)
+        hits = sum(len(set(found) & set(expected)) for found, expected in zip(cand_ids, ref_ids))
+        report[f"recall@{top_k}"] = hits / ref_ids.size
+    return report
+
+
+def reranker_parity(reference, candidate, queries, candidate_texts, top_n=3):
+    """
+    Сравнение двух cross-encoder: для каждого запроса candidate_texts[i] - его кандидаты.
+    Доля совпадения top_n, максимальное расхождение оценок и задержка на запрос (мс).
+    """
+    pairs = [[(query, text) for text in texts] for query, texts in zip(queries, candidate_texts)]
+    agreement, max_diff = [], 0.0
+    for query_pairs in pairs:
+        if not query_pairs:
+            continue
+        ref_scores = np.asarray(reference.predict(query_pairs), dtype=np.float32)
+        cand_scores = np.asarray(candidate.predict(query_pairs), dtype=np.float32)
+        n = min(top_n, len(query_pairs))
+        ref_top = set(np.argsort(-ref_scores, kind="stable")[:n])
+        cand_top = set(np.argsort(-cand_scores, kind="stable")[:n])
+        agreement.append(len(ref_top & cand_top) / n)
+        max_diff = max(max_diff, float(np.abs(ref_scores - cand_scores).max()))
+    return {
+        f"top{top_n}_agreement": float(np.mean(agreement)) if agreement else 1.0,
+        "max_score_diff": max_diff,
+        "reference_ms": _latency_ms(reference.predict, pairs),
+        "candidate_ms": _latency_ms(candidate.predict, pairs),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Экспорт энкодера и reranker в ONNX (int8) и проверка паритета")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="экспортировать модели в ONNX")
+    export_parser.add_argument("--encoder", default="models/multilingual-e5-large")
+    export_parser.add_argument("--reranker", default="models/cross-encoder/ms-marco-MiniLM-L-6-v2")
+    export_parser.add_argument("--out", type=Path, default=ONNX_MODELS_PATH)
+    export_parser.add_argument("--fp32", action="store_true", help="без int8-квантования")
+
+    parity_parser = subparsers.add_parser("parity", help="сравнить ONNX и torch на отложенных запросах")
+    parity_parser.add_argument("queries", type=Path, help="файл с запросами, по одному на строку")
+    parity_parser.add_argument("--store", type=Path, default=Path("data/vector_store_text"))
+    parity_parser.add_argument("--encoder", default="models/multilingual-e5-large")
+    parity_parser.add_argument("--reranker", default="models/cross-encoder/ms-marco-MiniLM-L-6-v2")
+    parity_parser.add_argument("--onnx", type=Path, default=ONNX_MODELS_PATH)
+    parity_parser.add_argument("--threads", type=int, default=ONNX_THREADS)
+    parity_parser.add_argument("--top-k", type=int, default=25)
+    parity_parser.add_argument("--top-n", type=int, default=3)
+
+    args = parser.parse_args()
+    if args.command == "export":
+        for export, model_path in ((export_encoder, args.encoder), (export_cross_encoder, args.reranker)):
+            output_dir = export(model_path, args.out / Path(model_path).name, quantize=not args.fp32)
+            print(f"{model_path} -> {output_dir}")
+    else:
+        from faiss_store import FAISSStore
+        from payload_store import PayloadStore
+
+        queries = [line.strip() for line in args.queries.read_text(encoding="utf-8").splitlines() if line.strip()]
+        store = FAISSStore(args.store, payloads=PayloadStore.load_or_build(args.store)).load_embds()
+
+        torch_encoder = SentenceTransformer(args.encoder, local_files_only=True, device="cpu")
+        onnx_encoder = OnnxEncoder.load_or_export(args.encoder, args.onnx / Path(args.encoder).name, args.threads)
+        report = encoder_parity(torch_encoder, onnx_encoder, queries, store.index, top_k=args.top_k)
+        print("encoder:", json.dumps(report, indent=2))
+
+        # Кандидаты для reranker - выдача FAISS по эталонным эмбеддингам
+        _, ids = store.index.search(np.asarray(torch_encoder.encode(queries), dtype=np.float32), args.top_k)
+        candidate_texts = [[store.payloads.text(int(i)) for i in row if i != -1] for row in ids]
+        torch_reranker = CrossEncoder(args.reranker, local_files_only=True, device="cpu")
+        onnx_reranker = OnnxCrossEncoder.load_or_export(args.reranker, args.onnx / Path(args.reranker).name, args.threads)
+        report = reranker_parity(torch_reranker, onnx_reranker, queries, candidate_texts, top_n=args.top_n)
+        print("reranker:", json.dumps(report, indent=2))
@@ -0,0 +1,264 @@
+import json
+import os
+import pickle
+import shutil
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+# Версия колоночного формата payload-хранилища
+PAYLOAD_STORE_VERSION = 1
+PAYLOAD_STORE_DIR = "payload_store"
+# Колонки со строками (offsets + UTF-8 blob); type хранится кодами, остальные ключи - json
+STRING_COLUMNS = ("text", "source")
+
+
+class LazySequence(Sequence):
+    """Последовательность, элементы которой вычисляются по индексу при обращении."""
+    def __init__(self, length: int, getter: Callable[[int], Any]):
+        self.length = length
+        self.getter = getter
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.getter(i) for i in range(*idx.indices(self.length))]
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError(idx)
+        return self.getter(int(idx))
+
+
+def write_string_column(path: Path, name: str, values: List[str]):
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    np.save(path / f"{name}_offsets.npy", offsets)
+    with open(path / f"{name}.bin", "wb") as f:
+        for data in encoded:
+            f.write(data)
+
+
+class StringColumn:
+    """Строковая колонка: смещения + UTF-8 blob, оба через mmap."""
+    def __init__(self, path: Path, name: str):
+        self.offsets = np.load(path / f"{name}_offsets.npy", mmap_mode="r")
+        blob_path = path / f"{name}.bin"
+        # np.memmap не умеет отображать пустой файл
+        self.blob = np.memmap(blob_path, dtype=np.uint8, mode="r") if blob_path.stat().st_size else np.zeros(0, np.uint8)
+
+    def view(self, idx: int) -> memoryview:
+        """Байты значения без копирования."""
+        return memoryview(self.blob[self.offsets[idx]:self.offsets[idx + 1]])
+
+    def __getitem__(self, idx: int) -> str:
+        return bytes(self.view(idx)).decode("utf-8")
+
+
+class PayloadStore:
+    """
+    Payloads чанков в колоночном формате, отображаемом в память:
+    text / source - смещения + UTF-8 blob, type - коды uint8, id - int64 или строки,
+    прочие ключи - json. Несколько процессов делят страницы через page cache ОС.
+    """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path / "meta.json", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.length = self.meta["length"]
+        self.types = self.meta["types"]
+        self.columns = {name: StringColumn(self.path, name) for name in STRING_COLUMNS}
+        self.type_codes = np.load(self.path / "type_codes.npy", mmap_mode="r")
+        self.id_kind = self.meta["id_kind"]
+        if self.id_kind == "int":
+            self.ids = np.load(self.path / "ids.npy", mmap_mode="r")
+        elif self.id_kind == "str":
+            self.ids = StringColumn(self.path, "ids")
+        else:
+            self.ids = None
+        self.extra = StringColumn(self.path, "extra") if self.meta["has_extra"] else None
+
+    @staticmethod
+    def build(payloads: List[Dict[str, Any]], path: Path, source_stamp: Optional[dict] = None, default_type: Optional[str] = None):
+        """Записывает payloads в каталог path (через временный каталог и rename)."""
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+
+        for name in STRING_COLUMNS:
+            write_string_column(tmp_path, name, [str(p.get(name, "")) for p in payloads])
+
+        types = [None]
+        type_codes = np.zeros(len(payloads), dtype=np.uint8)
+        for i, payload in enumerate(payloads):
+            payload_type = payload.get("type", default_type)
+            if payload_type not in types:
+                types.append(payload_type)
+            type_codes[i] = types.index(payload_type)
+        np.save(tmp_path / "type_codes.npy", type_codes)
+
+        ids = [p.get("id") for p in payloads]
+        if all(i is None for i in ids):
+            id_kind = "none"
+        elif all(isinstance(i, (int, np.integer)) and not isinstance(i, bool) for i in ids):
+            id_kind = "int"
+            np.save(tmp_path / "ids.npy", np.asarray(ids, dtype=np.int64))
+        else:
+            id_kind = "str"
+            write_string_column(tmp_path, "ids", ["" if i is None else str(i) for i in ids])
+
+        reserved = set(STRING_COLUMNS) | {"type", "id"}
+        extras = [
+            {k: v for k, v in p.items() if k not in reserved}
+            for p in payloads
+        ]
+        has_extra = any(extras)
+        if has_extra:
+            write_string_column(
+                tmp_path, "extra",
+                [json.dumps(extra, ensure_ascii=False, default=str) for extra in extras],
+            )
+
+        meta = {
+            "version": PAYLOAD_STORE_VERSION,
+            "length": len(payloads),
+            "types": types,
+            "id_kind": id_kind,
+            "has_extra": has_extra,
+            "keys": sorted({k for p in payloads for k in p}),
+            "source": source_stamp,
+        }
+        with open(tmp_path / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Другой процесс успел собрать path между rmtree и rename - используем его результат
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not (path / "meta.json").exists():
+                raise
+
+    @classmethod
+    def load_or_build(cls, vector_store_path: Path, default_type: Optional[str] = None) -> "PayloadStore":
+        """
+        Открывает payload_store хранилища; (пере)собирает его из payloads.pkl,
+        если его нет или payloads.pkl изменился.
+        """
+        vector_store_path = Path(vector_store_path)
+        path = vector_store_path / PAYLOAD_STORE_DIR
+        pickle_path = vector_store_path / "payloads.pkl"
+
+        source_stamp = None
+        if pickle_path.exists():
+            stat = pickle_path.stat()
+            source_stamp = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "default_type": default_type}
+
+        try:
+            store = cls(path)
+            if store.meta.get("version") == PAYLOAD_STORE_VERSION and (
+                source_stamp is None or store.meta.get("source") == source_stamp
+            ):
+                return store
+        except FileNotFoundError:
+            if source_stamp is None:
+                raise
+
+        with open(pickle_path, "rb") as f:
+            payloads = pickle.load(f)
+        cls.build(payloads, path, source_stamp=source_stamp, default_type=default_type)
+        return cls(path)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def text(self, idx: int) -> str:
+        return self.columns["text"][idx]
+
+    def text_view(self, idx: int) -> memoryview:
+        return self.columns["text"].view(idx)
+
+    def type(self, idx: int) -> Optional[str]:
+        return self.types[self.type_codes[idx]]
+
+    def type_mask(self, types) -> np.ndarray:
+        """Булев массив: тип чанка входит в types (None - чанк без типа)."""
+        codes = [code for code, payload_type in enumerate(self.types) if payload_type in types]
+        return np.isin(self.type_codes, codes)
+
+    def id(self, idx: int):
+        if self.id_kind == "int":
+            return int(self.ids[idx])
+        if self.id_kind == "str":
+            return self.ids[idx] or None
+        return None
+
+    @property
+    def texts(self) -> LazySequence:
+        return LazySequence(self.length, self.text)
+
+    def __getitem__(self, idx) -> Dict[str, Any]:
+        """Собирает payload-словарь чанка (новый объект при каждом обращении)."""
+        idx = int(idx)
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError(idx)
+        payload: Dict[str, Any] = {}
+        if self.extra is not None:
+            payload.update(json.loads(self.extra[idx]))
+        payload["text"] = self.text(idx)
+        payload["source"] = self.columns["source"][idx]
+        payload_type = self.type(idx)
+        if payload_type is not None:
+            payload["type"] = payload_type
+        if self.id_kind != "none":
+            payload["id"] = self.id(idx)
+        return payload
+
+    def __iter__(self):
+        for idx in range(self.length):
+            yield self[idx]
+
+
+class ConcatPayloads(Sequence):
+    """Несколько payload-хранилищ как одна последовательность (индексы идут подряд)."""
+    def __init__(self, stores: List[Any]):
+        self.stores = [store for store in stores if store is not None]
+        self.offsets = np.cumsum([0] + [len(store) for store in self.stores])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def locate(self, idx: int):
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        store_idx = int(np.searchsorted(self.offsets, idx, side="right") - 1)
+        return self.stores[store_idx], idx - int(self.offsets[store_idx])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        store, local_idx = self.locate(idx)
+        return store[local_idx]
+
+    def text(self, idx: int) -> str:
+        store, local_idx = self.locate(idx)
+        return store.text(local_idx)
+
+    def type_mask(self, types) -> np.ndarray:
+        return np.concatenate([store.type_mask(types) for store in self.stores] or [np.zeros(0, dtype=bool)])
+
+    @property
+    def texts(self) -> LazySequence:
+        return LazySequence(len(self), self.text)
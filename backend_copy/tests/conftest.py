@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Модули бэкенда лежат плоско в backend_copy и импортируются по имени
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, Overloaded
+
+
+async def wait_until(condition):
+    while not condition():
+        await asyncio.sleep(0)
+
+
+def run_queue(controller, users):
+    """
+    Ставит в очередь по запросу на каждого из users (слот занят) и освобождает слоты по одному.
+    Возвращает пользователей в порядке допуска.
+    """
+    async def scenario():
+        admitted = []
+
+        async def request(user_id):
+            await controller.acquire(user_id)
+            admitted.append(user_id)
+
+        await controller.acquire("holder")
+        tasks = []
+        for user_id in users:
+            tasks.append(asyncio.create_task(request(user_id)))
+            await wait_until(lambda: controller.queued == len(tasks))
+        for expected in range(1, len(users) + 1):
+            controller.release(1.0)
+            await wait_until(lambda: len(admitted) == expected)
+        await asyncio.gather(*tasks)
+        return admitted
+
+    return asyncio.run(scenario())
+
+
+def test_free_slot_is_taken_without_queueing():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=2)
+        assert await controller.acquire("a") == pytest.approx(0, abs=0.01)
+        await controller.acquire("a")
+        return controller.stats()
+
+    stats = asyncio.run(scenario())
+    assert (stats["running"], stats["queued"], stats["admitted"]) == (2, 0, 2)
+
+
+def test_release_wakes_users_round_robin():
+    controller = AdmissionController(max_concurrency=1, max_queued_per_user=3)
+    admitted = run_queue(controller, ["a", "a", "a", "b", "c", "b"])
+    # Пачка запросов "a" не задерживает "b" и "c"
+    assert admitted == ["a", "b", "c", "a", "b", "a"]
+    assert (controller.running, controller.queued, controller.waiting) == (1, 0, {})
+
+
+def test_rejects_over_user_and_queue_limits():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, max_queue=4, max_queued_per_user=2)
+        await controller.acquire("holder")
+        tasks = [asyncio.create_task(controller.acquire(user_id)) for user_id in ("a", "a", "b")]
+        await wait_until(lambda: controller.queued == 3)
+        with pytest.raises(Overloaded) as user_limit:
+            await controller.acquire("a")
+
+        tasks.append(asyncio.create_task(controller.acquire("c")))
+        await wait_until(lambda: controller.queued == 4)
+        with pytest.raises(Overloaded) as queue_full:
+            await controller.acquire("d")
+
+        for _ in tasks:
+            controller.release(2.0)
+        await asyncio.gather(*tasks)
+        return controller, user_limit.value, queue_full.value
+
+    controller, user_limit, queue_full = asyncio.run(scenario())
+    assert user_limit.status_code == 429
+    assert queue_full.status_code == 503
+    # Retry-After: без истории - DEFAULT_SERVICE_TIME на каждое место в очереди, включая свое
+    assert (user_limit.retry_after, queue_full.retry_after) == (40, 50)
+    assert controller.counters["rejected_user_limit"] == 1
+    assert controller.counters["rejected_queue_full"] == 1
+    # После отказов очередь не испорчена: все принятые запросы получили слот
+    assert (controller.running, controller.queued) == (1, 0)
+    assert controller.retry_after() == 2
+
+
+def test_queue_timeout_and_cancel_leave_the_queue():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, queue_timeout=0.05)
+        await controller.acquire("holder")
+        with pytest.raises(Overloaded) as timed_out:
+            await controller.acquire("a")
+
+        waiter = asyncio.create_task(controller.acquire("b"))
+        await wait_until(lambda: controller.queued == 1)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+        controller.release()
+        return controller, timed_out.value
+
+    controller, timed_out = asyncio.run(scenario())
+    assert timed_out.status_code == 503
+    assert controller.counters["timed_out"] == 1
+    assert (controller.running, controller.queued, controller.waiting) == (0, 0, {})
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+from answer_cache import SemanticAnswerCache
+
+
+def embedding(seed, dim=8):
+    return np.random.default_rng(seed).normal(size=dim).astype(np.float32)
+
+
+def test_lookup_by_similarity_and_chunks():
+    cache = SemanticAnswerCache(dim=8, store_version="v1")
+    cache.add(embedding(0), False, [1, 2], "ответ", [{"filepath": "a"}], "v1")
+
+    hit = cache.lookup(embedding(0) * 2, False, [2, 1], "v1")
+    assert hit["answer"] == "ответ" and hit["similarity"] == pytest.approx(1.0)
+    assert cache.lookup(embedding(0), True, [1, 2], "v1") is None
+    assert cache.lookup(embedding(0), False, [1, 3], "v1") is None
+    assert cache.lookup(embedding(1), False, [1, 2], "v1") is None
+
+
+def test_answer_from_replaced_snapshot_is_not_cached():
+    cache = SemanticAnswerCache(dim=8, store_version="v1")
+    # Запрос нашел документы на снимке v1, а пока шла генерация, индексы заменили на v2
+    assert cache.lookup(embedding(0), False, [1], "v1") is None
+    cache.invalidate("v2")
+    cache.add(embedding(0), False, [1], "устаревший ответ", [], "v1")
+
+    assert cache.stats()["size"] == 0
+    assert cache.lookup(embedding(0), False, [1], "v2") is None
+    # Запрос, начатый на старом снимке, не получает ответов нового
+    cache.add(embedding(0), False, [1], "новый ответ", [], "v2")
+    assert cache.lookup(embedding(0), False, [1], "v1") is None
+    assert cache.lookup(embedding(0), False, [1], "v2")["answer"] == "новый ответ"
+
+
+def test_oldest_entry_evicted():
+    cache = SemanticAnswerCache(dim=8, max_entries=2)
+    for seed in range(3):
+        cache.add(embedding(seed), False, [seed], f"ответ {seed}", [])
+    assert cache.stats()["size"] == 2
+    assert cache.lookup(embedding(0), False, [0]) is None
+    assert cache.lookup(embedding(2), False, [2])["answer"] == "ответ 2"
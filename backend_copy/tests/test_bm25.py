@@ -0,0 +1,138 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import BM25
+from BM25 import TwoStageSearch, SearchBM25, SearchTFIDF, extend_searcher, load_or_fit_searcher
+
+DOCUMENTS = [
+    "Договор аренды помещения заключается сроком на один год",
+    "Оплата аренды производится ежемесячно до десятого числа",
+    "Арендатор обязан поддерживать помещение в надлежащем состоянии",
+    "Штраф за просрочку оплаты составляет один процент в день",
+    "Договор может быть расторгнут досрочно по соглашению сторон",
+    "Помещение передается арендатору по акту приема-передачи",
+    "Токарный станок предназначен для обработки металлических заготовок",
+    "Фреза и сверло используются при обработке деталей из сплава",
+]
+NEW_DOCUMENTS = [
+    "Квантовый компьютер использует кубиты вместо битов",
+    "Станок с числовым программным управлением обрабатывает детали точнее",
+]
+QUERIES = ["оплата аренды помещения", "досрочное расторжение договора", "обработка деталей на станке", "квантовый кубит"]
+
+
+def baseline_bm25_scores(documents, query):
+    """Исходный построчный BM25 (до перехода на CSR): score каждого документа."""
+    documents_words = BM25.bm25_documents_to_index(documents)
+    tf = [Counter(words) for words in documents_words]
+    containing = Counter(word for doc_tf in tf for word in doc_tf)
+    idf = {
+        word: BM25.idf_bm25(number_documents_containing_ngram=count, total_documents=len(documents))
+        for word, count in containing.items()
+    }
+    avg_document_length = sum(len(words) for words in documents_words) / len(documents_words)
+    scores = {}
+    for i, document_tf in enumerate(tf):
+        document_length = sum(document_tf.values())
+        scores[i] = sum(
+            BM25.bm25_score(
+                idf.get(word, 1e-6),
+                document_tf.get(word, 1e-6),
+                document_length=document_length,
+                average_document_length=avg_document_length,
+            )
+            for word in BM25.bm25_query_to_wrods(query)
+        )
+    return scores
+
+
+def baseline_tfidf_scores(documents, query):
+    """Исходный TF-IDF по n-граммам: документы с ненулевым score."""
+    idx_scores = BM25.search_tf_idf(BM25.documents_to_index(documents), query, limit=len(documents))
+    return {idx: score for idx, score in idx_scores if score > 0}
+
+
+def as_dict(idx_scores):
+    return {int(idx): float(score) for idx, score in idx_scores}
+
+
+def assert_scores_equal(actual, expected):
+    assert actual.keys() == expected.keys()
+    for idx, score in expected.items():
+        assert actual[idx] == pytest.approx(score, rel=1e-9, abs=1e-12)
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_bm25_matches_baseline(query):
+    index = SearchBM25()
+    index.fit(DOCUMENTS)
+    assert_scores_equal(as_dict(index.search(query, limit=len(DOCUMENTS))), baseline_bm25_scores(DOCUMENTS, query))
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_tfidf_matches_baseline(query):
+    index = SearchTFIDF()
+    index.fit(DOCUMENTS)
+    assert_scores_equal(as_dict(index.search(query, limit=len(DOCUMENTS))), baseline_tfidf_scores(DOCUMENTS, query))
+
+
+def test_add_documents_equals_refit():
+    documents = DOCUMENTS + NEW_DOCUMENTS
+    full = TwoStageSearch()
+    full.fit(documents)
+    incremental = TwoStageSearch()
+    incremental.fit(DOCUMENTS)
+    incremental.add_documents(documents)
+
+    for name in SearchTFIDF.INDEX_ARRAYS:
+        np.testing.assert_allclose(getattr(incremental.tfidf_index, name), getattr(full.tfidf_index, name))
+    for name in SearchBM25.INDEX_ARRAYS:
+        np.testing.assert_allclose(getattr(incremental.bm25_index, name), getattr(full.bm25_index, name))
+    assert incremental.tfidf_index.vocabulary == full.tfidf_index.vocabulary
+    assert incremental.bm25_index.vocabulary == full.bm25_index.vocabulary
+    for query in QUERIES:
+        assert incremental.search(query, 10, 5) == full.search(query, 10, 5)
+
+
+def test_search_batch_equals_search():
+    searcher = TwoStageSearch()
+    searcher.fit(DOCUMENTS)
+    mask = np.arange(len(DOCUMENTS)) % 2 == 0
+    for documents_mask in (None, mask):
+        batch = searcher.search_batch(QUERIES, limit_stage1=10, limit_stage2=3, documents_mask=documents_mask)
+        single = [searcher.search(query, 10, 3, documents_mask=documents_mask) for query in QUERIES]
+        assert batch == single
+
+    index = SearchBM25()
+    index.fit(DOCUMENTS)
+    assert index.search_bm25_batch(QUERIES, limit=4) == [index.search(query, limit=4) for query in QUERIES]
+
+
+def test_save_load_round_trip(tmp_path):
+    fitted = load_or_fit_searcher(DOCUMENTS, tmp_path)
+    (index_path,) = [p for p in tmp_path.iterdir() if p.is_dir()]
+
+    loaded = load_or_fit_searcher(DOCUMENTS, tmp_path)
+    # Массивы загруженного индекса отображаются в память, а не пересчитываются
+    assert isinstance(loaded.bm25_index.weights, np.memmap)
+    for query in QUERIES:
+        assert loaded.search(query, 10, 5) == fitted.search(query, 10, 5)
+
+    # Другой корпус - другая контрольная сумма: индекс пересобирается, старая версия удаляется
+    documents = DOCUMENTS + NEW_DOCUMENTS
+    extended = extend_searcher(DOCUMENTS, documents, tmp_path)
+    assert [p.name for p in tmp_path.iterdir() if p.is_dir()] != [index_path.name]
+    reloaded = load_or_fit_searcher(documents, tmp_path)
+    assert isinstance(reloaded.bm25_index.weights, np.memmap)
+    for query in QUERIES:
+        assert reloaded.search(query, 10, 5) == extended.search(query, 10, 5)
+
+
+def test_load_rejects_other_corpus(tmp_path):
+    searcher = TwoStageSearch()
+    searcher.fit(DOCUMENTS)
+    searcher.save(tmp_path / "index", checksum=BM25.corpus_checksum(DOCUMENTS))
+    assert TwoStageSearch.load(tmp_path / "index", DOCUMENTS, checksum=BM25.corpus_checksum(DOCUMENTS)) is not None
+    assert TwoStageSearch.load(tmp_path / "index", DOCUMENTS[:-1], checksum=BM25.corpus_checksum(DOCUMENTS[:-1])) is None
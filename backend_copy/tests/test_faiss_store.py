@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+import pytest
+
+faiss = pytest.importorskip("faiss")
+
+from faiss_store import FAISSStore, index_filename, top_k_columns
+
+
+def write_store(path, n_vectors, dim=8, seed=0):
+    embeddings = np.random.default_rng(seed).normal(size=(n_vectors, dim)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.save(path / "embeddings.npy", embeddings)
+    index = faiss.IndexFlatIP(dim)
+    index.add(embeddings)
+    faiss.write_index(index, str(path / "faiss.index"))
+    return [{"text": f"чанк {i}", "id": i} for i in range(n_vectors)]
+
+
+def test_approximate_index_rebuilt_when_embeddings_change(tmp_path):
+    payloads = write_store(tmp_path, 300)
+    store = FAISSStore(tmp_path, payloads=payloads, index_type="hnsw").load_embds()
+    index_path = tmp_path / index_filename("hnsw")
+    built_at = os.stat(index_path).st_mtime_ns
+
+    FAISSStore(tmp_path, payloads=payloads, index_type="hnsw").load_embds()
+    assert os.stat(index_path).st_mtime_ns == built_at
+
+    payloads = write_store(tmp_path, 400, seed=1)
+    store = FAISSStore(tmp_path, payloads=payloads, index_type="hnsw").load_embds()
+    assert store.index.ntotal == 400
+
+
+def test_flat_index_is_never_rebuilt(tmp_path):
+    payloads = write_store(tmp_path, 50)
+    original = (tmp_path / "faiss.index").read_bytes()
+    with pytest.raises(ValueError):
+        FAISSStore(tmp_path, index_type="flat").build_index()
+    assert (tmp_path / "faiss.index").read_bytes() == original
+
+    # Несовпадение с payloads - ошибка, а не пересборка исходного индекса
+    with pytest.raises(RuntimeError):
+        FAISSStore(tmp_path, payloads=payloads[:10], index_type="flat").load_embds()
+    assert (tmp_path / "faiss.index").read_bytes() == original
+
+
+@pytest.mark.parametrize("limit", [1, 3, 7, 12, 20])
+def test_top_k_columns_matches_stable_argsort(limit):
+    rng = np.random.default_rng(limit)
+    # Много равных score и пропусков (-inf), как при слиянии нескольких хранилищ
+    scores = rng.integers(0, 4, size=(6, 12)).astype(np.float32)
+    scores[rng.random(scores.shape) < 0.2] = -np.inf
+    expected = np.argsort(-scores, axis=1, kind="stable")[:, :limit]
+    assert np.array_equal(top_k_columns(scores, limit), expected)
+
+
+class CountingModel:
+    def __init__(self):
+        self.pairs = []
+
+    def predict(self, pairs):
+        self.pairs.extend(pairs)
+        return [float(len(text)) for _, text in pairs]
+
+
+def test_rerank_scores_cached_per_store_version():
+    from faiss_store import Reranker
+
+    model = CountingModel()
+    reranker = Reranker(None, model=model)
+    old = [{"payload": {"text": "старый текст", "id": 1}, "score": 0.5}]
+    new = [{"payload": {"text": "новый, более длинный текст", "id": 1}, "score": 0.5}]
+
+    assert reranker.score("вопрос", old, "v1") == [12.0]
+    assert reranker.score("вопрос ", old, "v1") == [12.0]
+    assert len(model.pairs) == 1
+    # Тот же id в новой версии хранилищ - другой текст, старая оценка не переиспользуется
+    assert reranker.score("вопрос", new, "v2") == [26.0]
+    # Запросы по старому снимку по-прежнему попадают в свой кэш
+    assert reranker.score("вопрос", old, "v1") == [12.0]
+    assert len(model.pairs) == 2
@@ -0,0 +1,199 @@
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+tokenizers = pytest.importorskip("tokenizers")
+
+import llm
+from llm import GenerationOptions, GenerationRequest, GenerationWorker, PrefixCache
+
+CHARS = list("абвгдеёжзийклмнопрстуфхцчшщъыьэюя abcdefghijklmnopqrstuvwxyz0123456789.,:?!<>/\n_-")
+SPECIALS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<think>", "</think>"]
+CHAT_TEMPLATE = (
+    "{% for m in messages %}<|im_start|>{{ m.role }}\n{{ m.content }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n"
+    "{% if enable_thinking is defined and enable_thinking is false %}<think>\n\n</think>\n\n{% endif %}{% endif %}"
+)
+
+
+@pytest.fixture(scope="module")
+def tiny_llm():
+    """Посимвольный токенизатор и случайно инициализированная Qwen3 на несколько десятков тысяч весов."""
+    from tokenizers import AddedToken, Tokenizer, decoders, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast, Qwen3Config, Qwen3ForCausalLM
+
+    vocab = {token: i for i, token in enumerate(SPECIALS + CHARS + ["[UNK]"])}
+    backend = Tokenizer(models.WordLevel(vocab, unk_token="[UNK]"))
+    backend.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    backend.decoder = decoders.Fuse()
+    backend.add_special_tokens([AddedToken(token, special=True) for token in SPECIALS[:3]])
+    backend.add_tokens([AddedToken(token, special=False) for token in SPECIALS[3:]])
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend, eos_token="<|im_end|>", pad_token="<|endoftext|>", unk_token="[UNK]"
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    torch.manual_seed(0)
+    config = Qwen3Config(
+        vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, head_dim=16, max_position_embeddings=4096,
+        # EOS для генерации задает get_generation_config, а не конфиг модели (см. without_eos)
+        eos_token_id=None, pad_token_id=tokenizer.pad_token_id,
+    )
+    model = Qwen3ForCausalLM(config).to(llm.DEVICE).eval()
+    return tokenizer, model
+
+
+def prompt(tokenizer, question, history=(), context="контекст"):
+    return llm.build_prompt(tokenizer, list(history), question, context)
+
+
+def reference_answer(tokenizer, model, text, max_new_tokens, stop_token_ids=None):
+    request = GenerationRequest(
+        text, max_new_tokens=max_new_tokens,
+        stop_token_ids=[tokenizer.eos_token_id] if stop_token_ids is None else stop_token_ids,
+    )
+    llm.generate_single(tokenizer, model, request)
+    return request.future.result()
+
+
+@pytest.fixture
+def without_eos(monkeypatch):
+    """model.generate не останавливает строку на EOS: длина ответа задается только лимитом запроса."""
+    get_generation_config = llm.get_generation_config
+
+    def config_without_eos(tokenizer):
+        config = get_generation_config(tokenizer)
+        config.eos_token_id = None
+        return config
+
+    monkeypatch.setattr(llm, "get_generation_config", config_without_eos)
+
+
+def wait_for(condition, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "условие не выполнилось"
+        time.sleep(0.005)
+
+
+def test_batch_matches_single_generation(tiny_llm):
+    tokenizer, model = tiny_llm
+    # Промпты разной длины: в батче они выравниваются левым паддингом
+    prompts = [
+        prompt(tokenizer, "да"),
+        prompt(tokenizer, "как оформить возврат товара?", [("user", "привет"), ("ai", "здравствуйте")]),
+        prompt(tokenizer, "сроки", context="длинный контекст " * 10),
+    ]
+    limits = [12, 30, 20]
+    worker = GenerationWorker(tokenizer, model, max_batch_size=4, max_wait=0.5).start()
+    try:
+        futures = [worker.submit(text, max_new_tokens=limit) for text, limit in zip(prompts, limits)]
+        answers = [future.result(timeout=60) for future in futures]
+    finally:
+        worker.stop()
+
+    assert worker.stats["max_batch_size"] == len(prompts)
+    assert answers == [reference_answer(tokenizer, model, text, limit) for text, limit in zip(prompts, limits)]
+    # Вызывающий поток не видит глобальных изменений токенизатора
+    assert tokenizer.padding_side == "right"
+
+
+def test_short_request_finishes_before_batch(tiny_llm, without_eos):
+    tokenizer, model = tiny_llm
+    worker = GenerationWorker(tokenizer, model, max_batch_size=4, max_wait=0.5).start()
+    try:
+        # Без стоп-токенов и EOS длинный запрос генерирует все max_new_tokens
+        long = worker.submit(prompt(tokenizer, "длинный ответ"), max_new_tokens=400, stop_token_ids=[])
+        short = worker.submit(prompt(tokenizer, "коротко"), max_new_tokens=3, stop_token_ids=[])
+        short.result(timeout=60)
+        assert not long.done()
+        long.result(timeout=120)
+    finally:
+        worker.stop()
+
+
+def test_cancelled_request_leaves_batch(tiny_llm, without_eos):
+    tokenizer, model = tiny_llm
+    worker = GenerationWorker(tokenizer, model, max_batch_size=4, max_wait=0.5).start()
+    try:
+        kept = GenerationRequest(prompt(tokenizer, "первый"), max_new_tokens=400, stop_token_ids=[])
+        dropped = GenerationRequest(prompt(tokenizer, "второй"), max_new_tokens=400, stop_token_ids=[])
+        worker.submit_request(kept)
+        worker.submit_request(dropped)
+        wait_for(lambda: len(dropped.token_ids) >= 2)
+
+        dropped.cancel()
+        dropped.future.result(timeout=60)
+        assert len(dropped.token_ids) < dropped.max_new_tokens
+        assert not kept.future.done()
+        kept.future.result(timeout=120)
+        assert len(kept.token_ids) == kept.max_new_tokens
+
+        # Отмененный до начала генерации запрос не попадает в модель
+        queued = GenerationRequest(prompt(tokenizer, "третий"), max_new_tokens=400, stop_token_ids=[])
+        queued.cancel()
+        assert worker.submit_request(queued).result(timeout=60) == ""
+        assert queued.token_ids == []
+    finally:
+        worker.stop()
+
+
+def test_closed_stream_cancels_generation(tiny_llm, without_eos, monkeypatch):
+    tokenizer, model = tiny_llm
+    worker = GenerationWorker(tokenizer, model).start()
+    requests = []
+    submit_request = worker.submit_request
+
+    def submit_without_stop(request):
+        # Длину ответа задает только лимит: отмена - единственная причина остановиться раньше
+        request.stop_token_ids = set()
+        requests.append(request)
+        return submit_request(request)
+
+    monkeypatch.setattr(worker, "submit_request", submit_without_stop)
+
+    class TokenStreamer(transformers.TextIteratorStreamer):
+        """Отдает каждый токен сразу: случайная модель почти не генерирует пробелов."""
+        def put(self, value):
+            self.on_finalized_text(self.tokenizer.decode(value.tolist()))
+
+    monkeypatch.setattr(llm, "TextIteratorStreamer", TokenStreamer)
+    options = GenerationOptions(max_new_tokens=2000, enable_thinking=False)
+    try:
+        stream = llm.generate_answer_stream(tokenizer, model, [], "вопрос", "контекст", worker=worker, options=options)
+        assert next(stream)
+        # Как при отключении клиента: close() возвращается, когда строка генерации уже освобождена
+        stream.close()
+        (request,) = requests
+        assert request.cancelled.is_set() and request.finished and request.future.done()
+        assert len(request.token_ids) < options.max_new_tokens
+    finally:
+        worker.stop()
+
+
+def test_prefix_cache_reuse_matches_full_prompt(tiny_llm):
+    tokenizer, model = tiny_llm
+    prefix_cache = PrefixCache(max_bytes=50 * 1024 ** 2, min_tokens=4)
+    worker = GenerationWorker(tokenizer, model, prefix_cache=prefix_cache).start()
+    history = [("user", "какой срок гарантии?"), ("ai", "гарантия один год")]
+    options = GenerationOptions(max_new_tokens=20)
+    try:
+        answers = [
+            llm.generate_answer(tokenizer, model, history, question, "контекст", worker=worker, chat_id=7, options=options)
+            for question in ("а на ремонт?", "а на замену?")
+        ]
+    finally:
+        worker.stop()
+
+    stats = prefix_cache.stats()
+    assert stats["hits"] == 1 and stats["reused_tokens"] > 0
+    # Повторный ход чата заменяет запись, а не добавляет вторую; ответы совпадают с генерацией
+    # по полному промпту, т.е. копия KV-кэша, обрезанная до префикса, не испорчена первым ходом
+    assert stats["entries"] == 1
+    assert answers == [
+        reference_answer(tokenizer, model, prompt(tokenizer, question, history), 20)
+        for question in ("а на ремонт?", "а на замену?")
+    ]
@@ -0,0 +1,72 @@
+import socket
+import threading
+import time
+
+import model_server
+from model_server import MSG_RESULT, OP_READINESS, ModelServerClient, recv_frame, send_frame
+
+
+def serve_unix(path, handler):
+    """Unix-сокет, на каждое соединение которого вызывается handler(sock) в отдельном потоке."""
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(path))
+    server.listen()
+
+    def accept():
+        while True:
+            try:
+                sock, _ = server.accept()
+            except OSError:
+                return
+            threading.Thread(target=handler, args=(sock,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server
+
+
+def test_hung_server_is_not_ready(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_server, "CONTROL_TIMEOUT", 0.1)
+    release = threading.Event()
+
+    def hang(sock):
+        recv_frame(sock)
+        release.wait()
+        sock.close()
+
+    server = serve_unix(tmp_path / "rag.sock", hang)
+    try:
+        client = ModelServerClient(str(tmp_path / "rag.sock"))
+        started_at = time.monotonic()
+        readiness = client.rag_readiness()
+        assert not readiness["ready"]
+        assert time.monotonic() - started_at < 5
+        # Неготовность кэшируется: повторная проверка не ждет таймаут снова
+        assert not client.rag_resources_ready()
+        assert client.pool.empty()
+    finally:
+        release.set()
+        server.close()
+
+
+def test_control_timeout_does_not_limit_answers(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_server, "CONTROL_TIMEOUT", 0.1)
+
+    def slow_answer(sock):
+        while True:
+            try:
+                op, _ = recv_frame(sock)
+            except (ConnectionError, OSError):
+                return
+            if op != OP_READINESS:
+                time.sleep(0.3)
+            send_frame(sock, MSG_RESULT, {"ready": True, "answer": "ok"})
+
+    server = serve_unix(tmp_path / "rag.sock", slow_answer)
+    try:
+        client = ModelServerClient(str(tmp_path / "rag.sock"), pool_size=1)
+        assert client.rag_readiness()["ready"]
+        # То же соединение из пула: ответ дольше CONTROL_TIMEOUT не обрывается
+        assert client.get_rag_answer([], "вопрос")["answer"] == "ok"
+        assert client.rag_readiness()["ready"]
+    finally:
+        server.close()